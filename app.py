@@ -14,7 +14,7 @@ import zipfile
 import time
 import re
 from typing import List, Dict, Set , Tuple
-from collections import defaultdict
+from collections import defaultdict, deque
 from io import BytesIO
 import logging
 from datetime import datetime
@@ -28,7 +28,8 @@ from bidi.algorithm import get_display
 from matplotlib.colors import LinearSegmentedColormap, BoundaryNorm
 import plotly.express as px
 import asyncio
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextlib
+import contextvars
 import threading
 from openpyxl.styles import Font, Alignment, PatternFill
 from openpyxl.styles import NamedStyle
@@ -37,9 +38,27 @@ from openpyxl import load_workbook
 from openpyxl.styles import Border, Side
 import math
 from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from zoneinfo import ZoneInfo
 import base64
+import copy
 from matplotlib import font_manager
 import numpy as np
+import hashlib
+import sqlite3
+import queue
+import importlib.util
+import httpx
+import unicodedata
+import zlib
+import shutil
+import socket
+import heapq
+import itertools
+import random
+from email.utils import parsedate_to_datetime
+from PyPDF2 import PdfReader, PdfWriter
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 # ============================================================================
 # بخش 1: تنظیمات اولیه
 # ============================================================================
@@ -113,6 +132,19 @@ else:
     DEFAULT_API_KEYS = [] 
     # یا می‌توانید خطا دهید: raise ValueError("هیچ API Key یافت نشد!")
 
+# محدودیت‌های هر API Key برای مدل اصلی و مدل سبک triage؛ کلیدها و rate limiter بین همه
+# sessionها مشترک‌اند، پس این مقادیر یک بار برای کل فرایند از متغیرهای محیطی خوانده می‌شوند
+API_LIMITS = {
+    'rpm': int(os.getenv("GEMINI_RPM", "2")),
+    'tpm': int(os.getenv("GEMINI_TPM", "125000")),
+    'rpd': int(os.getenv("GEMINI_RPD", "50"))
+}
+TRIAGE_API_LIMITS = {
+    'rpm': int(os.getenv("GEMINI_TRIAGE_RPM", "15")),
+    'tpm': int(os.getenv("GEMINI_TRIAGE_TPM", "250000")),
+    'rpd': int(os.getenv("GEMINI_TRIAGE_RPD", "1000"))
+}
+
 if 'api_keys' not in st.session_state:
     st.session_state.api_keys = DEFAULT_API_KEYS.copy()
 
@@ -138,6 +170,12 @@ authenticator = stauth.Authenticate(
 if 'authentication_status' not in st.session_state:
     st.session_state.authentication_status = None
 
+# اجرای app.py توسط tools/extraction_worker.py (بیرون از Streamlit): worker صفحه ورود ندارد
+WORKER_MODE = __name__ == "__extraction_worker__" and get_script_run_ctx() is None
+if WORKER_MODE:
+    st.session_state.authentication_status = True
+    st.session_state.name = st.session_state.username = 'worker'
+
 if st.session_state.authentication_status is None:
     name, authentication_status, username = authenticator.login(location='main')
     st.session_state.authentication_status = authentication_status
@@ -157,6 +195,12 @@ if st.session_state.authentication_status == None:
 # ============================================================================
 
 if st.session_state.authentication_status:
+
+    DISPATCH_MODE_LABELS = {
+        'longest': 'بزرگ‌ترین اول (کمترین زمان کل)',
+        'shortest': 'کوچک‌ترین اول (نتایج اولیه سریع‌تر)',
+        'upload': 'ترتیب بارگذاری'
+    }
     
     with st.sidebar:
         st.header("⚙️ تنظیمات برنامه")
@@ -236,13 +280,10 @@ if st.session_state.authentication_status:
 
 
         # st.markdown('<div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 12px; border-radius: 10px; text-align: center; margin-bottom: 15px;"><p style="color: white; margin: 0; font-size: 14px; font-weight: bold;">🎛️ پارامترهای محدودیت API</p></div>', unsafe_allow_html=True)
-        # Initialize session state for API limits if not exists
-        if 'max_tokens_per_min' not in st.session_state:
-            st.session_state.max_tokens_per_min = 125000
-        if 'max_requests_per_min' not in st.session_state:
-            st.session_state.max_requests_per_min = 2
-        if 'max_requests_per_day' not in st.session_state:
-            st.session_state.max_requests_per_day = 50
+        # محدودیت‌ها برای کل فرایند از API_LIMITS می‌آیند و در sidebar فقط نمایش داده می‌شوند
+        st.session_state.max_tokens_per_min = API_LIMITS['tpm']
+        st.session_state.max_requests_per_min = API_LIMITS['rpm']
+        st.session_state.max_requests_per_day = API_LIMITS['rpd']
         
 
         with st.expander("⚡ تنظیمات پیشرفته محدودیت‌های API", expanded=False):   
@@ -251,12 +292,11 @@ if st.session_state.authentication_status:
             st.markdown('<p style="margin: 0 0 8px 0; font-size: 12px; font-weight: 600; color: #7b1fa2; text-align: right;">🟣 حداکثر توکن در دقیقه (هر API)</p>', unsafe_allow_html=True)
             st.session_state.max_tokens_per_min = st.number_input(
                 "max_tokens_label",
-                min_value=1000,
-                max_value=1000000,
                 value=st.session_state.max_tokens_per_min,
                 step=5000,
                 label_visibility="collapsed",
-                help="تعداد توکن‌های قابل پردازش در هر دقیقه برای هر API Key"
+                disabled=True,
+                help="تعداد توکن‌های قابل پردازش در هر دقیقه برای هر API Key (متغیر محیطی GEMINI_TPM)"
             )
             # st.markdown(f'<p style="margin: 5px 0 0 0; font-size: 11px; color: #666; text-align: center;">مقدار فعلی: <strong>{st.session_state.max_tokens_per_min:,}</strong> توکن</p>', unsafe_allow_html=True)
             st.markdown('</div>', unsafe_allow_html=True)
@@ -266,12 +306,11 @@ if st.session_state.authentication_status:
             st.markdown('<p style="margin: 0 0 8px 0; font-size: 12px; font-weight: 600; color: #7b1fa2; text-align: right;">🟣 حداکثر درخواست در دقیقه (هر API)</p>', unsafe_allow_html=True)
             st.session_state.max_requests_per_min = st.number_input(
                 "max_requests_min_label",
-                min_value=1,
-                max_value=100,
                 value=st.session_state.max_requests_per_min,
                 step=1,
                 label_visibility="collapsed",
-                help="تعداد درخواست‌های مجاز در هر دقیقه برای هر API Key"
+                disabled=True,
+                help="تعداد درخواست‌های مجاز در هر دقیقه برای هر API Key (متغیر محیطی GEMINI_RPM)"
             )
             # st.markdown(f'<p style="margin: 5px 0 0 0; font-size: 11px; color: #666; text-align: center;">مقدار فعلی: <strong>{st.session_state.max_requests_per_min}</strong> درخواست</p>', unsafe_allow_html=True)
             st.markdown('</div>', unsafe_allow_html=True)
@@ -281,30 +320,133 @@ if st.session_state.authentication_status:
             st.markdown('<p style="margin: 0 0 8px 0; font-size: 12px; font-weight: 600; color: #7b1fa2; text-align: right;">🟣 حداکثر درخواست در روز (هر API)</p>', unsafe_allow_html=True)
             st.session_state.max_requests_per_day = st.number_input(
                 "max_requests_day_label",
-                min_value=1,
-                max_value=10000,
                 value=st.session_state.max_requests_per_day,
                 step=10,
                 label_visibility="collapsed",
-                help="تعداد کل درخواست‌های مجاز در هر روز برای هر API Key"
+                disabled=True,
+                help="تعداد کل درخواست‌های مجاز در هر روز برای هر API Key (متغیر محیطی GEMINI_RPD)"
             )
             # st.markdown(f'<p style="margin: 5px 0 0 0; font-size: 11px; color: #666; text-align: center;">مقدار فعلی: <strong>{st.session_state.max_requests_per_day}</strong> درخواست</p>', unsafe_allow_html=True)
             st.markdown('</div>', unsafe_allow_html=True)
+
+        # ظرفیت باقی‌مانده امروز و سلامت کلیدها پس از تعریف QuotaLedger و APIKeyManager در main پر می‌شوند
+        quota_status_placeholder = st.empty()
+        key_health_placeholder = st.empty()
+        fair_share_placeholder = st.empty()
         
         # st.markdown("---")
         st.markdown("""
         <div style="background: linear-gradient(135deg, #e3f2fd 0%, #f3e5f5 100%); padding: 12px; border-radius: 8px; border: 1px solid #e0e0e0;">
             <p style="margin: 0; font-size: 12px; color: #424242; text-align: right; line-height: 1.6;">
-            💡 <strong>هشدار:</strong> این مقادیر بر اساس محدودیت‌های Gemini API تنظیم شده‌اند. 
-            تغییر آن‌ها می‌تواند بر سرعت و دقت پردازش تأثیر بگذارد.
-            در صورتی که اطلاع دقیق از محدودیت ها و تغییرات مدل ندارید تنظیمات را تغییر ندهید.
+            💡 <strong>توجه:</strong> این مقادیر بر اساس محدودیت‌های Gemini API تنظیم شده‌اند و برای کل سرور 
+            از متغیرهای محیطی GEMINI_RPM، GEMINI_TPM و GEMINI_RPD خوانده می‌شوند.
+            برای تغییر آن‌ها باید این متغیرها توسط مدیر سرور تنظیم و برنامه دوباره اجرا شود.
              </p>
         </div>
         """, unsafe_allow_html=True)
 
         st.divider()
 
-        
+        if 'page_targeting' not in st.session_state:
+            st.session_state.page_targeting = True
+        if 'context_caching' not in st.session_state:
+            st.session_state.context_caching = False
+        if 'section_parallel' not in st.session_state:
+            st.session_state.section_parallel = False
+        if 'streaming' not in st.session_state:
+            st.session_state.streaming = True
+        if 'hedging' not in st.session_state:
+            st.session_state.hedging = False
+        if 'tiering' not in st.session_state:
+            st.session_state.tiering = False
+        if 'dedup' not in st.session_state:
+            st.session_state.dedup = True
+        if 'background_jobs' not in st.session_state:
+            st.session_state.background_jobs = True
+        if 'dispatch_mode' not in st.session_state:
+            st.session_state.dispatch_mode = os.getenv("DISPATCH_ORDER", "longest")
+        # محدودیت‌های مدل سبک triage (پیش‌فرض: سهمیه رایگان gemini-2.5-flash-lite)
+        st.session_state.triage_requests_per_min = TRIAGE_API_LIMITS['rpm']
+        st.session_state.triage_tokens_per_min = TRIAGE_API_LIMITS['tpm']
+        st.session_state.triage_requests_per_day = TRIAGE_API_LIMITS['rpd']
+        if 'hedge_percentile' not in st.session_state:
+            st.session_state.hedge_percentile = int(os.getenv("GEMINI_HEDGE_PERCENTILE", "95"))
+
+        with st.expander("🧪 تنظیمات پردازش", expanded=False):
+            st.session_state.page_targeting = st.checkbox(
+                "🎯 ارسال فقط صفحات گزارش حسابرس",
+                value=st.session_state.page_targeting,
+                help="صفحات گزارش حسابرس مستقل و بازرس قانونی قبل از ارسال جدا می‌شوند؛ "
+                     "در صورت عدم تشخیص، کل فایل ارسال می‌شود"
+            )
+            st.session_state.section_parallel = st.checkbox(
+                "⚡ استخراج موازی بخش‌ها",
+                value=st.session_state.section_parallel,
+                help="سه بخش خروجی به صورت سه درخواست همزمان (در صورت امکان روی کلیدهای مختلف) "
+                     "ارسال و سپس ادغام می‌شوند؛ سه برابر درخواست مصرف می‌کند"
+            )
+            st.session_state.streaming = st.checkbox(
+                "📡 نمایش زودهنگام خلاصه (Streaming)",
+                value=st.session_state.streaming,
+                help="پاسخ مدل به صورت stream دریافت می‌شود و خلاصه هر فایل به محض آماده شدن "
+                     "در تب نتایج نمایش داده می‌شود"
+            )
+            st.session_state.hedging = st.checkbox(
+                "⚡ درخواست پشتیبان برای پاسخ‌های کند (Hedging)",
+                value=st.session_state.hedging,
+                help="اگر پاسخ یک فایل از صدک تعیین شده تأخیرها دیرتر برسد، همان درخواست با کلید دیگری "
+                     "ارسال و اولین پاسخ استفاده می‌شود (حداکثر ۱۰٪ درخواست اضافه)"
+            )
+            if st.session_state.hedging:
+                st.session_state.hedge_percentile = st.slider(
+                    "صدک آستانه hedge", min_value=50, max_value=99,
+                    value=st.session_state.hedge_percentile
+                )
+            st.session_state.tiering = st.checkbox(
+                "🪜 تحلیل دو مرحله‌ای با مدل سبک (Tiering)",
+                value=st.session_state.tiering,
+                help="همه فایل‌ها ابتدا با مدل سبک تحلیل می‌شوند و فقط فایل‌های نامعتبر، کم‌اطمینان "
+                     "یا با ریسک بالا به مدل اصلی ارجاع می‌شوند"
+            )
+            if st.session_state.tiering:
+                st.session_state.triage_requests_per_min = st.number_input(
+                    "درخواست در دقیقه مدل سبک (هر API)",
+                    value=st.session_state.triage_requests_per_min, disabled=True, help="GEMINI_TRIAGE_RPM"
+                )
+                st.session_state.triage_tokens_per_min = st.number_input(
+                    "توکن در دقیقه مدل سبک (هر API)",
+                    value=st.session_state.triage_tokens_per_min, step=5000, disabled=True, help="GEMINI_TRIAGE_TPM"
+                )
+                st.session_state.triage_requests_per_day = st.number_input(
+                    "درخواست در روز مدل سبک (هر API)",
+                    value=st.session_state.triage_requests_per_day, step=10, disabled=True, help="GEMINI_TRIAGE_RPD"
+                )
+            st.session_state.dedup = st.checkbox(
+                "👯 حذف فایل‌های تکراری",
+                value=st.session_state.dedup,
+                help="فایل‌های یکسان یا با متن تقریباً یکسان (تغییر نام، ذخیره مجدد) فقط یک بار ارسال "
+                     "می‌شوند و نتیجه برای همه نام‌ها ثبت می‌شود"
+            )
+            st.session_state.dispatch_mode = st.selectbox(
+                "↕️ ترتیب ارسال فایل‌ها",
+                options=list(DISPATCH_MODE_LABELS),
+                format_func=DISPATCH_MODE_LABELS.get,
+                index=list(DISPATCH_MODE_LABELS).index(st.session_state.dispatch_mode),
+                help="ترتیب بر اساس هزینه تخمینی هر فایل (تعداد صفحات و حجم). بزرگ‌ترین اول زمان کل batch را "
+                     "کمینه می‌کند؛ کوچک‌ترین اول نتایج اولیه را زودتر نمایش می‌دهد"
+            )
+            st.session_state.background_jobs = st.checkbox(
+                "🛰️ پردازش در پس‌زمینه",
+                value=st.session_state.background_jobs,
+                help="پردازش روی سرور ادامه می‌یابد و با بستن مرورگر، refresh صفحه یا تغییر تنظیمات "
+                     "متوقف نمی‌شود؛ نتایج بعداً از بخش «کارهای پردازش من» قابل دریافت است"
+            )
+            st.session_state.context_caching = st.checkbox(
+                "🧠 کش کردن schema و دستورالعمل‌ها (Context Caching)",
+                value=st.session_state.context_caching,
+                help="دستورالعمل سیستم، prompt و راهنمای کامل schema یک بار برای هر کلید ثبت می‌شوند "
+                     "و در درخواست‌ها فقط به آن ارجاع داده می‌شود"
+            )
 
         
         #########
@@ -343,45 +485,163 @@ if st.session_state.authentication_status:
         AVG_TOKENS_PER_FILE = 20_000      # تخمین متوسط tokens برای هر فایل
         AVG_PROCESSING_TIME = 30          # تخمین زمان پردازش هر فایل (ثانیه)
         
-        def __init__(self, api_keys: list , max_tokens_per_min: int, max_requests_per_min: int, max_requests_per_day: int):
+        def __init__(self, api_keys: list , max_tokens_per_min: int, max_requests_per_min: int, max_requests_per_day: int,
+                     ledger: "QuotaLedger" = None, model: str = None):
             """
             Args:
                 api_keys: لیست API keys موجود
+                ledger: دفتر مصرف مشترک؛ در صورت وجود ظرفیت روزانه از مصرف واقعی امروز محاسبه می‌شود
+                model: مدلی که مصرف آن از دفتر خوانده می‌شود
             """
+            self.api_keys = list(api_keys)
             self.num_api_keys = len(api_keys)
-            self.api_usage = {key: {'requests_today': 0, 'last_reset': datetime.now()} 
+            self.ledger = ledger
+            self.model = model
+            usage = ledger.usage(self.api_keys, model) if ledger and model else {}
+            self.api_usage = {key: {'requests_today': usage.get(key, {}).get('requests', 0),
+                                    'tokens_today': usage.get(key, {}).get('tokens', 0),
+                                    'last_reset': datetime.now()}
                             for key in api_keys}
 
              # ✅ مقادیر محدودیت‌ها اکنون از ورودی‌های تابع init گرفته می‌شوند
             self.MAX_TOKENS_PER_MIN = max_tokens_per_min
             self.MAX_REQUESTS_PER_MIN = max_requests_per_min
             self.MAX_REQUESTS_PER_DAY = max_requests_per_day      
+            # مصرف هر مدل در حالت چند مرحله‌ای: model -> {'requests', 'tokens'}
+            self.tier_usage = defaultdict(lambda: {'requests': 0, 'tokens': 0})
+            self.tier_lock = threading.Lock()
+
+        def remaining_requests_today(self, model: str = None, daily_limit: int = None) -> int:
+            """درخواست‌های باقی‌مانده امروز روی همه کلیدها (بدون دفتر مصرف: کل سقف روزانه)"""
+            daily_limit = daily_limit or self.MAX_REQUESTS_PER_DAY
+            if not self.ledger or not (model or self.model):
+                return self.num_api_keys * daily_limit
+            if model is None or model == self.model:
+                return sum(max(0, daily_limit - usage['requests_today']) for usage in self.api_usage.values())
+            return self.ledger.remaining(self.api_keys, model, daily_limit)
+
+        def calculate_tier_budgets(self, num_files: int, avg_tokens_per_file: float,
+                                   tier_limits: Dict[str, dict], escalation_rate: float) -> dict:
+            """
+            بودجه جداگانه RPM/TPM/RPD برای هر مدل در حالت چند مرحله‌ای
 
+            Args:
+                num_files: تعداد فایل‌هایی که نیاز به درخواست دارند
+                avg_tokens_per_file: میانگین توکن هر درخواست
+                tier_limits: {model: {'rpm', 'tpm', 'rpd', 'share'}}؛ share نسبت فایل‌هایی است
+                    که به این مدل می‌رسند (۱ برای مدل triage، نرخ ارجاع برای مدل اصلی)
+                escalation_rate: نرخ تخمینی ارجاع به مدل اصلی
 
-        def calculate_optimal_workers(self, num_files: int, file_sizes: list = None) -> dict:
+            Returns:
+                dict: سقف همزمانی و ظرفیت روزانه هر مدل و ظرفیت روزانه کل خط پردازش
+            """
+            tiers = {}
+            for model, limits in tier_limits.items():
+                share = max(limits['share'], 0.01)
+                max_workers_rpm = self.num_api_keys * limits['rpm']
+                max_workers_tokens = math.floor(self.num_api_keys * limits['tpm'] / max(1, avg_tokens_per_file))
+                tiers[model] = {
+                    'workers': max(1, min(max_workers_rpm, max_workers_tokens, math.ceil(num_files * share),
+                                          GEMINI_MAX_CONCURRENCY)),
+                    'daily_files': int(self.remaining_requests_today(model, limits['rpd']) / share),
+                    'expected_requests': math.ceil(num_files * limits['share']),
+                    **limits
+                }
+            return {
+                'tiers': tiers,
+                'escalation_rate': escalation_rate,
+                'max_daily': min(tier['daily_files'] for tier in tiers.values()),
+                'total_workers': sum(tier['workers'] for tier in tiers.values())
+            }
+
+        def record_tier_usage(self, model: str, tokens: int):
+            with self.tier_lock:
+                self.tier_usage[model]['requests'] += 1
+                self.tier_usage[model]['tokens'] += tokens
+
+        def tier_usage_report(self) -> Dict[str, dict]:
+            with self.tier_lock:
+                return {model: dict(usage) for model, usage in self.tier_usage.items()}
+
+
+        @staticmethod
+        def dispatch_order(file_seconds: List[float], mode: str = 'longest') -> List[int]:
+            """
+            ترتیب ارسال فایل‌ها به موتور پردازش
+
+            - longest: بزرگ‌ترین اول (LPT)؛ گزارش ۳۰۰ صفحه‌ای در انتهای batch تنها نمی‌ماند و زمان کل کمینه می‌شود
+            - shortest: کوچک‌ترین اول؛ اولین نتایج زودتر آماده می‌شوند
+            - upload: ترتیب بارگذاری
+            """
+            indices = list(range(len(file_seconds)))
+            if mode == 'longest':
+                return sorted(indices, key=lambda i: -file_seconds[i])
+            if mode == 'shortest':
+                return sorted(indices, key=lambda i: file_seconds[i])
+            return indices
+
+        @staticmethod
+        def simulate_completions(file_seconds: List[float], workers: int, order: List[int]) -> List[float]:
+            """زمان تکمیل هر فایل (به ترتیب order) با زمان‌بندی لیستی: هر worker که آزاد شود فایل بعدی صف را برمی‌دارد"""
+            finish = [0.0] * max(1, min(workers, len(order)))
+            completions = []
+            for index in order:
+                start = heapq.heappop(finish)
+                completions.append(start + file_seconds[index])
+                heapq.heappush(finish, completions[-1])
+            return completions
+
+        @staticmethod
+        def simulate_makespan(file_seconds: List[float], workers: int, order: List[int]) -> float:
+            """زمان کل batch با همان زمان‌بندی simulate_completions"""
+            return max(APILimitsManager.simulate_completions(file_seconds, workers, order), default=0.0)
+
+        def calculate_optimal_workers(self, num_files: int, file_sizes: list = None, file_estimates: list = None,
+                                      requests_per_file: int = 1, dispatch_mode: str = 'longest') -> dict:
             """
             محاسبه تعداد بهینه workers بر اساس محدودیت‌های API
             
             Args:
                 num_files: تعداد فایل‌های ورودی
-                file_sizes: اندازه فایل‌ها (اختیاری) برای تخمین دقیق‌تر
+                file_sizes: اندازه فایل‌ها به بایت (اختیاری) برای تخمین دقیق‌تر
+                file_estimates: خروجی FileCostEstimator برای هر فایل (اختیاری، دقیق‌ترین حالت)
+                requests_per_file: تعداد درخواست API برای هر فایل (مثلاً ۳ در حالت موازی بخش‌ها)
+                dispatch_mode: ترتیب ارسال فایل‌ها (longest، shortest یا upload)
             
             Returns:
-                dict: شامل تعداد workers، زمان تخمینی، و توضیحات
+                dict: شامل تعداد workers، ترتیب ارسال، زمان تخمینی، و توضیحات
             """
+
+            # 0️⃣ هزینه هر فایل: تخمین واقعی، سپس اندازه فایل، در نهایت مقدار پیش‌فرض
+            if file_estimates:
+                file_tokens = [e['total_tokens'] for e in file_estimates]
+                file_seconds = [e['seconds'] for e in file_estimates]
+            elif file_sizes:
+                file_tokens = [FileCostEstimator.tokens_from_size(size) for size in file_sizes]
+                file_seconds = [tokens / self.AVG_TOKENS_PER_FILE * self.AVG_PROCESSING_TIME for tokens in file_tokens]
+            else:
+                file_tokens = [self.AVG_TOKENS_PER_FILE] * num_files
+                file_seconds = [self.AVG_PROCESSING_TIME] * num_files
+
+            # فایل‌های موجود در کش هزینه‌ای ندارند
+            billable_tokens = [t for t in file_tokens if t > 0]
+            avg_tokens_per_file = (sum(billable_tokens) / len(billable_tokens)) if billable_tokens else self.AVG_TOKENS_PER_FILE
+            total_tokens = sum(file_tokens)
+            total_seconds = sum(file_seconds)
+            oversized_files = sum(1 for t in file_tokens if t > self.MAX_TOKENS_PER_MIN)
             
             # 1️⃣ محاسبه بر اساس محدودیت Requests Per Minute
             # هر API می‌تواند 2 request در دقیقه داشته باشد
-            max_workers_rpm = self.num_api_keys * self.MAX_REQUESTS_PER_MIN
+            max_workers_rpm = max(1, self.num_api_keys * self.MAX_REQUESTS_PER_MIN // requests_per_file)
             
             # 2️⃣ محاسبه بر اساس محدودیت Tokens Per Minute
-            # با فرض هر فایل 20K token
-            max_files_per_min_tokens = (self.num_api_keys * self.MAX_TOKENS_PER_MIN) / self.AVG_TOKENS_PER_FILE
-            max_workers_tokens = math.floor(max_files_per_min_tokens)
+            # بر اساس میانگین توکن واقعی فایل‌های این batch
+            max_files_per_min_tokens = (self.num_api_keys * self.MAX_TOKENS_PER_MIN) / avg_tokens_per_file
+            max_workers_tokens = max(1, math.floor(max_files_per_min_tokens))
             
             # 3️⃣ محاسبه بر اساس محدودیت Daily Requests
-            # هر API: 50 request در روز
-            max_daily_files = self.num_api_keys * self.MAX_REQUESTS_PER_DAY
+            # ظرفیت باقی‌مانده امروز از دفتر مصرف مشترک (شامل مصرف سایر کاربران)
+            max_daily_files = self.remaining_requests_today() // requests_per_file
             
             # 4️⃣ محدودیت عملی: زمان پردازش
             # اگر هر فایل 30 ثانیه طول بکشد و ما 60 ثانیه داریم
@@ -393,20 +653,29 @@ if st.session_state.authentication_status:
                 max_workers_rpm,          # محدودیت RPM
                 max_workers_tokens,       # محدودیت tokens
                 num_files,                # تعداد فایل‌ها
-                10                        # حداکثر منطقی برای جلوگیری از اشغال منابع
+                GEMINI_MAX_CONCURRENCY    # سقف سراسری فایل‌های همزمان
             )
             
             # اطمینان از اینکه حداقل 1 worker داریم
             optimal_workers = max(1, optimal_workers)
             
-            # 6️⃣ محاسبه زمان تخمینی
-            # با پردازش موازی
-            estimated_time_parallel = (num_files / optimal_workers) * self.AVG_PROCESSING_TIME
+            # 6️⃣ ترتیب ارسال و محاسبه زمان تخمینی
+            # با پردازش موازی: زمان کل زمان‌بندی لیستی با همین ترتیب (شامل کندترین فایل) و سقف‌های RPM/TPM
+            dispatch_order = self.dispatch_order(file_seconds, dispatch_mode)
+            makespan = self.simulate_makespan(file_seconds, optimal_workers, dispatch_order)
+            makespan_upload_order = self.simulate_makespan(file_seconds, optimal_workers, list(range(len(file_seconds))))
+            estimated_time_parallel = max(
+                makespan,
+                num_files / max(1, max_workers_rpm) * 60,
+                total_tokens / (self.num_api_keys * self.MAX_TOKENS_PER_MIN) * 60,
+                1
+            )
             # بدون پردازش موازی
-            estimated_time_sequential = num_files * self.AVG_PROCESSING_TIME
+            estimated_time_sequential = max(total_seconds, 1)
             
-            # 7️⃣ بررسی محدودیت روزانه
-            daily_limit_ok = num_files <= max_daily_files
+            # 7️⃣ بررسی محدودیت روزانه (فایل‌های موجود در کش درخواستی مصرف نمی‌کنند)
+            billable_files = len(billable_tokens) if file_estimates else num_files
+            daily_limit_ok = billable_files <= max_daily_files
             
             # 8️⃣ تعیین استراتژی
             if num_files <= max_workers_rpm:
@@ -426,22 +695,28 @@ if st.session_state.authentication_status:
                 'message': message,
                 'estimated_time_minutes': estimated_time_parallel / 60,
                 'speedup_factor': estimated_time_sequential / estimated_time_parallel,
+                'dispatch_order': dispatch_order,
+                'makespan_seconds': {'ordered': makespan, 'upload': makespan_upload_order},
                 'limits': {
                     'max_rpm': max_workers_rpm,
                     'max_tokens': max_workers_tokens,
                     'max_daily': max_daily_files,
                     'files_count': num_files,
-                    'daily_limit_ok': daily_limit_ok
+                    'daily_limit_ok': daily_limit_ok,
+                    'total_tokens': total_tokens,
+                    'avg_tokens_per_file': avg_tokens_per_file,
+                    'oversized_files': oversized_files
                 },
                 'explanation': self._generate_explanation(
                     optimal_workers, 
                     num_files, 
                     max_workers_rpm,
-                    estimated_time_parallel
+                    estimated_time_parallel / 60,
+                    total_tokens
                 )
             }
         
-        def _generate_explanation(self, workers: int, files: int, max_rpm: int, time_min: float) -> str:
+        def _generate_explanation(self, workers: int, files: int, max_rpm: int, time_min: float, total_tokens: int = 0) -> str:
             """تولید توضیحات برای کاربر"""
             explanations = []
             
@@ -450,6 +725,8 @@ if st.session_state.authentication_status:
             explanations.append(f"  • تعداد فایل‌ها: {files}")
             explanations.append(f"  • Workers بهینه: {workers}")
             explanations.append(f"  • زمان تخمینی: {time_min:.1f} دقیقه")
+            if total_tokens:
+                explanations.append(f"  • توکن تخمینی کل: {total_tokens:,.0f}")
             
             explanations.append(f"\n📊 **محدودیت‌های API:**")
             explanations.append(f"  • حداکثر همزمان: {max_rpm} فایل در دقیقه")
@@ -464,34 +741,829 @@ if st.session_state.authentication_status:
             
             return "\n".join(explanations)
 
-    
+
     # ============================================================================
-    # 🔄 تابع اصلاح شده: پردازش با محاسبه خودکار workers
+    # 💾 کش دائمی نتایج استخراج (SQLite)
     # ============================================================================
 
-    def process_files_concurrent_smart(uploaded_files):
+    class ExtractionCache:
         """
-        ✅ پردازش همزمان با محاسبه خودکار تعداد workers بهینه
-        
-        ویژگی‌های جدید:
-        - محاسبه خودکار workers بر اساس محدودیت‌های API
-        - نمایش توضیحات کامل برای کاربر
-        - بهینه‌سازی منابع
+        کش روی دیسک برای نتایج FinancialAnalyzer
+
+        کلید هر رکورد از SHA-256 محتوای PDF به همراه اثرانگشت تنظیمات درخواست
+        (schema، prompt، مدل و temperature) ساخته می‌شود؛ بنابراین هر تغییری در
+        این تنظیمات به طور خودکار نتایج قدیمی را بی‌اعتبار می‌کند.
         """
-        
+
+        def __init__(self, cache_dir: str, max_size_mb: int = 500, max_age_days: int = 30):
+            """
+            Args:
+                cache_dir: مسیر پوشه ذخیره کش
+                max_size_mb: حداکثر حجم کل نتایج ذخیره شده (مگابایت)
+                max_age_days: حداکثر عمر هر رکورد (روز)
+            """
+            os.makedirs(cache_dir, exist_ok=True)
+            self.db_path = os.path.join(cache_dir, 'extraction_cache.sqlite3')
+            self.max_size_bytes = max_size_mb * 1024 * 1024
+            self.max_age_seconds = max_age_days * 24 * 3600
+            self.hits = 0
+            self.misses = 0
+            self.lock = threading.Lock()
+
+            with self._connect() as conn:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS extraction_cache (
+                        cache_key TEXT PRIMARY KEY,
+                        file_hash TEXT NOT NULL,
+                        filename TEXT,
+                        result TEXT NOT NULL,
+                        size_bytes INTEGER NOT NULL,
+                        created_at REAL NOT NULL,
+                        last_access REAL NOT NULL
+                    )
+                """)
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_last_access ON extraction_cache(last_access)')
+
+        def _connect(self):
+            return sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+
+        @staticmethod
+        def file_hash(file_content: bytes) -> str:
+            return hashlib.sha256(file_content).hexdigest()
+
+        @staticmethod
+        def make_key(file_hash: str, fingerprint: str) -> str:
+            return hashlib.sha256(f"{file_hash}:{fingerprint}".encode('utf-8')).hexdigest()
+
+        def get(self, file_content: bytes, fingerprint: str):
+            """برگرداندن نتیجه ذخیره شده یا None"""
+            return self.get_by_hash(self.file_hash(file_content), fingerprint)
+
+        def get_by_hash(self, file_hash: str, fingerprint: str):
+            """مانند get برای زمانی که فقط hash فایل در دسترس است (مثلاً نتایج Batch)"""
+            cache_key = self.make_key(file_hash, fingerprint)
+            now = time.time()
+            try:
+                with self._connect() as conn:
+                    row = conn.execute(
+                        'SELECT result, created_at FROM extraction_cache WHERE cache_key = ?',
+                        (cache_key,)
+                    ).fetchone()
+                    if row and now - row[1] <= self.max_age_seconds:
+                        conn.execute(
+                            'UPDATE extraction_cache SET last_access = ? WHERE cache_key = ?',
+                            (now, cache_key)
+                        )
+                        with self.lock:
+                            self.hits += 1
+                        return json.loads(row[0])
+            except (sqlite3.Error, json.JSONDecodeError) as e:
+                logger.warning(f"Cache read failed: {e}")
+
+            with self.lock:
+                self.misses += 1
+            return None
+
+        def contains(self, file_content: bytes, fingerprint: str) -> bool:
+            """بررسی وجود نتیجه معتبر بدون تغییر شمارنده‌های hit/miss"""
+            cache_key = self.make_key(self.file_hash(file_content), fingerprint)
+            try:
+                with self._connect() as conn:
+                    row = conn.execute(
+                        'SELECT created_at FROM extraction_cache WHERE cache_key = ?', (cache_key,)
+                    ).fetchone()
+                return bool(row) and time.time() - row[0] <= self.max_age_seconds
+            except sqlite3.Error:
+                return False
+
+        def put(self, file_content: bytes, fingerprint: str, result: Dict, filename: str = None,
+                file_hash: str = None):
+            """ذخیره نتیجه موفق و اجرای سیاست حذف"""
+            file_hash = file_hash or self.file_hash(file_content)
+            payload = json.dumps(result, ensure_ascii=False)
+            now = time.time()
+            try:
+                with self._connect() as conn:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO extraction_cache '
+                        '(cache_key, file_hash, filename, result, size_bytes, created_at, last_access) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (self.make_key(file_hash, fingerprint), file_hash, filename,
+                         payload, len(payload.encode('utf-8')), now, now)
+                    )
+                self.evict()
+            except sqlite3.Error as e:
+                logger.warning(f"Cache write failed: {e}")
+
+        def evict(self):
+            """حذف رکوردهای منقضی و سپس قدیمی‌ترین رکوردها تا رسیدن به سقف حجم"""
+            with self._connect() as conn:
+                conn.execute(
+                    'DELETE FROM extraction_cache WHERE created_at < ?',
+                    (time.time() - self.max_age_seconds,)
+                )
+                total_size = conn.execute(
+                    'SELECT COALESCE(SUM(size_bytes), 0) FROM extraction_cache'
+                ).fetchone()[0]
+                if total_size <= self.max_size_bytes:
+                    return
+                for cache_key, size_bytes in conn.execute(
+                    'SELECT cache_key, size_bytes FROM extraction_cache ORDER BY last_access ASC'
+                ).fetchall():
+                    if total_size <= self.max_size_bytes:
+                        break
+                    conn.execute('DELETE FROM extraction_cache WHERE cache_key = ?', (cache_key,))
+                    total_size -= size_bytes
+
+        def stats(self) -> dict:
+            with self._connect() as conn:
+                entries, size_bytes = conn.execute(
+                    'SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM extraction_cache'
+                ).fetchone()
+            with self.lock:
+                return {
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': entries,
+                    'size_mb': size_bytes / (1024 * 1024)
+                }
+
+    @st.cache_resource
+    def get_extraction_cache():
+        """یک نمونه مشترک از کش برای همه sessionها"""
+        return ExtractionCache(
+            cache_dir=os.getenv("ANALYSIS_CACHE_DIR", ".analysis_cache"),
+            max_size_mb=int(os.getenv("ANALYSIS_CACHE_MAX_MB", "500")),
+            max_age_days=int(os.getenv("ANALYSIS_CACHE_MAX_AGE_DAYS", "30"))
+        )
+
+
+    # ============================================================================
+    # 🎯 پیش‌پردازش: جدا کردن صفحات گزارش حسابرس با PyPDF2
+    # ============================================================================
+
+    def normalize_persian_text(text: str) -> str:
+        """یکسان‌سازی متن استخراج شده از PDF (حروف عربی، اشکال ارائه‌ای، نیم‌فاصله و کشیده)"""
+        text = unicodedata.normalize('NFKC', text or '')
+        text = text.replace('ي', 'ی').replace('ى', 'ی').replace('ك', 'ک')
+        return text.replace('\u200c', '').replace('\u0640', '')
+
+
+    class AuditorReportLocator:
+        """
+        پیدا کردن صفحات گزارش حسابرس مستقل و بازرس قانونی در گزارش سالانه
+
+        schema فقط به همین گزارش نیاز دارد؛ ارسال چند صفحه به جای کل صورت‌های مالی
+        توکن ورودی و زمان پاسخ را به شدت کاهش می‌دهد.
+        """
+
+        KEYWORDS = ["گزارش حسابرس مستقل", "بازرس قانونی"]
+        TRAILING_PAGES = 4            # صفحات ادامه گزارش بعد از هر صفحه پیدا شده
+        MAX_PAGES = 15                # سقف صفحات ارسالی
+        MIN_PAGES_FOR_TARGETING = 8   # فایل‌های کوچک بدون تغییر ارسال می‌شوند
+        MAX_KEPT_RATIO = 0.8          # اگر بیشتر صفحات انتخاب شدند، کل فایل ارسال شود
+
+        @staticmethod
+        def normalize_text(text: str) -> str:
+            """متن یکسان‌سازی شده بدون فاصله (برای جستجوی کلیدواژه مستقل از شکستن کلمات)"""
+            return re.sub(r'\s+', '', normalize_persian_text(text))
+
+        def __init__(self):
+            # متن برخی PDFهای فارسی با ترتیب کلمات یا حروف معکوس استخراج می‌شود
+            self.keywords = []
+            for keyword in self.KEYWORDS:
+                words = [self.normalize_text(w) for w in keyword.split()]
+                self.keywords += [''.join(words), ''.join(reversed(words)), ''.join(words)[::-1]]
+
+        def locate(self, reader: PdfReader) -> List[int]:
+            """شماره صفحات (از صفر) شامل کلیدواژه‌ها"""
+            hits = []
+            for page_number, page in enumerate(reader.pages):
+                try:
+                    text = self.normalize_text(page.extract_text())
+                except Exception:
+                    continue
+                if any(keyword in text for keyword in self.keywords):
+                    hits.append(page_number)
+            return hits
+
+        def trim(self, file_content: bytes) -> Tuple[bytes, dict]:
+            """
+            ساخت PDF شامل صفحات گزارش حسابرس
+
+            Returns:
+                tuple: (محتوای ارسالی، اطلاعات پیش‌پردازش)
+            """
+            info = {'trimmed': False, 'total_pages': None, 'sent_pages': None, 'reason': ''}
+            try:
+                reader = PdfReader(BytesIO(file_content))
+                total_pages = len(reader.pages)
+                info['total_pages'] = info['sent_pages'] = total_pages
+
+                if total_pages < self.MIN_PAGES_FOR_TARGETING:
+                    info['reason'] = 'small_document'
+                    return file_content, info
+
+                hits = self.locate(reader)
+                if not hits:
+                    info['reason'] = 'not_found'
+                    return file_content, info
+
+                selected = []
+                for hit in hits:
+                    for page_number in range(hit, min(hit + self.TRAILING_PAGES + 1, total_pages)):
+                        if page_number not in selected:
+                            selected.append(page_number)
+                selected = sorted(selected)[:self.MAX_PAGES]
+
+                if len(selected) >= total_pages * self.MAX_KEPT_RATIO:
+                    info['reason'] = 'most_pages_matched'
+                    return file_content, info
+
+                writer = PdfWriter()
+                for page_number in selected:
+                    writer.add_page(reader.pages[page_number])
+                buffer = BytesIO()
+                writer.write(buffer)
+
+                info.update({
+                    'trimmed': True,
+                    'sent_pages': len(selected),
+                    'pages': [p + 1 for p in selected],
+                    'reason': 'found'
+                })
+                return buffer.getvalue(), info
+            except Exception as e:
+                logger.warning(f"Page targeting failed, sending full document: {e}")
+                info['reason'] = 'error'
+                return file_content, info
+
+
+    # ============================================================================
+    # 👯 تشخیص فایل‌های تکراری (hash دقیق و MinHash متن) قبل از مصرف سهمیه
+    # ============================================================================
+
+    class DuplicateDetector:
+        """
+        پیدا کردن فایل‌های تکراری در یک batch تا برای هر گزارش فقط یک درخواست ارسال شود
+
+        فایل‌های کاملاً یکسان (تغییر نام یا یک گزارش در دو ZIP) با SHA-256 و نسخه‌های
+        بازسازی شده همان گزارش (ذخیره مجدد، متادیتای متفاوت) با امضای MinHash روی
+        shingleهای کلمات متن استخراج شده توسط PyPDF2 تشخیص داده می‌شوند. برای جلوگیری از
+        یکی شدن گزارش‌های دو شرکت با متن قالب مشابه، تعداد صفحات هم باید برابر باشد.
+        اسکن‌های بدون لایه متن فقط با hash دقیق مقایسه می‌شوند.
+        """
+
+        NUM_PERM = 128
+        SHINGLE_WORDS = 5
+        MIN_SHINGLES = 50            # متن کمتر از این مقدار برای مقایسه تقریبی قابل اعتماد نیست
+        MAX_HASH = (1 << 32) - 1
+        MERSENNE_PRIME = (1 << 61) - 1
+        CHUNK = 8192                 # محدود کردن حافظه ماتریس permutation × shingle
+
+        def __init__(self, threshold: float = 0.9):
+            """
+            Args:
+                threshold: حداقل شباهت Jaccard تخمینی برای تکراری دانستن دو فایل
+            """
+            self.threshold = threshold
+            rng = np.random.default_rng(1)
+            self.perm_a = rng.integers(1, self.MAX_HASH, size=self.NUM_PERM, dtype=np.uint64)
+            self.perm_b = rng.integers(0, self.MAX_HASH, size=self.NUM_PERM, dtype=np.uint64)
+
+        @staticmethod
+        def normalize_words(text: str) -> List[str]:
+            """کلمات متن یکسان‌سازی شده"""
+            return normalize_persian_text(text).split()
+
+        def signature(self, text: str):
+            """امضای MinHash متن یا None اگر متن کافی نباشد"""
+            words = self.normalize_words(text)
+            shingles = {
+                ' '.join(words[i:i + self.SHINGLE_WORDS])
+                for i in range(max(0, len(words) - self.SHINGLE_WORDS + 1))
+            }
+            if len(shingles) < self.MIN_SHINGLES:
+                return None
+            hashes = np.fromiter(
+                (zlib.crc32(s.encode('utf-8')) for s in shingles), dtype=np.uint64, count=len(shingles)
+            )
+            signature = np.full(self.NUM_PERM, self.MAX_HASH, dtype=np.uint64)
+            for start in range(0, len(hashes), self.CHUNK):
+                chunk = hashes[start:start + self.CHUNK]
+                permuted = (np.outer(self.perm_a, chunk) + self.perm_b[:, None]) % self.MERSENNE_PRIME
+                signature = np.minimum(signature, (permuted & np.uint64(self.MAX_HASH)).min(axis=1))
+            return signature
+
+        def fingerprint(self, file_content: bytes) -> dict:
+            """hash دقیق، تعداد صفحات و امضای MinHash یک فایل"""
+            info = {'sha256': ExtractionCache.file_hash(file_content), 'pages': None, 'signature': None}
+            try:
+                reader = PdfReader(BytesIO(file_content))
+                info['pages'] = len(reader.pages)
+                texts = []
+                for page in reader.pages:
+                    try:
+                        texts.append(page.extract_text() or '')
+                    except Exception:
+                        continue
+                info['signature'] = self.signature(' '.join(texts))
+            except Exception as e:
+                logger.warning(f"Duplicate detection could not read PDF: {e}")
+            return info
+
+        def find_duplicates(self, contents: List[bytes]) -> Dict[int, dict]:
+            """
+            Returns:
+                dict: اندیس هر فایل تکراری ← {'of': اندیس فایل اصلی، 'kind': 'exact' یا 'similar'، 'similarity'}
+            """
+            duplicates = {}
+            by_hash = {}
+            primaries = []    # (اندیس، تعداد صفحات، امضا) فایل‌های یکتای دارای متن
+            for index, content in enumerate(contents):
+                file_hash = ExtractionCache.file_hash(content)
+                if file_hash in by_hash:
+                    primary_index = by_hash[file_hash]
+                    primary_index = duplicates.get(primary_index, {'of': primary_index})['of']
+                    duplicates[index] = {'of': primary_index, 'kind': 'exact', 'similarity': 1.0}
+                    continue
+                by_hash[file_hash] = index
+                info = self.fingerprint(content)
+                if info['signature'] is None:
+                    continue
+                best = None
+                for primary_index, pages, signature in primaries:
+                    if pages != info['pages']:
+                        continue
+                    similarity = float(np.mean(signature == info['signature']))
+                    if similarity >= self.threshold and (best is None or similarity > best[1]):
+                        best = (primary_index, similarity)
+                if best:
+                    duplicates[index] = {'of': best[0], 'kind': 'similar', 'similarity': best[1]}
+                else:
+                    primaries.append((index, info['pages'], info['signature']))
+            return duplicates
+
+
+    # ============================================================================
+    # 🧮 تخمین هزینه هر فایل (توکن و زمان) با کالیبراسیون از usage_metadata
+    # ============================================================================
+
+    class FileCostEstimator:
+        """
+        تخمین توکن و زمان پردازش هر PDF از روی تعداد صفحات، تراکم متن و تصاویر
+
+        ضرایب اولیه تقریبی هستند و پس از هر فراخوانی موفق با مقادیر واقعی
+        response.usage_metadata به صورت میانگین متحرک نمایی کالیبره می‌شوند.
+        """
+
+        TOKENS_PER_PAGE = 258          # هزینه هر صفحه PDF در Gemini
+        CHARS_PER_TOKEN = 3.0          # متن فارسی
+        TOKENS_PER_IMAGE = 258
+        AVG_BYTES_PER_PAGE = 60_000    # فقط وقتی PDF قابل خواندن نیست
+        DEFAULT_OUTPUT_TOKENS = 8_000  # شامل توکن‌های thinking
+        DEFAULT_SECONDS_PER_1K_TOKENS = 1.5
+        SMOOTHING = 0.2
+
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.input_ratio = 1.0      # نسبت توکن ورودی واقعی به تخمینی
+            self.output_tokens = float(self.DEFAULT_OUTPUT_TOKENS)
+            self.seconds_per_1k_tokens = self.DEFAULT_SECONDS_PER_1K_TOKENS
+            self.observations = 0
+
+        @classmethod
+        def tokens_from_size(cls, size_bytes: int) -> int:
+            """تخمین سرانگشتی وقتی فقط اندازه فایل در دسترس است"""
+            pages = max(1, math.ceil(size_bytes / cls.AVG_BYTES_PER_PAGE))
+            return pages * cls.TOKENS_PER_PAGE + cls.DEFAULT_OUTPUT_TOKENS
+
+        @staticmethod
+        def inspect_pdf(file_content: bytes) -> dict:
+            """شمارش صفحات، کاراکترهای متن و تصاویر با PyPDF2"""
+            features = {'pages': 0, 'text_chars': 0, 'images': 0, 'readable': False}
+            try:
+                reader = PdfReader(BytesIO(file_content))
+                features['pages'] = len(reader.pages)
+                for page in reader.pages:
+                    try:
+                        features['text_chars'] += len(page.extract_text() or '')
+                        resources = page.get('/Resources')
+                        xobjects = resources.get_object().get('/XObject') if resources else None
+                        if xobjects:
+                            xobjects = xobjects.get_object()
+                            features['images'] += sum(
+                                1 for name in xobjects
+                                if xobjects[name].get_object().get('/Subtype') == '/Image'
+                            )
+                    except Exception:
+                        continue
+                features['readable'] = True
+            except Exception as e:
+                logger.warning(f"Cost estimation could not read PDF: {e}")
+                features['pages'] = max(1, math.ceil(len(file_content) / FileCostEstimator.AVG_BYTES_PER_PAGE))
+            return features
+
+        def estimate(self, file_content: bytes, overhead_tokens: int = 0) -> dict:
+            """
+            Args:
+                file_content: محتوایی که واقعاً ارسال می‌شود
+                overhead_tokens: توکن‌های ثابت هر درخواست (prompt، schema و system instruction)
+            """
+            features = self.inspect_pdf(file_content)
+            raw_input = (
+                features['pages'] * self.TOKENS_PER_PAGE
+                + features['text_chars'] / self.CHARS_PER_TOKEN
+                + features['images'] * self.TOKENS_PER_IMAGE
+                + overhead_tokens
+            )
+            with self.lock:
+                input_tokens = int(raw_input * self.input_ratio)
+                output_tokens = int(self.output_tokens)
+                seconds_per_1k = self.seconds_per_1k_tokens
+            total_tokens = input_tokens + output_tokens
+            return {
+                **features,
+                'raw_input_tokens': raw_input,
+                'input_tokens': input_tokens,
+                'output_tokens': output_tokens,
+                'total_tokens': total_tokens,
+                'seconds': total_tokens / 1000 * seconds_per_1k
+            }
+
+        def observe(self, estimate: dict, usage_metadata, duration: float):
+            """کالیبراسیون با مصرف واقعی یک فراخوانی موفق"""
+            if not estimate or usage_metadata is None:
+                return
+            prompt_tokens = getattr(usage_metadata, 'prompt_token_count', None) or 0
+            total_tokens = getattr(usage_metadata, 'total_token_count', None) or 0
+            if prompt_tokens <= 0 or total_tokens <= 0:
+                return
+            alpha = self.SMOOTHING
+            with self.lock:
+                if estimate['raw_input_tokens'] > 0:
+                    ratio = prompt_tokens / estimate['raw_input_tokens']
+                    self.input_ratio = (1 - alpha) * self.input_ratio + alpha * ratio
+                self.output_tokens = (1 - alpha) * self.output_tokens + alpha * (total_tokens - prompt_tokens)
+                if duration > 0:
+                    self.seconds_per_1k_tokens = (
+                        (1 - alpha) * self.seconds_per_1k_tokens + alpha * duration / (total_tokens / 1000)
+                    )
+                self.observations += 1
+
+    @st.cache_resource
+    def get_cost_estimator():
+        """ضرایب کالیبره شده بین batchها و sessionها حفظ می‌شوند"""
+        return FileCostEstimator()
+
+
+    # ============================================================================
+    # 🧠 Context Caching برای schema، دستورالعمل سیستم و prompt ثابت
+    # ============================================================================
+
+    def strip_schema_descriptions(schema):
+        """حذف توضیحات متنی از schema؛ ساختار، enumها و فیلدهای الزامی حفظ می‌شوند"""
+        if isinstance(schema, dict):
+            return {k: strip_schema_descriptions(v) for k, v in schema.items() if k != 'description'}
+        if isinstance(schema, list):
+            return [strip_schema_descriptions(item) for item in schema]
+        return schema
+
+
+    class GeminiContextCacheBackend:
+        """ثبت cached content واقعی روی سرور Gemini"""
+
+        local = False
+
+        def create(self, client, model: str, system_instruction: str, text: str, ttl_seconds: int) -> dict:
+            cached = client.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    display_name='financial-analyzer-instructions',
+                    system_instruction=system_instruction,
+                    contents=[types.Content(role='user', parts=[types.Part(text=text)])],
+                    ttl=f"{ttl_seconds}s"
+                )
+            )
+            token_count = getattr(cached.usage_metadata, 'total_token_count', None) or 0
+            return {'name': cached.name, 'token_count': token_count}
+
+        def delete(self, client, name: str):
+            client.caches.delete(name=name)
+
+
+    class LocalContextCacheBackend:
+        """
+        جایگزین محلی برای تست آفلاین
+
+        چرخه ایجاد و انقضا را شبیه‌سازی می‌کند؛ درخواست‌ها بدون ارجاع به کش ارسال
+        می‌شوند ولی صرفه‌جویی توکن مانند حالت واقعی محاسبه می‌شود.
+        """
+
+        local = True
+
+        def __init__(self):
+            self.entries = {}
+
+        def create(self, client, model: str, system_instruction: str, text: str, ttl_seconds: int) -> dict:
+            name = f"local/{hashlib.sha256(f'{model}:{text}:{time.time()}'.encode('utf-8')).hexdigest()[:16]}"
+            token_count = int(len(system_instruction + text) / FileCostEstimator.CHARS_PER_TOKEN)
+            self.entries[name] = token_count
+            return {'name': name, 'token_count': token_count}
+
+        def delete(self, client, name: str):
+            self.entries.pop(name, None)
+
+
+    class ContextCacheManager:
+        """
+        مدیریت cached contentها برای هر API key
+
+        کش هر کلید یک بار برای هر TTL ساخته می‌شود و پیش از انقضا به طور خودکار
+        بازسازی می‌شود. در صورت خطا، درخواست‌ها بدون کش ادامه می‌یابند.
+        """
+
+        REFRESH_MARGIN_SECONDS = 120     # بازسازی کش کمی قبل از انقضا
+        FAILURE_COOLDOWN_SECONDS = 600   # پس از خطای ساخت، تا این مدت بدون کش
+
+        def __init__(self, backend, ttl_seconds: int = 3600):
+            self.backend = backend
+            self.ttl_seconds = ttl_seconds
+            self.entries = {}        # (api_key, spec hash) -> entry
+            self.failures = {}       # (api_key, spec hash) -> زمان خطا
+            self.creating = {}       # (api_key, spec hash) -> Event ساختی که در جریان است
+            self.lock = threading.Lock()
+            self.stats = {'created': 0, 'requests': 0, 'cached_tokens': 0, 'prompt_tokens': 0}
+
+        @staticmethod
+        def spec_hash(model: str, system_instruction: str, text: str) -> str:
+            return hashlib.sha256(f"{model}\n{system_instruction}\n{text}".encode('utf-8')).hexdigest()
+
+        def get_or_create(self, client, api_key: str, model: str, system_instruction: str, text: str):
+            """
+            برگرداندن entry معتبر یا None (ارسال بدون کش)
+
+            ساخت کش یک درخواست شبکه است و بیرون از قفل انجام می‌شود؛ برای هر (کلید، spec) فقط
+            یک thread می‌سازد و بقیه منتظر نتیجه آن می‌مانند (یا تا انقضا از entry قبلی استفاده می‌کنند).
+            """
+            key = (api_key, self.spec_hash(model, system_instruction, text))
+            while True:
+                now = time.time()
+                with self.lock:
+                    entry = self.entries.get(key)
+                    if entry and entry['expires_at'] - now > self.REFRESH_MARGIN_SECONDS:
+                        return entry
+                    if now - self.failures.get(key, 0) < self.FAILURE_COOLDOWN_SECONDS:
+                        return None
+                    creating = self.creating.get(key)
+                    if creating is None:
+                        creating = self.creating[key] = threading.Event()
+                        break
+                    if entry and entry['expires_at'] > now:
+                        return entry
+                creating.wait()
+
+            try:
+                return self._create(client, api_key, key, entry, model, system_instruction, text)
+            finally:
+                with self.lock:
+                    del self.creating[key]
+                creating.set()
+
+        def _create(self, client, api_key: str, key: tuple, previous: dict, model: str,
+                    system_instruction: str, text: str):
+            now = time.time()
+            try:
+                created = self.backend.create(client, model, system_instruction, text, self.ttl_seconds)
+            except Exception as e:
+                logger.warning(f"Context cache creation failed for {api_key[:8]}...: {e}")
+                with self.lock:
+                    self.failures[key] = now
+                return None
+
+            entry = {
+                'key': key,
+                'name': created['name'],
+                'token_count': created['token_count'],
+                'expires_at': now + self.ttl_seconds,
+                'local': self.backend.local
+            }
+            with self.lock:
+                self.entries[key] = entry
+                self.stats['created'] += 1
+            logger.info(f"🧠 Context cache {entry['name']} created ({entry['token_count']} tokens)")
+            if previous:
+                try:
+                    self.backend.delete(client, previous['name'])
+                except Exception:
+                    pass
+            return entry
+
+        def invalidate(self, entry: dict):
+            """حذف entry پس از خطای سرور (مثلاً کش منقضی یا پیدا نشده)"""
+            with self.lock:
+                if self.entries.get(entry['key']) is entry:
+                    del self.entries[entry['key']]
+
+        def record_usage(self, entry: dict, usage_metadata):
+            """ثبت توکن‌هایی که از کش خوانده شدند"""
+            prompt_tokens = (getattr(usage_metadata, 'prompt_token_count', None) or 0) if usage_metadata else 0
+            if entry['local']:
+                cached_tokens = entry['token_count']
+            else:
+                cached_tokens = (getattr(usage_metadata, 'cached_content_token_count', None) or 0) if usage_metadata else 0
+            with self.lock:
+                self.stats['requests'] += 1
+                self.stats['cached_tokens'] += cached_tokens
+                self.stats['prompt_tokens'] += prompt_tokens
+
+        def snapshot(self) -> dict:
+            with self.lock:
+                return dict(self.stats)
+
+    @st.cache_resource
+    def get_context_cache_manager():
+        backend_name = os.getenv("GEMINI_CONTEXT_CACHE_BACKEND", "gemini")
+        backend = LocalContextCacheBackend() if backend_name == "local" else GeminiContextCacheBackend()
+        return ContextCacheManager(backend, ttl_seconds=int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600")))
+
+
+    # ============================================================================
+    # 🧭 برنامه‌ریزی batch (مشترک بین پردازش تعاملی و jobهای پس‌زمینه)
+    # ============================================================================
+
+    def find_duplicate_files(all_files) -> Dict[int, dict]:
+        """فایل‌های تکراری بارگذاری شده (در صورت فعال بودن گزینه حذف تکراری‌ها)"""
+        if not st.session_state.get('dedup', True) or len(all_files) < 2:
+            return {}
+        with st.spinner('👯 بررسی فایل‌های تکراری...'):
+            detector = DuplicateDetector(threshold=float(os.getenv("DEDUP_SIMILARITY_THRESHOLD", "0.9")))
+            return detector.find_duplicates(
+                [f['content'] if isinstance(f, dict) else f.getvalue() for f in all_files]
+            )
+
+
+    def uploaded_files_fingerprint(files) -> str:
+        """اثر انگشت مجموعه فایل‌های بارگذاری شده (نام و محتوا) برای تشخیص تغییر ورودی بین rerunها"""
+        digest = hashlib.sha256()
+        for f in files:
+            name = f['name'] if isinstance(f, dict) else f.name
+            content = f['content'] if isinstance(f, dict) else f.getvalue()
+            digest.update(name.encode('utf-8') + b'\0' + hashlib.sha256(content).digest())
+        return digest.hexdigest()
+
+
+    def expand_duplicate_results(results: list, names: List[str], duplicates: Dict[int, dict],
+                                 unique_indices: List[int]) -> list:
+        """بازگرداندن نتایج به ترتیب فایل‌های بارگذاری شده؛ فایل‌های تکراری نتیجه فایل اصلی را می‌گیرند"""
+        if not duplicates:
+            return results
+        expanded = [None] * len(names)
+        for position, index in enumerate(unique_indices):
+            expanded[index] = results[position]
+        for index, duplicate in duplicates.items():
+            primary = expanded[duplicate['of']]
+            if primary is not None:
+                expanded[index] = (names[index], copy.deepcopy(primary[1]))
+        return expanded
+
+
+    def plan_processing(uploaded_files) -> dict:
+        """
+        ساخت analyzer از تنظیمات sidebar، تخمین هزینه فایل‌ها و محاسبه تعداد workers بهینه
+        (و بودجه هر مدل در حالت دو مرحله‌ای)؛ مشترک بین پردازش تعاملی و jobهای پس‌زمینه
+        """
+        analyzer = FinancialAnalyzer(
+            cache=get_extraction_cache(),
+            page_targeting=st.session_state.get('page_targeting', True),
+            cost_estimator=get_cost_estimator(),
+            context_cache=get_context_cache_manager() if st.session_state.get('context_caching') else None,
+            section_parallel=st.session_state.get('section_parallel', False),
+            streaming=st.session_state.get('streaming', True),
+            hedging=HedgingPolicy(
+                percentile=st.session_state.get('hedge_percentile', 95),
+                budget_ratio=float(os.getenv("GEMINI_HEDGE_BUDGET", "0.1"))
+            ) if st.session_state.get('hedging') else None
+        )
+        if st.session_state.get('tiering'):
+            # سقف همزمانی هر مدل پس از محاسبه بودجه‌ها تنظیم می‌شود
+            analyzer.tiering = ModelTiering(
+                GEMINI_TRIAGE_MODEL, analyzer.model_name, concurrency={},
+                min_avg_logprob=float(os.getenv("GEMINI_TRIAGE_MIN_AVG_LOGPROB", "-0.5"))
+            )
+        requests_per_file = len(FinancialAnalyzer.SECTION_KEYS) if analyzer.section_parallel else 1
+        with st.spinner('🔍 تخمین هزینه فایل‌ها...'):
+            file_estimates = [
+                analyzer.estimate_cost(
+                    f['content'] if isinstance(f, dict) else f.getvalue(),
+                    f['name'] if isinstance(f, dict) else f.name
+                )
+                for f in uploaded_files
+            ]
+
         # 1️⃣ محاسبه تعداد workers بهینه
         limits_manager = APILimitsManager(   
             api_keys=st.session_state.api_keys,
             max_tokens_per_min=st.session_state.max_tokens_per_min,
             max_requests_per_min=st.session_state.max_requests_per_min,
-            max_requests_per_day=st.session_state.max_requests_per_day
+            max_requests_per_day=st.session_state.max_requests_per_day,
+            ledger=quota_ledger,
+            model=analyzer.model_name
         )
 
         optimization = limits_manager.calculate_optimal_workers(
-            num_files=len(uploaded_files)
+            num_files=len(uploaded_files),
+            file_sizes=[len(f['content']) if isinstance(f, dict) else f.size for f in uploaded_files],
+            file_estimates=file_estimates,
+            requests_per_file=requests_per_file,
+            dispatch_mode=st.session_state.get('dispatch_mode', 'longest')
         )
         
         optimal_workers = optimization['optimal_workers']
+
+        # 1️⃣-ب بودجه جداگانه هر مدل در حالت دو مرحله‌ای
+        tier_budget = None
+        if analyzer.tiering:
+            billable_files = len([e for e in file_estimates if e['total_tokens'] > 0])
+            tier_budget = limits_manager.calculate_tier_budgets(
+                num_files=billable_files,
+                avg_tokens_per_file=optimization['limits']['avg_tokens_per_file'] / requests_per_file,
+                tier_limits={
+                    GEMINI_TRIAGE_MODEL: {
+                        'rpm': st.session_state.triage_requests_per_min,
+                        'tpm': st.session_state.triage_tokens_per_min,
+                        'rpd': st.session_state.triage_requests_per_day,
+                        'share': 1.0
+                    },
+                    analyzer.model_name: {
+                        'rpm': st.session_state.max_requests_per_min,
+                        'tpm': st.session_state.max_tokens_per_min,
+                        'rpd': st.session_state.max_requests_per_day,
+                        'share': GEMINI_ESCALATION_RATE * requests_per_file
+                    }
+                },
+                escalation_rate=GEMINI_ESCALATION_RATE
+            )
+            analyzer.tiering.concurrency = {model: tier['workers'] for model, tier in tier_budget['tiers'].items()}
+            analyzer.tiering.limits_manager = limits_manager
+            optimal_workers = tier_budget['total_workers']
+            optimization['limits']['max_daily'] = tier_budget['max_daily']
+            optimization['limits']['daily_limit_ok'] = billable_files <= tier_budget['max_daily']
+
+        return {
+            'analyzer': analyzer,
+            'limits_manager': limits_manager,
+            'optimization': optimization,
+            'tier_budget': tier_budget,
+            'optimal_workers': optimal_workers,
+            'requests_per_file': requests_per_file,
+            'file_estimates': file_estimates
+        }
+
+
+    def batch_concurrency_limit(optimal_workers: int, total_files: int) -> int:
+        """
+        سقف همزمانی یک batch؛ کنترل‌کننده AIMD از optimal_workers شروع می‌کند و تا این سقف بالا می‌رود
+
+        connection pool و rate limiter برای کل فرایند یک بار تنظیم می‌شوند و به batch وابسته نیستند.
+        """
+        return max(optimal_workers, min(total_files, GEMINI_MAX_CONCURRENCY))
+
+
+    # ============================================================================
+    # 🔄 تابع اصلاح شده: پردازش با محاسبه خودکار workers
+    # ============================================================================
+
+    def process_files_concurrent_smart(uploaded_files, live_results_container=None):
+        """
+        ✅ پردازش همزمان با محاسبه خودکار تعداد workers بهینه
+        
+        ویژگی‌های جدید:
+        - محاسبه خودکار workers بر اساس محدودیت‌های API
+        - نمایش توضیحات کامل برای کاربر
+        - بهینه‌سازی منابع
+        - نمایش زودهنگام خلاصه هر فایل در live_results_container (حالت streaming)
+        - ارسال فقط یک درخواست برای فایل‌های تکراری و کپی نتیجه برای همه نام‌ها
+        """
+
+        # 0️⃣-الف حذف فایل‌های تکراری؛ فقط فایل‌های یکتا پردازش می‌شوند
+        all_files = uploaded_files
+        duplicates = find_duplicate_files(all_files)
+        unique_indices = [i for i in range(len(all_files)) if i not in duplicates]
+        uploaded_files = [all_files[i] for i in unique_indices]
+        
+        # 0️⃣ و 1️⃣ پیش‌پردازش، تخمین هزینه واقعی هر فایل و محاسبه تعداد workers بهینه
+        extraction_cache = get_extraction_cache()
+        cache_stats_start = extraction_cache.stats()
+        context_cache_start = get_context_cache_manager().snapshot() if st.session_state.get('context_caching') else None
+        plan = plan_processing(uploaded_files)
+        analyzer = plan['analyzer']
+        limits_manager = plan['limits_manager']
+        optimization = plan['optimization']
+        tier_budget = plan['tier_budget']
+        optimal_workers = plan['optimal_workers']
+        requests_per_file = plan['requests_per_file']
         
         # 2️⃣ نمایش اطلاعات برای کاربر
         st.markdown('<div class="modern-card">', unsafe_allow_html=True)
@@ -505,22 +1577,57 @@ if st.session_state.authentication_status:
         
 
         
+        st.caption(
+            f"🧮 توکن تخمینی این batch: {optimization['limits']['total_tokens']:,.0f} "
+            f"(میانگین {optimization['limits']['avg_tokens_per_file']:,.0f} برای هر فایل) | "
+            f"زمان تخمینی: {optimization['estimated_time_minutes']:.1f} دقیقه با {optimal_workers} درخواست همزمان"
+        )
+        makespan = optimization['makespan_seconds']
+        if st.session_state.get('dispatch_mode', 'longest') == 'longest' and makespan['upload'] > makespan['ordered'] * 1.05:
+            st.caption(
+                f"↕️ ارسال بزرگ‌ترین فایل‌ها در ابتدا: زمان کل تخمینی {makespan['ordered'] / 60:.1f} دقیقه به جای "
+                f"{makespan['upload'] / 60:.1f} دقیقه با ترتیب بارگذاری"
+            )
+        if tier_budget:
+            st.caption(" | ".join(
+                f"🪜 {model}: {tier['workers']} همزمان، ~{tier['expected_requests']} درخواست، "
+                f"ظرفیت روزانه {tier['daily_files']:,} فایل"
+                for model, tier in tier_budget['tiers'].items()
+            ))
+        if optimization['limits']['oversized_files']:
+            st.warning(
+                f"⚠️ {optimization['limits']['oversized_files']} فایل به تنهایی بیش از سقف توکن در دقیقه "
+                f"یک کلید ({st.session_state.max_tokens_per_min:,}) مصرف می‌کنند."
+            )
+
         st.markdown('</div>', unsafe_allow_html=True)
         st.markdown("<br>", unsafe_allow_html=True)
         
         # 3️⃣ بررسی محدودیت روزانه
         if not optimization['limits']['daily_limit_ok']:
-            st.error(
-                f"⚠️ تعداد فایل‌ها ({len(uploaded_files)}) بیشتر از محدودیت روزانه "
-                f"({optimization['limits']['max_daily']}) است. "
-                f"لطفاً تعداد فایل‌ها را کاهش دهید یا API key های بیشتری اضافه کنید."
-            )
+            show_daily_limit_error(len(uploaded_files), optimization)
             return None
         
         # 4️⃣ شروع پردازش با workers محاسبه شده
-        analyzer = FinancialAnalyzer()
         total_files = len(uploaded_files)
-        max_retry_attempts = 3
+        # همه تلاش‌ها (شامل تلاش‌های داخلی قبلی analyzer) از صف واحد AsyncExtractionEngine انجام می‌شوند
+        max_retry_attempts = 5
+
+        client_pool_start = client_pool.snapshot()
+        max_concurrency = batch_concurrency_limit(optimal_workers, total_files)
+        rate_limiter_start = rate_limiter.snapshot()
+
+        # 4️⃣-ب ثبت batch در دفتر پردازش؛ هر فایل به محض اتمام روی دیسک نوشته می‌شود تا پس از crash،
+        # redeploy یا قطع اسکریپت فقط فایل‌های ناتمام دوباره پردازش شوند
+        job_runner = get_background_job_runner()
+        journal = job_runner.store.create(all_files, duplicates, owner=st.session_state.get('username'), settings={
+            'mode': 'inline',
+            'model': analyzer.model_name,
+            'optimal_workers': optimal_workers,
+            'estimated_time_minutes': optimization['estimated_time_minutes']
+        })
+        st.session_state.inline_job_id = journal['id']
+        st.session_state.inline_job_inputs = uploaded_files_fingerprint(all_files)
         
         st.markdown('<div class="modern-card"><h3>در حال پردازش...</h3></div>', unsafe_allow_html=True)
         progress_bar = st.progress(0)
@@ -528,121 +1635,153 @@ if st.session_state.authentication_status:
         status_container = st.container()
         
         # Metrics
-        col1, col2, col3, col4 = st.columns(4)
+        col1, col2, col3, col4, col5 = st.columns(5)
         metric_success = col1.empty()
         metric_failed = col2.empty()
         metric_retrying = col3.empty()
         metric_total = col4.empty()
+        metric_cache = col5.empty()
+        concurrency_chart = st.empty()
+
+        def update_cache_metric():
+            stats = extraction_cache.stats()
+            batch_hits = stats['hits'] - cache_stats_start['hits']
+            batch_misses = stats['misses'] - cache_stats_start['misses']
+            metric_cache.metric("💾 کش (hit/miss)", f"{batch_hits}/{batch_misses}")
         
         results = [None] * total_files
         completed = 0
         failed_count = 0
         retry_count = 0
+        pending_retry = 0
         start_time = time.time()
-        files_to_retry = []
-        
-        # 5️⃣ پردازش اولیه با optimal_workers
-        with ThreadPoolExecutor(max_workers=optimal_workers) as executor:
-            future_to_index = {
-                executor.submit(process_single_file, analyzer, file, i, total_files, 1, max_retry_attempts): i
-                for i, file in enumerate(uploaded_files)
-            }
-            
-            for future in as_completed(future_to_index):
-                index, filename, result, error, needs_retry = future.result()
+
+        def update_metrics():
+            metric_success.metric("✅ موفق", len([r for r in results if r and 'error' not in r[1]]))
+            metric_failed.metric("❌ ناموفق", failed_count)
+            metric_retrying.metric("🔄 در انتظار تلاش مجدد", pending_retry)
+            metric_total.metric("📊 کل", total_files)
+            update_cache_metric()
+
+        def handle_result(outcome, attempt_num, retry_scheduled):
+            """ثبت نتیجه هر فایل و به‌روزرسانی UI (در thread اسکریپت Streamlit)"""
+            nonlocal completed, failed_count, retry_count, pending_retry
+            index, filename, result, error, needs_retry = outcome
+            first_round = attempt_num == 1
+            if first_round:
                 completed += 1
-                
-                if error:
-                    if needs_retry:
-                        files_to_retry.append((index, uploaded_files[index], filename, 2))
+            else:
+                pending_retry -= 1
+
+            if error:
+                if retry_scheduled:
+                    pending_retry += 1
+                    if first_round:
                         retry_count += 1
                         with status_container:
                             st.warning(f'🔄 **{filename}** نیاز به تلاش مجدد دارد ({completed}/{total_files})')
                     else:
-                        results[index] = (filename, {"error": f"خطا: {error}"})
-                        failed_count += 1
                         with status_container:
-                            st.error(f'❌ **{filename}**: خطای غیرقابل بازیابی')
+                            st.warning(f'🔄 **{filename}** - تلاش {attempt_num + 1}/{max_retry_attempts}')
+                elif first_round:
+                    results[index] = (filename, {"error": f"خطا: {error}"})
+                    failed_count += 1
+                    with status_container:
+                        st.error(f'❌ **{filename}**: خطای غیرقابل بازیابی')
                 else:
-                    results[index] = (filename, result)
+                    results[index] = (filename, {"error": f"خطا بعد از {attempt_num} تلاش: {error}"})
+                    failed_count += 1
                     with status_container:
+                        st.error(f'❌ **{filename}**: ناموفق بعد از {attempt_num} تلاش')
+            else:
+                results[index] = (filename, result)
+                with status_container:
+                    if first_round:
                         st.success(f'✅ **{filename}** ({completed}/{total_files})')
-                
+                    else:
+                        st.success(f'✅ **{filename}** موفق در تلاش {attempt_num}!')
+
+            update_metrics()
+            concurrency_chart.line_chart(engine.controller.history_frame().set_index('ثانیه'), height=180)
+            if first_round:
                 progress_bar.progress(completed / total_files)
-                
-                metric_success.metric("✅ موفق", len([r for r in results if r and 'error' not in r[1]]))
-                metric_failed.metric("❌ ناموفق", failed_count)
-                metric_retrying.metric("🔄 در انتظار تلاش مجدد", len(files_to_retry))
-                metric_total.metric("📊 کل", total_files)
-                
                 elapsed = time.time() - start_time
                 avg_time = elapsed / completed
-                remaining = (total_files - completed + len(files_to_retry)) * avg_time
+                remaining = (total_files - completed + pending_retry) * avg_time
+                limiter_wait = rate_limiter.snapshot()['wait_seconds'] - rate_limiter_start['wait_seconds']
                 status_placeholder.info(
                     f'📊 پردازش اولیه: {completed}/{total_files} | '
-                    f'⏱️ زمان: {elapsed:.1f}s | ⏳ تخمین: {remaining:.1f}s'
+                    f'⏱️ زمان: {elapsed:.1f}s | ⏳ تخمین: {remaining:.1f}s | '
+                    f'🚦 انتظار محدودکننده نرخ: {limiter_wait:.1f}s'
                 )
-        
-        # 6️⃣ مرحله Retry (اگر نیاز باشد)
-        if files_to_retry:
-            st.markdown("---")
-            st.markdown("### 🔄 تلاش مجدد برای فایل‌های ناموفق...")
-            
-            retry_attempt = 1
-            # در retry از نصف workers استفاده می‌کنیم
-            retry_workers = max(1, optimal_workers // 2)
-            
-            while files_to_retry and retry_attempt <= max_retry_attempts:
-                st.info(f"🔄 دور {retry_attempt} از تلاش مجدد ({len(files_to_retry)} فایل) با {retry_workers} worker")
-                
-                delay = min(5 * retry_attempt, 15)
-                with st.spinner(f'⏳ صبر {delay} ثانیه قبل از تلاش مجدد...'):
-                    time.sleep(delay)
-                
-                current_retry_list = files_to_retry.copy()
-                files_to_retry = []
-                
-                with ThreadPoolExecutor(max_workers=retry_workers) as executor:
-                    future_to_data = {
-                        executor.submit(
-                            process_single_file, 
-                            analyzer, 
-                            file_data, 
-                            idx, 
-                            total_files, 
-                            attempt_num,
-                            max_retry_attempts
-                        ): (idx, fname, attempt_num)
-                        for idx, file_data, fname, attempt_num in current_retry_list
-                    }
-                    
-                    for future in as_completed(future_to_data):
-                        idx, fname, attempt_num = future_to_data[future]
-                        index, filename, result, error, needs_retry = future.result()
-                        
-                        if error:
-                            if needs_retry and attempt_num < max_retry_attempts:
-                                files_to_retry.append((index, uploaded_files[index], filename, attempt_num + 1))
-                                with status_container:
-                                    st.warning(f'🔄 **{filename}** - تلاش {attempt_num + 1}/{max_retry_attempts}')
-                            else:
-                                results[index] = (filename, {"error": f"خطا بعد از {attempt_num} تلاش: {error}"})
-                                failed_count += 1
-                                with status_container:
-                                    st.error(f'❌ **{filename}**: ناموفق بعد از {attempt_num} تلاش')
-                        else:
-                            results[index] = (filename, result)
-                            with status_container:
-                                st.success(f'✅ **{filename}** موفق در تلاش {attempt_num}!')
-                            failed_count = max(0, failed_count - 1)
-                        
-                        successful = len([r for r in results if r and 'error' not in r[1]])
-                        metric_success.metric("✅ موفق", successful)
-                        metric_failed.metric("❌ ناموفق", failed_count)
-                        metric_retrying.metric("🔄 در انتظار تلاش مجدد", len(files_to_retry))
-                
-                retry_attempt += 1
-        
+
+        def handle_retry(filename, next_attempt, delay):
+            """فایل ناموفق با backoff خودش به صف برگشته و بقیه فایل‌ها منتظر آن نمی‌مانند"""
+            with status_container:
+                st.caption(f"⏳ **{filename}**: تلاش {next_attempt}/{max_retry_attempts} پس از {delay:.0f} ثانیه")
+
+        first_insight_seconds = None
+        partial_shown = set()
+
+        def handle_partial(filename, key, value):
+            """نمایش زودهنگام بخش خلاصه قبل از اتمام کل پاسخ"""
+            nonlocal first_insight_seconds
+            if filename in partial_shown:
+                return   # درخواست اصلی و hedge هر دو ممکن است خلاصه را گزارش کنند
+            partial_shown.add(filename)
+            if first_insight_seconds is None:
+                first_insight_seconds = time.time() - start_time
+            if live_results_container is not None:
+                with live_results_container:
+                    render_summary_card(filename, value, pending=True)
+            with status_container:
+                st.info(
+                    f"📡 **{filename}**: {value.get('نام_شرکت', 'N/A')} | "
+                    f"{value.get('نوع_اظهارنظر', 'N/A')} | ریسک {value.get('سطح_ریسک_کلی_بنا_به_گزارش', 'N/A')}"
+                )
+
+        # 5️⃣ و 6️⃣ پردازش و تلاش‌های مجدد در یک صف واحد روی event loop دائمی
+        # رویدادهای موتور از thread مربوط به loop در صف قرار می‌گیرند و اینجا نمایش داده می‌شوند
+        fair_scheduler = get_fair_scheduler()
+        engine = AsyncExtractionEngine(analyzer, max_concurrency=optimal_workers, max_attempts=max_retry_attempts,
+                                       max_limit=max_concurrency, scheduler=fair_scheduler,
+                                       user=st.session_state.get('username'),
+                                       express=fair_scheduler.is_express(total_files))
+        ui_events = queue.Queue()
+        analyzer.on_partial = lambda *args: ui_events.put((handle_partial, args))
+        if live_results_container is not None:
+            with live_results_container:
+                st.subheader("📡 خلاصه‌های آماده شده (در حال پردازش)")
+        def journal_result(outcome, attempt, retry_scheduled):
+            # ثبت در thread دفتر (نه روی loop)؛ rerun یا بستن مرورگر ثبت نتایج باقی‌مانده را متوقف نمی‌کند
+            job_runner.store.defer(job_runner.store.record_outcome, journal['id'], outcome[0], outcome, attempt,
+                                   retry_scheduled)
+            ui_events.put((handle_result, (outcome, attempt, retry_scheduled)))
+
+        future = get_event_loop_runner().submit(engine.run(
+            uploaded_files,
+            journal_result,
+            lambda *args: ui_events.put((handle_retry, args)),
+            order=optimization['dispatch_order']
+        ))
+        job_runner.track(journal['id'], future, engine)
+        status_placeholder.caption(
+            f"🗂️ شناسه دفتر پردازش: `{journal['id']}` | در صورت قطع پردازش، از بخش «کارهای پردازش من» "
+            "فقط فایل‌های ناتمام دوباره ارسال می‌شوند"
+        )
+        last_refresh = time.time()
+        while not (future.done() and ui_events.empty()):
+            try:
+                handler, args = ui_events.get(timeout=0.2)
+            except queue.Empty:
+                # به‌روزرسانی دوره‌ای صفحه؛ Streamlit درخواست rerun (مثلاً دکمه توقف) را فقط در فراخوانی‌های st اعمال می‌کند
+                if time.time() - last_refresh > 2:
+                    update_metrics()
+                    last_refresh = time.time()
+                continue
+            handler(*args)
+        future.result()
+
         # 7️⃣ گزارش نهایی
         total_duration = time.time() - start_time
         successful = len([r for r in results if r and 'error' not in r[1]])
@@ -662,6 +1801,116 @@ if st.session_state.authentication_status:
         
         if retry_count > 0:
             st.info(f'ℹ️ تعداد فایل‌هایی که نیاز به تلاش مجدد داشتند: {retry_count}')
+
+        if duplicates:
+            names = [f['name'] if isinstance(f, dict) else f.name for f in all_files]
+            similar_count = len([d for d in duplicates.values() if d['kind'] == 'similar'])
+            st.info(
+                f'👯 {len(duplicates)} فایل تکراری شناسایی شد ({len(duplicates) - similar_count} کاملاً یکسان، '
+                f'{similar_count} با متن مشابه) و بدون درخواست جدید نتیجه فایل اصلی برای آن‌ها ثبت شد'
+            )
+            with st.expander("👯 فهرست فایل‌های تکراری", expanded=False):
+                for index, duplicate in sorted(duplicates.items()):
+                    kind = 'یکسان' if duplicate['kind'] == 'exact' else f"شباهت {duplicate['similarity']:.0%}"
+                    st.markdown(f"- **{names[index]}** ← {names[duplicate['of']]} ({kind})")
+
+        controller_stats = engine.controller.stats
+        st.info(
+            f"🎚️ کنترل همزمانی: شروع با {optimal_workers}، اوج {controller_stats['peak']:.1f} و پایان با "
+            f"{engine.controller.limit:.1f} فایل همزمان (سقف {max_concurrency}) | "
+            f"کاهش به دلیل 429/503: {controller_stats['overload_cuts']}، به دلیل جهش تأخیر: "
+            f"{controller_stats['latency_cuts']}"
+        )
+
+        if first_insight_seconds is not None:
+            st.info(f'📡 اولین خلاصه پس از {first_insight_seconds:.1f} ثانیه نمایش داده شد')
+
+        if analyzer.hedging:
+            hedge_report = analyzer.hedging.report()
+            with_h, without_h = hedge_report['with_hedging'], hedge_report['without_hedging']
+            # بدون نمونه کندتر از زمان لغو، تخمین فقط یک حد پایین است
+            estimated = '≥' if hedge_report['lower_bound'] else '≈' if hedge_report['estimated'] else ''
+            budget_note = (f"، {hedge_report['budget_denied']} مورد به دلیل اتمام بودجه ارسال نشد"
+                           if hedge_report['budget_denied'] else "")
+            st.info(
+                f"⚡ Hedging: {hedge_report['hedges']} درخواست پشتیبان از {hedge_report['requests']} درخواست "
+                f"({hedge_report['hedge_wins']} مورد سریع‌تر بود{budget_note}) | "
+                f"تأخیر با hedging: p50 {with_h['p50']:.1f}s، p95 {with_h['p95']:.1f}s، p99 {with_h['p99']:.1f}s | "
+                f"بدون hedging: p50 {estimated}{without_h['p50']:.1f}s، p95 {estimated}{without_h['p95']:.1f}s، "
+                f"p99 {estimated}{without_h['p99']:.1f}s"
+            )
+
+        if analyzer.tiering:
+            tier_report = analyzer.tiering.report()
+            reasons = "، ".join(
+                f"{ModelTiering.ESCALATION_REASONS.get(reason, reason)}: {count}"
+                for reason, count in tier_report['reasons'].items()
+            )
+            usage = " | ".join(
+                f"{model}: {item['requests']} درخواست، {item['tokens']:,} توکن"
+                for model, item in limits_manager.tier_usage_report().items()
+            )
+            st.info(
+                f"🪜 {tier_report['accepted']} از {tier_report['triaged']} فایل با {GEMINI_TRIAGE_MODEL} نهایی شد و "
+                f"{tier_report['escalated']} فایل به {analyzer.model_name} ارجاع شد"
+                f"{f' ({reasons})' if reasons else ''}"
+                f"{f' | {usage}' if usage else ''}"
+            )
+
+        if analyzer.repair_stats['files']:
+            st.info(
+                f"🩹 {analyzer.repair_stats['files']} فایل با پاسخ ناقص یا نامعتبر فقط با "
+                f"{analyzer.repair_stats['requests']} درخواست بخشی ترمیم شد (بدون تکرار کل فایل)"
+            )
+
+        preflight = [info for _, info in analyzer.preflight_results.values() if info.get('total_pages')]
+        trimmed = [info for info in preflight if info['trimmed']]
+        if trimmed:
+            total_pages = sum(info['total_pages'] for info in preflight)
+            sent_pages = sum(info['sent_pages'] for info in preflight)
+            st.info(
+                f'🎯 در {len(trimmed)} از {len(preflight)} فایل فقط صفحات گزارش حسابرس ارسال شد | '
+                f'صفحات ارسالی: {sent_pages} از {total_pages} ({sent_pages / total_pages:.0%})'
+            )
+
+        if analyzer.context_cache:
+            context_cache_end = analyzer.context_cache.snapshot()
+            cached_tokens = context_cache_end['cached_tokens'] - context_cache_start['cached_tokens']
+            prompt_tokens = context_cache_end['prompt_tokens'] - context_cache_start['prompt_tokens']
+            created = context_cache_end['created'] - context_cache_start['created']
+            if cached_tokens > 0:
+                st.info(
+                    f'🧠 Context caching: {cached_tokens:,} توکن ورودی از کش خوانده شد '
+                    f'({cached_tokens / max(1, prompt_tokens):.0%} از {prompt_tokens:,} توکن ورودی) | '
+                    f'کش‌های ساخته شده در این batch: {created}'
+                )
+
+        rate_limiter_end = rate_limiter.snapshot()
+        limiter_waits = rate_limiter_end['waited'] - rate_limiter_start['waited']
+        if limiter_waits > 0:
+            st.info(
+                f"🚦 {limiter_waits} از {rate_limiter_end['acquired'] - rate_limiter_start['acquired']} درخواست "
+                f"برای رعایت محدودیت RPM/TPM منتظر ماندند | مجموع انتظار: "
+                f"{rate_limiter_end['wait_seconds'] - rate_limiter_start['wait_seconds']:.1f}s "
+                f"(بیشترین: {rate_limiter_end['max_wait_seconds']:.1f}s)"
+            )
+
+        pool_savings = client_pool.estimated_savings(client_pool_start)
+        if pool_savings['reused'] > 0:
+            st.info(
+                f'🔌 استفاده مجدد از اتصال‌ها: {pool_savings["reused"]} درخواست بدون ساخت کلاینت جدید '
+                f'({pool_savings["created"]} کلاینت جدید) | '
+                f'زمان صرفه‌جویی شده در برقراری اتصال: ~{pool_savings["saved_seconds"]:.1f} ثانیه '
+                f'(~{pool_savings["per_connection_seconds"] * 1000:.0f}ms برای هر اتصال)'
+            )
+
+        cache_stats_end = extraction_cache.stats()
+        cache_hits = cache_stats_end['hits'] - cache_stats_start['hits']
+        if cache_hits > 0:
+            st.info(
+                f'💾 {cache_hits} فایل از کش بازیابی شد (بدون مصرف سهمیه API) | '
+                f'حجم کش: {cache_stats_end["size_mb"]:.1f} MB در {cache_stats_end["entries"]} رکورد'
+            )
         
         # نمایش مقایسه با زمان تخمینی
         estimated_time = optimization['estimated_time_minutes'] * 60
@@ -669,6 +1918,11 @@ if st.session_state.authentication_status:
             st.success(f"✅ زمان پردازش مطابق تخمین بود!")
         elif total_duration < estimated_time:
             st.success(f"🚀 پردازش {(estimated_time - total_duration):.0f} ثانیه سریع‌تر از تخمین بود!")
+
+        # 8️⃣ بازگرداندن نتایج به ترتیب فایل‌های بارگذاری شده؛ فایل‌های تکراری نتیجه فایل اصلی را می‌گیرند
+        results = expand_duplicate_results(
+            results, [f['name'] if isinstance(f, dict) else f.name for f in all_files], duplicates, unique_indices
+        )
         
         return results
     
@@ -679,44 +1933,706 @@ if st.session_state.authentication_status:
     # ========================================================================
 
     class APIKeyManager:
+        """
+        انتخاب کلید با وزن سلامت و circuit breaker جداگانه برای هر کلید
+
+        وزن هر کلید از نرخ موفقیت اخیر، تأخیر نسبت به بقیه کلیدها و سهمیه باقی‌مانده امروز
+        محاسبه می‌شود. هر کلید یک breaker سه حالته دارد:
+        - closed: ترافیک عادی
+        - open: بدون ترافیک تا پایان cool-down (پس از چند خطای پشت سر هم، نرخ موفقیت پایین
+          یا خطای احراز هویت)
+        - half_open: پس از cool-down فقط یک درخواست آزمایشی؛ موفقیت آن breaker را می‌بندد و
+          شکست آن را با cool-down دو برابر دوباره باز می‌کند
+        """
+
+        CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+        SMOOTHING = 0.2
+        MIN_SUCCESS_RATE = 0.5          # زیر این نرخ موفقیت (پس از حداقل نمونه) breaker باز می‌شود
+        MIN_SAMPLES = 5
+        BASE_COOLDOWN = 30.0            # ثانیه
+        MAX_COOLDOWN = 600.0
+        AUTH_COOLDOWN = 3600.0          # کلید نامعتبر یا غیرفعال
+        PROBE_TIMEOUT = 120.0           # درخواست آزمایشی بدون نتیجه (مثلاً لغو شده) پس از این مدت تکرار می‌شود
+        AUTH_PATTERNS = ['401', '403', 'api key not valid', 'api_key_invalid', 'permission_denied', 'permission denied']
+
         def __init__(self, api_keys: List[str]):
             if not api_keys:
                 raise ValueError("API keys list cannot be empty.")
             self.api_keys = api_keys
-            self.current_index = 0
-            self.failures = {key: 0 for key in api_keys}
             self.max_failures = 3
             self.lock = threading.Lock()  # ✅ اضافه شده برای thread-safety
-            
-        def get_next_key(self) -> str:
+            self.health = {key: self._new_health() for key in api_keys}
+            # مصرف هر session: session_id -> {'user', 'requests', 'tokens', 'failures', 'last_seen'}
+            self.sessions = {}
+
+        @staticmethod
+        def _new_health() -> dict:
+            return {'state': APIKeyManager.CLOSED, 'success_rate': 1.0, 'latency': None, 'samples': 0,
+                    'consecutive_failures': 0, 'cooldown': 0.0, 'open_until': 0.0, 'probe_in_flight': False,
+                    'probe_started': 0.0, 'successes': 0, 'failures': 0, 'last_error': ''}
+
+        def _weight(self, health: dict, median_latency: float, remaining: float) -> float:
+            latency_factor = median_latency / health['latency'] if health['latency'] and median_latency else 1.0
+            return max(0.01, health['success_rate'] ** 2 * min(2.0, latency_factor) * remaining)
+
+        def get_next_key(self, exclude: Set[str] = None, remaining: Dict[str, float] = None) -> str:
+            """
+            Args:
+                exclude: کلیدهایی که در صورت امکان انتخاب نشوند (مثلاً کلید درخواست اصلی برای hedge)
+                remaining: نسبت سهمیه باقی‌مانده امروز هر کلید (۰ تا ۱)؛ کلیدهای با سهمیه صفر انتخاب نمی‌شوند
+            """
+            now = time.monotonic()
             with self.lock:  # ✅ محافظت از race condition
-                attempts = 0
-                while attempts < len(self.api_keys):
-                    key = self.api_keys[self.current_index]
-                    self.current_index = (self.current_index + 1) % len(self.api_keys)
-                    if self.failures.get(key, 0) < self.max_failures:
-                        return key
-                    attempts += 1
-                logger.warning("All API keys have failed, resetting failure counters")
-                self.failures = {key: 0 for key in self.api_keys}
-                return self.api_keys[0]
-        
-        def mark_failure(self, key: str):
+                available = []
+                for key in self.api_keys:
+                    health = self.health[key]
+                    if health['state'] == self.OPEN and now >= health['open_until']:
+                        health['state'] = self.HALF_OPEN
+                        logger.info(f"API key {key[:8]}... half-open, sending probe request")
+                    if health['state'] == self.OPEN:
+                        continue
+                    if health['state'] == self.HALF_OPEN and health['probe_in_flight'] \
+                            and now - health['probe_started'] < self.PROBE_TIMEOUT:
+                        continue
+                    available.append(key)
+
+                candidates = [
+                    key for key in available
+                    if key not in (exclude or ()) and (remaining is None or remaining.get(key, 1.0) > 0)
+                ] or [key for key in available if remaining is None or remaining.get(key, 1.0) > 0] or available
+                if not candidates:
+                    # همه breakerها باز هستند؛ کلیدی که زودتر از cool-down خارج می‌شود
+                    key = min(self.api_keys, key=lambda k: self.health[k]['open_until'])
+                    logger.warning(f"All API key circuits are open, using {key[:8]}... before its cool-down ends")
+                    return key
+
+                latencies = sorted(self.health[key]['latency'] for key in candidates if self.health[key]['latency'])
+                median_latency = latencies[len(latencies) // 2] if latencies else None
+                weights = [
+                    self._weight(self.health[key], median_latency, (remaining or {}).get(key, 1.0))
+                    for key in candidates
+                ]
+                key = random.choices(candidates, weights=weights)[0]
+                if self.health[key]['state'] == self.HALF_OPEN:
+                    self.health[key]['probe_in_flight'] = True
+                    self.health[key]['probe_started'] = now
+                return key
+
+        def _open(self, key: str, health: dict, cooldown: float, reason: str):
+            health['state'] = self.OPEN
+            health['cooldown'] = cooldown
+            health['open_until'] = time.monotonic() + cooldown
+            health['probe_in_flight'] = False
+            logger.warning(f"API key circuit opened for {key[:8]}... ({reason}, cool-down {cooldown:.0f}s)")
+
+        def mark_failure(self, key: str, error: BaseException = None):
             with self.lock:
-                if key in self.failures:
-                    self.failures[key] += 1
-                    logger.warning(f"API key failure count for {key[:8]}...: {self.failures[key]}")
-        
-        def mark_success(self, key: str):
+                health = self.health.get(key)
+                if health is None:
+                    return
+                health['failures'] += 1
+                health['consecutive_failures'] += 1
+                health['samples'] += 1
+                health['success_rate'] = (1 - self.SMOOTHING) * health['success_rate']
+                health['last_error'] = str(error or '')[:200]
+                logger.warning(f"API key failure count for {key[:8]}...: {health['consecutive_failures']}")
+
+                message = health['last_error'].lower()
+                hint = retry_after_seconds(error) if error is not None else None
+                if health['state'] == self.OPEN:
+                    return   # درخواست‌هایی که پیش از باز شدن breaker ارسال شده بودند
+                if any(pattern in message for pattern in self.AUTH_PATTERNS):
+                    self._open(key, health, self.AUTH_COOLDOWN, 'authentication')
+                elif health['state'] == self.HALF_OPEN:
+                    self._open(key, health, min(self.MAX_COOLDOWN, max(hint or 0, health['cooldown'] * 2)),
+                               'probe failed')
+                elif health['consecutive_failures'] >= self.max_failures or (
+                        health['samples'] >= self.MIN_SAMPLES and health['success_rate'] < self.MIN_SUCCESS_RATE):
+                    self._open(key, health, min(self.MAX_COOLDOWN, max(hint or 0, self.BASE_COOLDOWN)),
+                               'repeated failures')
+
+        def mark_success(self, key: str, latency: float = None):
+            with self.lock:
+                health = self.health.get(key)
+                if health is None:
+                    return
+                if health['state'] != self.CLOSED:
+                    logger.info(f"API key circuit closed for {key[:8]}...")
+                health['state'] = self.CLOSED
+                health['probe_in_flight'] = False
+                health['consecutive_failures'] = 0
+                health['successes'] += 1
+                health['samples'] += 1
+                health['success_rate'] = (1 - self.SMOOTHING) * health['success_rate'] + self.SMOOTHING
+                if latency:
+                    health['latency'] = latency if health['latency'] is None else \
+                        (1 - self.SMOOTHING) * health['latency'] + self.SMOOTHING * latency
+
+        def record_usage(self, session: Tuple[str, str], tokens: int = 0, failed: bool = False):
+            """نسبت دادن یک فراخوانی به session درخواست‌دهنده"""
+            if not session:
+                return
+            session_id, user = session
+            with self.lock:
+                usage = self.sessions.setdefault(
+                    session_id, {'user': user, 'requests': 0, 'tokens': 0, 'failures': 0, 'last_seen': 0.0}
+                )
+                usage['requests'] += 1
+                usage['tokens'] += tokens or 0
+                usage['failures'] += int(failed)
+                usage['last_seen'] = time.time()
+
+        def session_report(self) -> List[dict]:
+            with self.lock:
+                return sorted(
+                    ({'session_id': session_id, **usage} for session_id, usage in self.sessions.items()),
+                    key=lambda item: item['last_seen'], reverse=True
+                )
+
+        def health_report(self) -> List[dict]:
+            """وضعیت هر کلید برای نمایش به اپراتور (بدون خود کلید)"""
+            now = time.monotonic()
+            with self.lock:
+                return [{
+                    'key': f"…{key[-4:]}",
+                    'key_id': api_key_id(key),
+                    'state': health['state'],
+                    'success_rate': health['success_rate'],
+                    'latency': health['latency'],
+                    'successes': health['successes'],
+                    'failures': health['failures'],
+                    'cooldown_left': max(0.0, health['open_until'] - now) if health['state'] == self.OPEN else 0.0,
+                    'last_error': health['last_error']
+                } for key, health in self.health.items()]
+
+    def current_session() -> Tuple[str, str]:
+        """(شناسه session، نام کاربری) برای نسبت دادن مصرف کلیدها به هر تحلیلگر"""
+        ctx = get_script_run_ctx()
+        return (ctx.session_id if ctx else 'local'), (st.session_state.get('username') or '-')
+
+    @st.cache_resource
+    def get_api_key_manager(api_keys: Tuple[str, ...]) -> APIKeyManager:
+        """
+        یک APIKeyManager برای هر مجموعه کلید در کل فرایند
+
+        همه sessionها (و همه rerunها) همان وضعیت سلامت و breaker کلیدها را می‌بینند؛
+        مجموعه کلید متفاوت (مثلاً کلیدهای وارد شده توسط کاربر) نمونه جداگانه می‌گیرد.
+        """
+        return APIKeyManager(list(api_keys))
+
+    api_key_manager = get_api_key_manager(tuple(sorted(set(st.session_state.api_keys))))
+
+    # مدل سبک مرحله اول و نرخ تخمینی ارجاع به مدل اصلی در حالت دو مرحله‌ای
+    GEMINI_TRIAGE_MODEL = os.getenv("GEMINI_TRIAGE_MODEL", "gemini-2.5-flash-lite")
+    GEMINI_ESCALATION_RATE = float(os.getenv("GEMINI_ESCALATION_RATE", "0.3"))
+
+    # آدرس جایگزین API (مثلاً سرور جعلی tools/fake_gemini_server.py برای بنچمارک)
+    GEMINI_API_BASE_URL = os.getenv("GEMINI_API_BASE_URL")
+    # فعال‌سازی HTTP/2 (نیازمند نصب بسته h2)
+    GEMINI_HTTP2 = os.getenv("GEMINI_HTTP2", "0") == "1"
+    # سقف سراسری فایل‌های همزمان؛ اندازه connection pool هر کلید هم به همین اندازه ثابت است
+    GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "50"))
+
+
+    class EventLoopRunner:
+        """
+        یک event loop دائمی در thread جداگانه
+
+        اتصال‌های keep-alive کلاینت async به event loop سازنده خود وابسته‌اند؛
+        با اجرای همه batchها روی همین loop، اتصال‌ها بین rerunها زنده می‌مانند.
+        """
+
+        def __init__(self):
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name="gemini-event-loop", daemon=True)
+            self.thread.start()
+
+        def submit(self, coro):
+            """اجرای coroutine روی loop و برگرداندن concurrent.futures.Future"""
+            return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    @st.cache_resource
+    def get_event_loop_runner():
+        return EventLoopRunner()
+
+
+    class GeminiClientPool:
+        """
+        نگهداری یک genai.Client با عمر طولانی برای هر API key
+
+        به جای ساخت کلاینت جدید (و handshake جدید TLS) در هر تلاش، کلاینت هر key
+        یک بار ساخته می‌شود و connection pool آن بین درخواست‌ها و rerunها حفظ می‌شود.
+        اندازه pool هنگام ساخت ثابت می‌شود؛ کلاینت‌ها هرگز جایگزین نمی‌شوند، چون کلاینت
+        قدیمی ممکن است هنوز درخواست در حال اجرا داشته باشد. اتصال‌ها فقط در صورت نیاز باز می‌شوند،
+        پس سقف بزرگ هزینه‌ای ندارد.
+        """
+
+        def __init__(self, base_url: str = None, http2: bool = False, pool_size: int = 10):
+            self.base_url = base_url
+            self.http2 = http2 and importlib.util.find_spec('h2') is not None
+            self.pool_size = max(1, pool_size)
+            self.clients = {}
+            self.lock = threading.Lock()
+            # آمار برای تخمین زمان صرفه‌جویی شده در برقراری اتصال
+            self.stats = {
+                'created': 0,
+                'reused': 0,
+                'setup_seconds': 0.0,
+                'cold_calls': 0,
+                'cold_seconds': 0.0,
+                'warm_calls': 0,
+                'warm_seconds': 0.0
+            }
+            self.warm_keys = set()
+
+        def _http_options(self):
+            limits = httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.pool_size,
+                keepalive_expiry=300
+            )
+            client_args = {'limits': limits, 'http2': self.http2}
+            try:
+                return types.HttpOptions(
+                    base_url=self.base_url,
+                    client_args=client_args,
+                    async_client_args=client_args
+                )
+            except Exception:
+                # نسخه‌های قدیمی google-genai از client_args پشتیبانی نمی‌کنند
+                return types.HttpOptions(base_url=self.base_url) if self.base_url else None
+
+        def get(self, api_key: str):
+            with self.lock:
+                client = self.clients.get(api_key)
+                if client is not None:
+                    self.stats['reused'] += 1
+                    return client
+
+                start = time.perf_counter()
+                client = genai.Client(api_key=api_key, http_options=self._http_options())
+                self.stats['setup_seconds'] += time.perf_counter() - start
+                self.stats['created'] += 1
+                self.clients[api_key] = client
+                self.warm_keys.discard(api_key)
+                logger.info(f"Created pooled client for {api_key[:8]}... (pool size {self.pool_size}, http2={self.http2})")
+                return client
+
+        def record_call(self, api_key: str, seconds: float):
+            """ثبت زمان یک فراخوانی؛ اولین فراخوانی هر کلاینت شامل برقراری اتصال است"""
+            with self.lock:
+                if api_key in self.warm_keys:
+                    self.stats['warm_calls'] += 1
+                    self.stats['warm_seconds'] += seconds
+                else:
+                    self.warm_keys.add(api_key)
+                    self.stats['cold_calls'] += 1
+                    self.stats['cold_seconds'] += seconds
+
+        def snapshot(self) -> dict:
+            with self.lock:
+                return dict(self.stats)
+
+        def estimated_savings(self, start: dict) -> dict:
+            """
+            تخمین زمان صرفه‌جویی شده از زمان snapshot
+
+            هزینه هر اتصال سرد = زمان ساخت کلاینت + (میانگین فراخوانی سرد - میانگین فراخوانی گرم)
+            """
+            end = self.snapshot()
+            reused = end['reused'] - start['reused']
+            created = end['created'] - start['created']
+            avg_setup = end['setup_seconds'] / end['created'] if end['created'] else 0.0
+            avg_cold = end['cold_seconds'] / end['cold_calls'] if end['cold_calls'] else 0.0
+            avg_warm = end['warm_seconds'] / end['warm_calls'] if end['warm_calls'] else avg_cold
+            per_connection = avg_setup + max(0.0, avg_cold - avg_warm)
+            return {
+                'reused': reused,
+                'created': created,
+                'per_connection_seconds': per_connection,
+                'saved_seconds': reused * per_connection
+            }
+
+    @st.cache_resource
+    def get_client_pool():
+        return GeminiClientPool(base_url=GEMINI_API_BASE_URL, http2=GEMINI_HTTP2,
+                                pool_size=int(os.getenv("GEMINI_POOL_SIZE", str(GEMINI_MAX_CONCURRENCY))))
+
+    client_pool = get_client_pool()
+
+
+    # ============================================================================
+    # 📒 دفتر مصرف روزانه سهمیه API (مشترک بین sessionها و ماندگار پس از restart)
+    # ============================================================================
+
+    def api_key_id(api_key: str) -> str:
+        """شناسه کلید برای ذخیره روی دیسک؛ خود کلید هرگز ذخیره نمی‌شود"""
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]
+
+
+    class QuotaLedger:
+        """
+        ثبت تعداد درخواست و توکن مصرفی هر کلید و مدل در هر روز سهمیه در SQLite
+
+        همه کاربران از همان DEFAULT_API_KEYS استفاده می‌کنند؛ بنابراین ظرفیت باقی‌مانده
+        روزانه فقط از این دفتر مشترک قابل محاسبه است. روز سهمیه مطابق Gemini در نیمه‌شب
+        به وقت اقیانوس آرام (GEMINI_QUOTA_TIMEZONE) عوض می‌شود و افزایش شمارنده‌ها
+        به صورت اتمی در یک تراکنش انجام می‌شود.
+        """
+
+        def __init__(self, db_dir: str, timezone_name: str = "America/Los_Angeles", keep_days: int = 30):
+            os.makedirs(db_dir, exist_ok=True)
+            self.db_path = os.path.join(db_dir, 'quota_ledger.sqlite3')
+            try:
+                self.timezone = ZoneInfo(timezone_name)
+            except Exception:
+                # بدون پایگاه داده tzdata (مثلاً ویندوز)، ساعت استاندارد اقیانوس آرام
+                logger.warning(f"Timezone {timezone_name} not available, using UTC-8")
+                self.timezone = dt_timezone(timedelta(hours=-8))
+            self.keep_days = keep_days
+
+            with self._connect() as conn:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS quota_usage (
+                        key_id TEXT NOT NULL,
+                        model TEXT NOT NULL,
+                        day TEXT NOT NULL,
+                        requests INTEGER NOT NULL DEFAULT 0,
+                        tokens INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (key_id, model, day)
+                    )
+                """)
+                cutoff = (datetime.now(self.timezone).date() - timedelta(days=self.keep_days)).isoformat()
+                conn.execute('DELETE FROM quota_usage WHERE day < ?', (cutoff,))
+
+        def _connect(self):
+            return sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+
+        def quota_day(self) -> str:
+            return datetime.now(self.timezone).date().isoformat()
+
+        def next_reset(self) -> datetime:
+            """زمان بازنشانی بعدی سهمیه به وقت محلی سرور"""
+            now = datetime.now(self.timezone)
+            midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=self.timezone)
+            return midnight.astimezone()
+
+        def try_consume(self, api_key: str, model: str, daily_limit: int) -> bool:
+            """ثبت یک درخواست در صورتی که سقف روزانه کلید پر نشده باشد (بررسی و افزایش اتمی)"""
+            key = (api_key_id(api_key), model, self.quota_day())
+            try:
+                with contextlib.closing(self._connect()) as conn:
+                    conn.execute('BEGIN IMMEDIATE')
+                    row = conn.execute(
+                        'SELECT requests FROM quota_usage WHERE key_id = ? AND model = ? AND day = ?', key
+                    ).fetchone()
+                    if row and row[0] >= daily_limit:
+                        conn.execute('ROLLBACK')
+                        return False
+                    conn.execute("""
+                        INSERT INTO quota_usage (key_id, model, day, requests) VALUES (?, ?, ?, 1)
+                        ON CONFLICT (key_id, model, day) DO UPDATE SET requests = requests + 1
+                    """, key)
+                    conn.execute('COMMIT')
+                    return True
+            except sqlite3.Error as e:
+                # خرابی دفتر نباید پردازش را متوقف کند؛ rate limiter همچنان RPM/TPM را رعایت می‌کند
+                logger.warning(f"Quota ledger write failed: {e}")
+                return True
+
+        def refund(self, api_key: str, model: str):
+            """برگرداندن درخواستی که ثبت شده ولی هرگز ارسال نشده است (مثلاً لغو در حین انتظار)"""
+            try:
+                with contextlib.closing(self._connect()) as conn:
+                    conn.execute(
+                        'UPDATE quota_usage SET requests = MAX(0, requests - 1) WHERE key_id = ? AND model = ? AND day = ?',
+                        (api_key_id(api_key), model, self.quota_day())
+                    )
+            except sqlite3.Error as e:
+                logger.warning(f"Quota ledger write failed: {e}")
+
+        def add_tokens(self, api_key: str, model: str, tokens: int):
+            try:
+                with contextlib.closing(self._connect()) as conn:
+                    conn.execute("""
+                        INSERT INTO quota_usage (key_id, model, day, tokens) VALUES (?, ?, ?, ?)
+                        ON CONFLICT (key_id, model, day) DO UPDATE SET tokens = tokens + excluded.tokens
+                    """, (api_key_id(api_key), model, self.quota_day(), int(tokens)))
+            except sqlite3.Error as e:
+                logger.warning(f"Quota ledger write failed: {e}")
+
+        def usage(self, api_keys: List[str], model: str) -> Dict[str, dict]:
+            """مصرف امروز هر کلید: {api_key: {'requests', 'tokens'}}"""
+            ids = {api_key_id(api_key): api_key for api_key in api_keys}
+            usage = {api_key: {'requests': 0, 'tokens': 0} for api_key in api_keys}
+            try:
+                with contextlib.closing(self._connect()) as conn:
+                    rows = conn.execute(
+                        'SELECT key_id, requests, tokens FROM quota_usage WHERE model = ? AND day = ?',
+                        (model, self.quota_day())
+                    ).fetchall()
+            except sqlite3.Error as e:
+                logger.warning(f"Quota ledger read failed: {e}")
+                rows = []
+            for key_id, requests, tokens in rows:
+                if key_id in ids:
+                    usage[ids[key_id]] = {'requests': requests, 'tokens': tokens}
+            return usage
+
+        def remaining(self, api_keys: List[str], model: str, daily_limit: int) -> int:
+            """مجموع درخواست‌های باقی‌مانده امروز روی همه کلیدها"""
+            return sum(max(0, daily_limit - item['requests']) for item in self.usage(api_keys, model).values())
+
+    @st.cache_resource
+    def get_quota_ledger():
+        return QuotaLedger(
+            os.getenv("QUOTA_LEDGER_DIR", os.getenv("ANALYSIS_CACHE_DIR", ".analysis_cache")),
+            timezone_name=os.getenv("GEMINI_QUOTA_TIMEZONE", "America/Los_Angeles")
+        )
+
+    quota_ledger = get_quota_ledger()
+
+
+    # ============================================================================
+    # 🚦 محدودکننده نرخ token bucket برای هر کلید و مدل (RPM، TPM و RPD)
+    # ============================================================================
+
+    class DailyQuotaExceededError(Exception):
+        """سهمیه روزانه کلید (در reserve) یا همه کلیدها (در acquire_client_async) برای مدل درخواستی تمام شده است"""
+
+
+    class RateLimiter:
+        """
+        فاصله‌گذاری درخواست‌ها قبل از ارسال به جای sleep-and-retry بعد از خطای 429
+
+        برای هر (کلید، مدل) دو سطل درخواست و توکن با ظرفیت یک دقیقه نگهداری می‌شود و
+        سقف روزانه از QuotaLedger مشترک بررسی می‌شود. reserve ظرفیت را فوراً رزرو می‌کند (سطل می‌تواند منفی شود) و مدت
+        انتظار لازم را برمی‌گرداند؛ بنابراین acquire_async در event loop
+        بدون نگه داشتن قفل در حین انتظار از آن استفاده می‌کند. توکن‌های رزرو شده
+        تخمینی هستند و پس از پاسخ با usage_metadata واقعی اصلاح می‌شوند (settle).
+
+        دفتر روی SQLite است و ممکن است تا ۳۰ ثانیه منتظر قفل بماند (مثلاً پشت extraction worker)؛
+        روی event loop مشترک همه فراخوانی‌های دفتر در thread انجام می‌شوند.
+        """
+
+        USAGE_REFRESH_SECONDS = 30   # فاصله خواندن دوباره مصرف روزانه همه کلیدها از دفتر
+
+        def __init__(self, ledger: "QuotaLedger" = None, default_limits: dict = None):
+            self.ledger = ledger
+            self.lock = threading.Lock()
+            self.daily_usage_snapshots = {}        # مدل ← (زمان خواندن، {کلید: درخواست‌های امروز})
+            self.refreshing = set()
+            self.limits = {}                       # مدل ← {'rpm', 'tpm', 'rpd'}
+            self.default_limits = default_limits or {'rpm': 5, 'tpm': 250000, 'rpd': 100}
+            self.buckets = {}                      # (کلید، مدل) ← وضعیت سطل‌ها
+            self.stats = {'acquired': 0, 'waited': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0, 'refunded': 0}
+
+        def configure(self, model: str, rpm: int, tpm: int, rpd: int):
+            """تنظیم محدودیت‌های هر کلید برای یک مدل؛ فقط یک بار هنگام ساخت limiter فرایند"""
+            with self.lock:
+                self.limits[model] = {'rpm': max(1, rpm), 'tpm': max(1, tpm), 'rpd': max(1, rpd)}
+
+        def _bucket(self, api_key: str, model: str, now: float) -> dict:
+            limits = self.limits.get(model, self.default_limits)
+            bucket = self.buckets.get((api_key, model))
+            if bucket is None:
+                bucket = {'requests': float(limits['rpm']), 'tokens': float(limits['tpm']), 'updated': now}
+                self.buckets[(api_key, model)] = bucket
+            elapsed = now - bucket['updated']
+            bucket['requests'] = min(limits['rpm'], bucket['requests'] + elapsed * limits['rpm'] / 60)
+            bucket['tokens'] = min(limits['tpm'], bucket['tokens'] + elapsed * limits['tpm'] / 60)
+            bucket['updated'] = now
+            return bucket
+
+        def daily_limit(self, model: str) -> int:
+            with self.lock:
+                return self.limits.get(model, self.default_limits)['rpd']
+
+        def _ledger_write(self, method, *args):
+            """نوشتن در دفتر؛ روی event loop در thread و بدون انتظار برای نتیجه"""
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                method(*args)
+                return
+            loop.run_in_executor(None, method, *args)
+
+        def reserve(self, api_key: str, model: str, tokens: int) -> float:
+            """
+            رزرو یک درخواست و tokens توکن روی همین کلید؛ انتخاب کلید دیگر در صورت پر بودن
+            سقف روزانه بر عهده acquire_client_async است
+
+            Returns:
+                float: ثانیه‌های انتظار تا مجاز شدن ارسال
+            """
+            if self.ledger and not self.ledger.try_consume(api_key, model, self.daily_limit(model)):
+                raise DailyQuotaExceededError(f"Daily quota of {api_key[:8]}... for {model} is exhausted")
+            self._count_daily(api_key, model, 1)
+            return self._take(api_key, model, tokens)
+
+        def _count_daily(self, api_key: str, model: str, delta: int):
+            """به‌روز نگه داشتن snapshot مصرف روزانه با رزروها و بازگشت‌های همین فرایند تا خواندن بعدی دفتر"""
+            with self.lock:
+                _, usage = self.daily_usage_snapshots.get(model, (None, {}))
+                usage[api_key] = max(0, usage.get(api_key, 0) + delta)
+                self.daily_usage_snapshots.setdefault(model, (None, usage))
+
+        def daily_usage(self, api_keys: List[str], model: str) -> Dict[str, int]:
+            """
+            درخواست‌های امروز هر کلید بدون مراجعه همزمان به SQLite (برای وزن‌دهی انتخاب کلید روی event loop)؛
+            snapshot کهنه‌تر از USAGE_REFRESH_SECONDS در یک thread پس‌زمینه از دفتر دوباره خوانده می‌شود.
+            سقف قطعی همچنان در try_consume بررسی می‌شود.
+            """
+            with self.lock:
+                updated, usage = self.daily_usage_snapshots.get(model, (None, {}))
+                stale = updated is None or time.monotonic() - updated > self.USAGE_REFRESH_SECONDS
+                if self.ledger and stale and model not in self.refreshing:
+                    self.refreshing.add(model)
+                    threading.Thread(target=self._refresh_daily_usage, args=(list(api_keys), model),
+                                     daemon=True).start()
+                return {api_key: usage.get(api_key, 0) for api_key in api_keys}
+
+        def _refresh_daily_usage(self, api_keys: List[str], model: str):
+            try:
+                usage = {api_key: item['requests'] for api_key, item in self.ledger.usage(api_keys, model).items()}
+                with self.lock:
+                    self.daily_usage_snapshots[model] = (time.monotonic(), usage)
+            finally:
+                with self.lock:
+                    self.refreshing.discard(model)
+
+        async def _consume_daily_async(self, api_key: str, model: str) -> bool:
+            """بررسی و ثبت سقف روزانه در thread؛ ثبتی که پس از لغو انجام شود برگردانده می‌شود"""
+            consume = asyncio.ensure_future(
+                asyncio.to_thread(self.ledger.try_consume, api_key, model, self.daily_limit(model))
+            )
+            try:
+                consumed = await asyncio.shield(consume)
+            except asyncio.CancelledError:
+                consume.add_done_callback(
+                    lambda done: done.cancelled() or not done.result()
+                    or self._ledger_write(self.ledger.refund, api_key, model)
+                )
+                raise
+            if consumed:
+                self._count_daily(api_key, model, 1)
+            return consumed
+
+        def _take(self, api_key: str, model: str, tokens: int) -> float:
+            """برداشت از سطل‌های درخواست و توکن و محاسبه انتظار لازم"""
+            with self.lock:
+                limits = self.limits.get(model, self.default_limits)
+                bucket = self._bucket(api_key, model, time.monotonic())
+                # درخواست بزرگ‌تر از ظرفیت یک دقیقه فقط منتظر پر شدن کامل سطل می‌ماند
+                tokens = min(max(0, tokens), limits['tpm'])
+                bucket['requests'] -= 1
+                bucket['tokens'] -= tokens
+                wait = max(
+                    0.0,
+                    -bucket['requests'] * 60 / limits['rpm'],
+                    -bucket['tokens'] * 60 / limits['tpm']
+                )
+                self.stats['acquired'] += 1
+                if wait > 0:
+                    self.stats['waited'] += 1
+                    self.stats['wait_seconds'] += wait
+                    self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], wait)
+                return wait
+
+        def settle(self, api_key: str, model: str, reserved_tokens: int, usage_metadata):
+            """جایگزینی توکن‌های تخمینی با مصرف واقعی درخواست"""
+            actual = getattr(usage_metadata, 'total_token_count', None) if usage_metadata is not None else None
+            if not actual:
+                return
+            if self.ledger:
+                self._ledger_write(self.ledger.add_tokens, api_key, model, actual)
+            with self.lock:
+                limits = self.limits.get(model, self.default_limits)
+                bucket = self._bucket(api_key, model, time.monotonic())
+                bucket['tokens'] = min(limits['tpm'], bucket['tokens'] - (actual - min(reserved_tokens, limits['tpm'])))
+
+        def refund(self, api_key: str, model: str, tokens: int):
+            """آزاد کردن رزروی که درخواستش ارسال نشد؛ سهمیه روزانه و ظرفیت سطل‌ها فوراً برمی‌گردد"""
+            if self.ledger:
+                self._ledger_write(self.ledger.refund, api_key, model)
+                self._count_daily(api_key, model, -1)
+            with self.lock:
+                limits = self.limits.get(model, self.default_limits)
+                bucket = self._bucket(api_key, model, time.monotonic())
+                bucket['requests'] = min(limits['rpm'], bucket['requests'] + 1)
+                bucket['tokens'] = min(limits['tpm'], bucket['tokens'] + min(max(0, tokens), limits['tpm']))
+                self.stats['refunded'] += 1
+
+        async def acquire_async(self, api_key: str, model: str, tokens: int) -> float:
+            if self.ledger and not await self._consume_daily_async(api_key, model):
+                raise DailyQuotaExceededError(f"Daily quota of {api_key[:8]}... for {model} is exhausted")
+            wait = self._take(api_key, model, tokens)
+            if wait > 0:
+                try:
+                    await asyncio.sleep(wait)
+                except asyncio.CancelledError:
+                    # لغو قبل از ارسال: رزرو مصرف نشده است
+                    self.refund(api_key, model, tokens)
+                    raise
+            return wait
+
+        def snapshot(self) -> dict:
             with self.lock:
-                if key in self.failures:
-                    self.failures[key] = 0
+                return dict(self.stats)
 
-    api_key_manager = APIKeyManager(st.session_state.api_keys)
+    @st.cache_resource
+    def get_rate_limiter():
+        """
+        سطل‌ها بین sessionها مشترک هستند چون کلیدها مشترک‌اند؛ محدودیت‌ها هم یک بار از
+        API_LIMITS (مدل اصلی و هر مدل دیگر) و TRIAGE_API_LIMITS تنظیم می‌شوند
+        """
+        limiter = RateLimiter(ledger=quota_ledger, default_limits=dict(API_LIMITS))
+        limiter.configure(GEMINI_TRIAGE_MODEL, **TRIAGE_API_LIMITS)
+        return limiter
+
+    rate_limiter = get_rate_limiter()
+
+    def get_client_with_retry(exclude_key: str = None, model: str = None, exhausted: Set[str] = None):
+        remaining = None
+        if model:
+            # وزن‌دهی با سهمیه باقی‌مانده امروز؛ کلیدهای با سهمیه تمام شده کنار گذاشته می‌شوند
+            daily_limit = rate_limiter.daily_limit(model)
+            remaining = {
+                key: 0.0 if key in (exhausted or ()) else max(0, daily_limit - requests) / daily_limit
+                for key, requests in rate_limiter.daily_usage(api_key_manager.api_keys, model).items()
+            }
+        # برای hedge تا حد امکان کلیدی غیر از کلید درخواست اصلی انتخاب می‌شود
+        api_key = api_key_manager.get_next_key(exclude={exclude_key} if exclude_key else None, remaining=remaining)
+        if exhausted and api_key in exhausted:
+            # فقط کلیدهای با breaker باز سهمیه دارند؛ سهمیه مهم‌تر از cool-down است
+            api_key = next(key for key in api_key_manager.api_keys if key not in exhausted)
+        return client_pool.get(api_key), api_key
+
+    async def acquire_client_async(model: str, tokens: int, client_key: Tuple = None):
+        """
+        انتخاب کلیدی که سهمیه روزانه دارد و رزرو ظرفیت آن در rate limiter
 
-    def get_client_with_retry():
-        api_key = api_key_manager.get_next_key()
-        return genai.Client(api_key=api_key), api_key
+        کلید پیشنهادی (client_key) اگر سهمیه امروزش تمام شده باشد با کلید دیگری جایگزین
+        می‌شود؛ DailyQuotaExceededError فقط وقتی بالا می‌رود که سهمیه همه کلیدها تمام شده باشد.
+        """
+        exhausted = set()
+        while True:
+            client, api_key = client_key or get_client_with_retry(model=model, exhausted=exhausted)
+            client_key = None
+            try:
+                await rate_limiter.acquire_async(api_key, model, tokens)
+                return client, api_key
+            except DailyQuotaExceededError:
+                exhausted.add(api_key)
+                if exhausted.issuperset(api_key_manager.api_keys):
+                    raise DailyQuotaExceededError(f"Daily quota of all API keys for {model} is exhausted")
+
+    # پاسخ‌هایی که نشان می‌دهند سرور درخواست را نپذیرفته و از سهمیه روزانه کم نکرده است
+    REJECTED_STATUS_CODES = {401, 403, 429}
+
+    def is_rejected_request(error: BaseException) -> bool:
+        return getattr(error, 'code', None) in REJECTED_STATUS_CODES
 
     # ========================================================================
     # بخش 5: توابع پردازش فارسی و ادغام
@@ -1262,13 +3178,431 @@ if st.session_state.authentication_status:
         
         return fig
     # ========================================================================
-    # بخش اصلاح شده: پردازش همزمان فایل‌ها
+    # بخش اصلاح شده: پردازش همزمان فایل‌ها
+    # ========================================================================
+
+    # ========================================================================
+    # ⚡ Hedging: درخواست پشتیبان برای فراخوانی‌های کند
+    # ========================================================================
+
+    def latency_percentiles(values: List[float]) -> dict:
+        if not values:
+            return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0}
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+
+
+    class HedgingPolicy:
+        """
+        تصمیم‌گیری درباره ارسال درخواست پشتیبان (hedge) و ثبت آمار تأخیر
+
+        اگر یک فراخوانی بیش از صدک percentile تأخیرهای مشاهده شده طول بکشد، همان
+        درخواست با کلید دیگری ارسال می‌شود. تعداد hedgeها حداکثر budget_ratio از
+        درخواست‌های این batch است تا سهمیه هدر نرود. درخواست بازنده لغو می‌شود؛ تأخیر
+        درخواست‌های اصلی لغو شده برای مقایسه «بدون hedging» از توزیع ثبت شده تخمین زده می‌شود.
+        """
+
+        MIN_SAMPLES = 10   # تا این تعداد نمونه، از fallback_delay استفاده می‌شود
+
+        def __init__(self, percentile: float = 95, budget_ratio: float = 0.1,
+                     min_delay: float = 5.0, fallback_delay: float = 90.0, window: int = 200):
+            """
+            Args:
+                percentile: صدک تأخیر که پس از آن hedge ارسال می‌شود
+                budget_ratio: حداکثر نسبت hedgeها به کل درخواست‌ها
+                min_delay: حداقل انتظار پیش از hedge (ثانیه)
+                fallback_delay: انتظار پیش از hedge تا جمع شدن نمونه کافی (ثانیه)
+                window: تعداد تأخیرهای اخیر برای محاسبه صدک
+            """
+            self.percentile = percentile
+            self.budget_ratio = budget_ratio
+            self.min_delay = min_delay
+            self.fallback_delay = fallback_delay
+            self.samples = deque(maxlen=window)
+            self.lock = threading.Lock()
+            self.requests = 0
+            self.hedges = 0
+            self.hedge_wins = 0
+            self.budget_denied = 0
+            self.effective_latencies = []   # تأخیر هر درخواست با hedging
+            self.primary_latencies = []     # تأخیر درخواست اصلی (برای مقایسه بدون hedging)
+            self.cancelled_primaries = []   # زمان لغو درخواست‌های اصلی که hedge از آن‌ها جلو زد
+
+        def hedge_delay(self) -> float:
+            with self.lock:
+                if len(self.samples) < self.MIN_SAMPLES:
+                    return self.fallback_delay
+                return max(self.min_delay, float(np.percentile(list(self.samples), self.percentile)))
+
+        def start_request(self):
+            with self.lock:
+                self.requests += 1
+
+        def try_acquire(self) -> bool:
+            """گرفتن یک واحد از بودجه hedge"""
+            with self.lock:
+                if self.hedges < max(1, int(self.budget_ratio * self.requests)):
+                    self.hedges += 1
+                    return True
+                self.budget_denied += 1
+                return False
+
+        def record(self, effective_seconds: float, hedge_won: bool = False, primary_cancelled: bool = False):
+            """
+            Args:
+                effective_seconds: زمان از ارسال درخواست اصلی به مدل تا رسیدن اولین پاسخ معتبر
+                    (انتظار rate limiter جزو آن نیست)
+                hedge_won: پاسخ از درخواست پشتیبان رسیده است
+                primary_cancelled: درخواست اصلی هنوز در جریان بود و در همین لحظه لغو می‌شود؛
+                    فقط می‌دانیم تأخیر آن بیش از effective_seconds بوده است
+            """
+            with self.lock:
+                self.effective_latencies.append(effective_seconds)
+                if hedge_won:
+                    self.hedge_wins += 1
+                    if primary_cancelled:
+                        self.cancelled_primaries.append(effective_seconds)
+                        # حد پایین تأخیر درخواست کند هم در پنجره صدک می‌ماند؛ حذف آن آستانه hedge را پایین می‌کشد
+                        self.samples.append(effective_seconds)
+                else:
+                    self.primary_latencies.append(effective_seconds)
+                    self.samples.append(effective_seconds)
+
+        def _estimate_primary(self, elapsed: float) -> float:
+            """
+            تأخیر تخمینی درخواست اصلی لغو شده: میانه تأخیرهای ثبت شده بزرگ‌تر از زمان لغو
+            (توزیع شرطی)؛ اگر هیچ نمونه‌ای کندتر نبوده، خود زمان لغو (حد پایین)
+            """
+            slower = [seconds for seconds in self.primary_latencies if seconds > elapsed]
+            return float(np.median(slower)) if slower else elapsed
+
+        def report(self) -> dict:
+            """ارقام «بدون hedging» برای درخواست‌های اصلی لغو شده از توزیع تأخیرهای ثبت شده تخمین زده می‌شوند"""
+            with self.lock:
+                estimated = [self._estimate_primary(elapsed) for elapsed in self.cancelled_primaries]
+                return {
+                    'lower_bound': sum(1 for elapsed, seconds in zip(self.cancelled_primaries, estimated)
+                                       if seconds == elapsed),
+                    'requests': self.requests,
+                    'hedges': self.hedges,
+                    'hedge_wins': self.hedge_wins,
+                    'budget_denied': self.budget_denied,
+                    'estimated': len(estimated),
+                    'with_hedging': latency_percentiles(self.effective_latencies),
+                    'without_hedging': latency_percentiles(self.primary_latencies + estimated)
+                }
+
+
+    # ========================================================================
+    # 🪜 مدل دو مرحله‌ای: triage با مدل سبک و ارجاع به مدل اصلی
+    # ========================================================================
+
+    class ModelTiering:
+        """
+        همه فایل‌ها ابتدا با مدل سبک تحلیل می‌شوند؛ فقط فایل‌هایی که اعتبارسنجی را رد
+        می‌کنند، اطمینان پایینی دارند یا ریسک بالا گزارش کرده‌اند به مدل اصلی می‌روند.
+
+        هر tier سقف همزمانی جداگانه‌ای دارد (از APILimitsManager.calculate_tier_budgets)
+        و مصرف درخواست و توکن هر tier در limits_manager ثبت می‌شود.
+        """
+
+        ESCALATION_REASONS = {
+            'validation': 'پاسخ نامعتبر',
+            'low_confidence': 'اطمینان پایین',
+            'high_risk': 'ریسک بالا',
+            'error': 'خطای مدل سبک'
+        }
+
+        def __init__(self, triage_model: str, escalation_model: str, concurrency: Dict[str, int],
+                     limits_manager: "APILimitsManager" = None, min_avg_logprob: float = -0.5,
+                     escalate_risk_levels: Tuple[str, ...] = ('بالا', 'بحرانی')):
+            """
+            Args:
+                triage_model: مدل سبک مرحله اول
+                escalation_model: مدل اصلی برای فایل‌های ارجاعی
+                concurrency: سقف درخواست همزمان هر مدل
+                limits_manager: برای ثبت مصرف جداگانه هر tier
+                min_avg_logprob: میانگین log-probability کمتر از این مقدار یعنی اطمینان پایین
+                escalate_risk_levels: سطوح ریسکی که همیشه با مدل اصلی بررسی می‌شوند
+            """
+            self.triage_model = triage_model
+            self.escalation_model = escalation_model
+            self.concurrency = concurrency
+            self.limits_manager = limits_manager
+            self.min_avg_logprob = min_avg_logprob
+            self.escalate_risk_levels = set(escalate_risk_levels)
+            self.semaphores = {}
+            self.lock = threading.Lock()
+            self.stats = {'triaged': 0, 'accepted': 0, 'escalated': 0, 'reasons': defaultdict(int)}
+
+        def slot(self, model: str) -> asyncio.Semaphore:
+            """Semaphore هر مدل؛ در اولین استفاده روی event loop جاری ساخته می‌شود"""
+            if model not in self.semaphores:
+                self.semaphores[model] = asyncio.Semaphore(max(1, self.concurrency.get(model, 1)))
+            return self.semaphores[model]
+
+        def check_confidence(self, response):
+            candidates = getattr(response, 'candidates', None) or []
+            avg_logprobs = getattr(candidates[0], 'avg_logprobs', None) if candidates else None
+            if avg_logprobs is not None and avg_logprobs < self.min_avg_logprob:
+                raise LowConfidenceError(f"avg_logprobs {avg_logprobs:.2f} < {self.min_avg_logprob}")
+
+        def escalation_reason(self, data: Dict):
+            summary = data[FinancialAnalyzer.ROOT_KEY][FinancialAnalyzer.SECTION_KEYS[0]]
+            if summary.get('سطح_ریسک_کلی_بنا_به_گزارش') in self.escalate_risk_levels:
+                return 'high_risk'
+            return None
+
+        def record_outcome(self, reason: str = None):
+            with self.lock:
+                self.stats['triaged'] += 1
+                if reason is None:
+                    self.stats['accepted'] += 1
+                else:
+                    self.stats['escalated'] += 1
+                    self.stats['reasons'][reason] += 1
+
+        def record_usage(self, model: str, usage_metadata):
+            if self.limits_manager:
+                tokens = getattr(usage_metadata, 'total_token_count', None) or 0
+                self.limits_manager.record_tier_usage(model, tokens)
+
+        def report(self) -> dict:
+            with self.lock:
+                return {**self.stats, 'reasons': dict(self.stats['reasons'])}
+
+
+    # ========================================================================
+    # ✅ اعتبارسنجی پاسخ مدل و تشخیص بخش‌های معیوب
+    # ========================================================================
+
+    class SchemaValidator:
+        """
+        اعتبارسنجی کامپایل شده برای زیرمجموعه JSON Schema به کار رفته در response_schema
+        (type، properties، required، items و enum)
+
+        schema یک بار به درختی از توابع تبدیل می‌شود و validate فهرست خطاها را به
+        صورت (مسیر، نوع خطا، توضیح) برمی‌گرداند.
+        """
+
+        TYPE_CHECKS = {
+            'object': lambda v: isinstance(v, dict),
+            'array': lambda v: isinstance(v, list),
+            'string': lambda v: isinstance(v, str),
+            'boolean': lambda v: isinstance(v, bool),
+            'integer': lambda v: isinstance(v, int) and not isinstance(v, bool),
+            'number': lambda v: isinstance(v, (int, float)) and not isinstance(v, bool)
+        }
+
+        def __init__(self, schema: dict):
+            self._check = self._compile(schema)
+
+        def _compile(self, schema: dict):
+            expected = schema.get('type')
+            type_check = self.TYPE_CHECKS.get(expected)
+            enum = set(schema['enum']) if 'enum' in schema else None
+            properties = {key: self._compile(sub) for key, sub in schema.get('properties', {}).items()}
+            required = schema.get('required', [])
+            items = self._compile(schema['items']) if 'items' in schema else None
+
+            def check(value, path, errors):
+                if type_check and not type_check(value):
+                    errors.append((path, 'type', f"expected {expected}"))
+                    return
+                if enum is not None and value not in enum:
+                    errors.append((path, 'enum', f"{value!r} is not an allowed value"))
+                    return
+                if isinstance(value, dict):
+                    for key in required:
+                        if key not in value:
+                            errors.append((path + (key,), 'missing', 'required field'))
+                    for key, sub_check in properties.items():
+                        if key in value:
+                            sub_check(value[key], path + (key,), errors)
+                elif items is not None and isinstance(value, list):
+                    for index, item in enumerate(value):
+                        items(item, path + (index,), errors)
+
+            return check
+
+        def validate(self, data) -> List[Tuple[tuple, str, str]]:
+            errors = []
+            self._check(data, (), errors)
+            return errors
+
+
+    class ResponseQualityError(Exception):
+        """پاسخ دریافت شده ولی قابل قبول نیست؛ مشکل از کلید API نیست"""
+
+
+    class LowConfidenceError(ResponseQualityError):
+        """پاسخ مدل سبک (triage) اطمینان کافی ندارد و باید به مدل اصلی ارجاع شود"""
+
+
+    class ExtractionDefectError(ResponseQualityError):
+        """
+        پاسخ مدل ناقص یا نامعتبر است ولی بخش‌های سالم آن قابل استفاده‌اند
+
+        Attributes:
+            partial: ساختار ریشه فقط با بخش‌های سالم
+            broken_sections: بخش‌هایی که باید دوباره درخواست شوند
+            missing_topics: موضوعات چک‌لیست که نیامده یا نامعتبر بوده‌اند
+            truncated: پاسخ به دلیل سقف توکن خروجی (finish_reason=MAX_TOKENS) یا JSON ناقص قطع شده است
+        """
+
+        def __init__(self, partial: Dict, broken_sections: List[str], missing_topics: List[str], truncated: bool):
+            self.partial = partial
+            self.broken_sections = broken_sections
+            self.missing_topics = missing_topics
+            self.truncated = truncated
+            details = []
+            if truncated:
+                details.append("truncated response")
+            if broken_sections:
+                details.append(f"invalid sections: {', '.join(broken_sections)}")
+            if missing_topics:
+                details.append(f"{len(missing_topics)} missing checklist topics")
+            super().__init__(f"Schema defect ({'; '.join(details)})")
+
+
+    def salvage_array_items(text: str, key: str) -> list:
+        """عناصر کامل آرایه key از یک JSON قطع شده (مثلاً چک‌لیست ناتمام)"""
+        match = re.search(re.escape(json.dumps(key, ensure_ascii=False)) + r'\s*:\s*\[', text)
+        if not match:
+            return []
+        decoder = json.JSONDecoder()
+        position = match.end()
+        items = []
+        while True:
+            while position < len(text) and text[position] in ' \t\r\n,':
+                position += 1
+            try:
+                item, position = decoder.raw_decode(text, position)
+            except json.JSONDecodeError:
+                return items
+            items.append(item)
+
+
     # ========================================================================
+    # 📡 پارسر تدریجی JSON برای پاسخ‌های streaming
+    # ========================================================================
+
+    class IncrementalJSONParser:
+        """
+        پارسر تدریجی JSON: به محض بسته شدن object یا array مربوط به کلیدهای
+        مورد نظر، مقدار آن را برمی‌گرداند؛ هر کاراکتر فقط یک بار بررسی می‌شود.
+        """
+
+        def __init__(self, target_keys: List[str]):
+            self.target_keys = set(target_keys)
+            self.emitted = set()
+            self.buffer = ''
+            self.position = 0
+            self.in_string = False
+            self.escape = False
+            self.string_start = None
+            self.last_string = None
+            self.pending_key = None
+            self.stack = []   # (شروع container، کلیدی که آن را باز کرده)
+
+        def feed(self, text: str) -> List[Tuple[str, object]]:
+            """افزودن یک chunk و برگرداندن (کلید، مقدار)هایی که کامل شده‌اند"""
+            self.buffer += text
+            completed = []
+            buffer = self.buffer
+            for i in range(self.position, len(buffer)):
+                char = buffer[i]
+                if self.in_string:
+                    if self.escape:
+                        self.escape = False
+                    elif char == '\\':
+                        self.escape = True
+                    elif char == '"':
+                        self.in_string = False
+                        self.last_string = buffer[self.string_start:i + 1]
+                    continue
+
+                if char == '"':
+                    self.in_string = True
+                    self.string_start = i
+                elif char == ':':
+                    try:
+                        self.pending_key = json.loads(self.last_string) if self.last_string else None
+                    except json.JSONDecodeError:
+                        self.pending_key = None
+                elif char in '{[':
+                    self.stack.append((i, self.pending_key))
+                    self.pending_key = None
+                elif char in '}]':
+                    if self.stack:
+                        start, key = self.stack.pop()
+                        if key in self.target_keys and key not in self.emitted:
+                            try:
+                                completed.append((key, json.loads(buffer[start:i + 1])))
+                                self.emitted.add(key)
+                            except json.JSONDecodeError:
+                                pass
+                elif char == ',':
+                    self.pending_key = None
+            self.position = len(buffer)
+            return completed
+
+
+    class StreamedResponse:
+        """پاسخ تجمیع شده از chunkهای generate_content_stream با رابط مشابه پاسخ عادی"""
+
+        def __init__(self, text: str, last_chunk):
+            self.text = text
+            self.usage_metadata = getattr(last_chunk, 'usage_metadata', None)
+            self.candidates = getattr(last_chunk, 'candidates', None)
+
 
     class FinancialAnalyzer:
         """کلاس تحلیلگر مالی با پشتیبانی از پردازش همزمان"""
-        
-        def __init__(self):
+
+        ROOT_KEY = "تحلیل_جامع_گزارش_حسابرسی"
+        SECTION_KEYS = [
+            "بخش۱_خلاصه_و_اطلاعات_کلیدی",
+            "بخش۲_تجزیه_تحلیل_گزارش",
+            "بخش۳_چک_لیست_موضوعی"
+        ]
+        CHECKLIST_KEY = "بخش۳_چک_لیست_موضوعی"
+        DEFAULT_MODEL = "gemini-2.5-flash"
+        
+        def __init__(self, cache: "ExtractionCache" = None, page_targeting: bool = False,
+                     cost_estimator: "FileCostEstimator" = None, context_cache: "ContextCacheManager" = None,
+                     section_parallel: bool = False, streaming: bool = False,
+                     hedging: "HedgingPolicy" = None, tiering: "ModelTiering" = None):
+            self.model_name = self.DEFAULT_MODEL
+            self.temperature = 0.5
+            self.system_instruction = "شما تحلیلگر مالی هستید."
+            self.prompt = """لطفاً گزارش حسابرس را تحلیل کنید. نکته بسیار مهم برای بخش۳_چک_لیست_موضوعی:
+            - باید تمام  موضوع ها را چک کنید و در خروجی بیاورید
+            - برای هر موضوع، فیلد "در_گزارش_آمده" را مشخص کنید (true یا false)
+            - همه موضوع ها باید در آرایه بخش۳_چک_لیست_موضوعی باشند"""
+            self.cache = cache
+            self.page_targeting = page_targeting
+            self.page_locator = AuditorReportLocator()
+            self.preflight_results = {}   # file hash -> (محتوای ارسالی، اطلاعات پیش‌پردازش)
+            self.preflight_lock = threading.Lock()
+            self.cost_estimator = cost_estimator
+            self.cost_estimates = {}      # file hash -> تخمین هزینه
+            self.context_cache = context_cache
+            self.section_parallel = section_parallel
+            self.streaming = streaming
+            self.hedging = hedging
+            self.tiering = tiering
+            # callback با ورودی (filename, کلید بخش, مقدار) برای نمایش زودهنگام نتایج
+            self.on_partial = None
+            # callback با ورودی (seconds, tokens, error) پس از هر فراخوانی async مدل (کنترل همزمانی)
+            self.on_call = None
+            # session سازنده analyzer؛ فراخوانی‌ها روی thread دیگری اجرا می‌شوند و به آن دسترسی ندارند
+            self.session = current_session()
+            self.escalated_files = set()  # file hash فایل‌هایی که به مدل اصلی ارجاع شده‌اند
+            self.partial_sections = {}    # file hash -> بخش‌های معتبر تلاش ناموفق قبلی
+            self.validators = {}          # hash schema -> SchemaValidator
+            self.repair_stats = {'files': 0, 'requests': 0}
+
             # Schema بدون تغییر
             self.response_schema = {
                 "type": "object",
@@ -1646,77 +3980,1687 @@ if st.session_state.authentication_status:
                 "required": ["تحلیل_جامع_گزارش_حسابرسی"]
             }
         
-        def extract_table_from_page(self, file_content: bytes, filename: str, max_retries: int = 5) -> Dict:
+        def cache_fingerprint(self, batch: bool = False) -> str:
+            """
+            اثرانگشت تنظیماتی که روی خروجی مدل اثر می‌گذارند (برای کلید کش)
+
+            batch=True: درخواست حالت Batch همیشه یک درخواست کامل با مدل اصلی است (build_batch_request)،
+            بدون section-parallel و triage؛ اثرانگشت آن با پردازش تعاملی با همین تنظیمات یکی است
+            """
+            settings = {
+                'response_schema': self.response_schema,
+                'prompt': self.prompt,
+                'system_instruction': self.system_instruction,
+                'model': self.model_name,
+                'temperature': self.temperature,
+                'page_targeting': self.page_targeting,
+                'section_parallel': self.section_parallel and not batch,
+                'triage_model': self.tiering.triage_model if self.tiering and not batch else None
+            }
+            return hashlib.sha256(
+                json.dumps(settings, ensure_ascii=False, sort_keys=True).encode('utf-8')
+            ).hexdigest()
+
+        def prepare_document(self, file_content: bytes, filename: str) -> Tuple[bytes, dict]:
+            """
+            پیش‌پردازش قبل از ارسال: در صورت فعال بودن، فقط صفحات گزارش حسابرس ارسال می‌شود
+
+            Returns:
+                tuple: (محتوای ارسالی، اطلاعات پیش‌پردازش)
+            """
+            if not self.page_targeting:
+                return file_content, {'trimmed': False, 'reason': 'disabled'}
+
+            file_hash = hashlib.sha256(file_content).hexdigest()
+            with self.preflight_lock:
+                if file_hash in self.preflight_results:
+                    return self.preflight_results[file_hash]
+
+            payload, info = self.page_locator.trim(file_content)
+            if info['trimmed']:
+                logger.info(
+                    f"🎯 {filename}: sending {info['sent_pages']}/{info['total_pages']} pages {info['pages']}"
+                )
+            with self.preflight_lock:
+                self.preflight_results[file_hash] = (payload, info)
+            return payload, info
+
+        def request_overhead_tokens(self) -> int:
+            """توکن‌های ثابت هر درخواست: prompt، system instruction و schema"""
+            text = self.prompt + self.system_instruction + json.dumps(self.response_schema, ensure_ascii=False)
+            return int(len(text) / FileCostEstimator.CHARS_PER_TOKEN)
+
+        def estimate_cost(self, file_content: bytes, filename: str) -> dict:
+            """تخمین توکن و زمان فایل؛ فایل‌های موجود در کش هزینه‌ای ندارند"""
+            file_hash = hashlib.sha256(file_content).hexdigest()
+            with self.preflight_lock:
+                if file_hash in self.cost_estimates:
+                    return self.cost_estimates[file_hash]
+
+            if self.cache and self.cache.contains(file_content, self.cache_fingerprint()):
+                estimate = {'cached': True, 'pages': 0, 'raw_input_tokens': 0, 'input_tokens': 0,
+                            'output_tokens': 0, 'total_tokens': 0, 'seconds': 0.0}
+            else:
+                estimator = self.cost_estimator or FileCostEstimator()
+                payload, _ = self.prepare_document(file_content, filename)
+                estimate = {'cached': False, **estimator.estimate(payload, self.request_overhead_tokens())}
+                if self.section_parallel:
+                    # سند در هر درخواست بخش دوباره ارسال می‌شود و هر بخش حدود 1/N خروجی را تولید می‌کند؛
+                    # بخش‌ها همزمان اجرا می‌شوند، پس زمان فایل زمان یک بخش (کل ورودی + سهم خروجی) است
+                    sections = len(self.SECTION_KEYS)
+                    section_tokens = estimate['input_tokens'] + estimate['output_tokens'] / sections
+                    estimate['seconds'] *= section_tokens / max(1, estimate['total_tokens'])
+                    extra_input = estimate['input_tokens'] * (sections - 1)
+                    estimate['input_tokens'] += extra_input
+                    estimate['total_tokens'] += extra_input
+
+            with self.preflight_lock:
+                self.cost_estimates[file_hash] = estimate
+            return estimate
+
+        def _observe_usage(self, file_content: bytes, filename: str, response, duration: float):
+            """ارسال مصرف واقعی توکن به estimator برای کالیبراسیون"""
+            if not self.cost_estimator or response is None:
+                return
+            estimate = self.cost_estimates.get(hashlib.sha256(file_content).hexdigest())
+            if estimate is None or estimate.get('cached'):
+                payload, _ = self.prepare_document(file_content, filename)
+                estimate = self.cost_estimator.estimate(payload, self.request_overhead_tokens())
+            self.cost_estimator.observe(estimate, getattr(response, 'usage_metadata', None), duration)
+
+        def _request_tokens(self, file_content: bytes, schema: dict = None) -> int:
+            """توکن تخمینی یک درخواست برای رزرو در rate limiter (پس از پاسخ اصلاح می‌شود)"""
+            estimate = self.cost_estimates.get(hashlib.sha256(file_content).hexdigest())
+            if not estimate or estimate.get('cached'):
+                return FileCostEstimator.tokens_from_size(len(file_content))
+            if self.section_parallel or schema is not None:
+                # درخواست‌های بخشی و ترمیمی سند کامل را می‌فرستند ولی خروجی کمتری دارند
+                return int(estimate['total_tokens'] / len(self.SECTION_KEYS)) if self.section_parallel \
+                    else estimate['input_tokens']
+            return estimate['total_tokens']
+
+        def section_schema(self, section: str) -> dict:
+            """schema فرعی شامل فقط یک بخش، با همان ساختار ریشه برای ادغام آسان"""
+            root = self.response_schema['properties'][self.ROOT_KEY]
+            return {
+                "type": "object",
+                "properties": {
+                    self.ROOT_KEY: {
+                        "type": "object",
+                        "description": root.get('description', ''),
+                        "properties": {section: root['properties'][section]},
+                        "required": [section]
+                    }
+                },
+                "required": [self.ROOT_KEY]
+            }
+
+        def section_prompt(self, section: str) -> str:
+            return f"{self.prompt}\n\nدر این درخواست فقط «{section}» را تولید کنید."
+
+        def checklist_topics(self) -> List[str]:
+            root = self.response_schema['properties'][self.ROOT_KEY]['properties']
+            return root[self.CHECKLIST_KEY]['items']['properties']['موضوع']['enum']
+
+        def checklist_schema(self, topics: List[str]) -> dict:
+            """schema فرعی چک‌لیست که فقط موضوعات داده شده را می‌پذیرد"""
+            schema = copy.deepcopy(self.section_schema(self.CHECKLIST_KEY))
+            checklist = schema['properties'][self.ROOT_KEY]['properties'][self.CHECKLIST_KEY]
+            checklist['items']['properties']['موضوع']['enum'] = list(topics)
+            return schema
+
+        def checklist_prompt(self, topics: List[str]) -> str:
+            return (
+                f"{self.prompt}\n\nدر این درخواست فقط «{self.CHECKLIST_KEY}» را و فقط برای این موضوعات "
+                f"تولید کنید: {'، '.join(topics)}"
+            )
+
+        def _context_cache_text(self, schema: dict, prompt: str) -> str:
+            """متن ثابتی که در cached content ثبت می‌شود: prompt و schema کامل با توضیحات"""
+            return (
+                prompt
+                + "\n\nراهنمای کامل ساختار خروجی (JSON Schema با توضیحات هر فیلد):\n"
+                + json.dumps(schema, ensure_ascii=False, indent=1)
+            )
+
+        def _resolve_context_cache(self, client, api_key: str, schema: dict, prompt: str, model: str = None):
+            # درخواست‌های ترمیم موضوعات چک‌لیست هر بار prompt متفاوتی دارند و ارزش کش ندارند
+            if not self.context_cache or (
+                    prompt != self.prompt and prompt not in map(self.section_prompt, self.SECTION_KEYS)):
+                return None
+            return self.context_cache.get_or_create(
+                client, api_key, model or self.model_name, self.system_instruction,
+                self._context_cache_text(schema, prompt)
+            )
+
+        def _handle_context_cache_error(self, cache_entry, error: Exception):
+            if cache_entry and 'cache' in str(error).lower():
+                self.context_cache.invalidate(cache_entry)
+
+        def _build_request(self, file_content: bytes, cache_entry: dict = None,
+                           schema: dict = None, prompt: str = None, model: str = None) -> dict:
+            """پارامترهای مشترک generate_content برای مسیر همگام و asyncio"""
+            schema = schema or self.response_schema
+            prompt = prompt or self.prompt
+            model = model or self.model_name
+            if cache_entry and not cache_entry['local']:
+                # دستورالعمل‌ها و توضیحات schema در کش هستند؛ فقط ساختار schema ارسال می‌شود
+                return {
+                    'model': model,
+                    'contents': [types.Part.from_bytes(data=file_content, mime_type="application/pdf")],
+                    'config': {
+                        'cached_content': cache_entry['name'],
+                        "response_mime_type": "application/json",
+                        "response_schema": strip_schema_descriptions(schema),
+                        "temperature": self.temperature
+                    }
+                }
+            return {
+                'model': model,
+                'contents': [types.Part.from_bytes(data=file_content, mime_type="application/pdf"), prompt],
+                'config': {
+                    'system_instruction': self.system_instruction,
+                    "response_mime_type": "application/json",
+                    "response_schema": schema,
+                    "temperature": self.temperature
+                }
+            }
+
+        def build_batch_request(self, file_content: bytes) -> dict:
+            """درخواست generateContent به شکل JSON برای یک خط فایل JSONL حالت Batch"""
+            return {
+                'contents': [{
+                    'role': 'user',
+                    'parts': [
+                        {'inline_data': {'mime_type': 'application/pdf',
+                                         'data': base64.b64encode(file_content).decode('ascii')}},
+                        {'text': self.prompt}
+                    ]
+                }],
+                'system_instruction': {'parts': [{'text': self.system_instruction}]},
+                'generation_config': {
+                    'response_mime_type': 'application/json',
+                    'response_schema': to_rest_schema(self.response_schema),
+                    'temperature': self.temperature
+                }
+            }
+
+        def _get_cached(self, file_content: bytes, filename: str):
+            if not self.cache:
+                return None
+            cached = self.cache.get(file_content, self.cache_fingerprint())
+            if cached is not None:
+                logger.info(f"💾 Cache hit for {filename}")
+            return cached
+
+        def _validator(self, schema: dict) -> SchemaValidator:
+            key = hashlib.sha256(json.dumps(schema, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+            with self.preflight_lock:
+                if key not in self.validators:
+                    self.validators[key] = SchemaValidator(schema)
+                return self.validators[key]
+
+        def _clean_checklist(self, items: list, topics: List[str]) -> list:
+            """حذف موارد نامعتبر و تکراری چک‌لیست؛ موضوع آن‌ها جاافتاده حساب می‌شود"""
+            item_schema = self.response_schema['properties'][self.ROOT_KEY]['properties'][self.CHECKLIST_KEY]['items']
+            validator = self._validator(item_schema)
+            allowed = set(topics)
+            seen = set()
+            clean = []
+            for item in items:
+                if validator.validate(item) or item['موضوع'] not in allowed or item['موضوع'] in seen:
+                    continue
+                seen.add(item['موضوع'])
+                clean.append(item)
+            return clean
+
+        def _remaining_defects(self, sections: Dict, topics: List[str] = None) -> Tuple[List[str], List[str]]:
+            """(بخش‌های غایب، موضوعات غایب چک‌لیست) برای بخش‌های جمع‌آوری شده"""
+            broken = [section for section in self.SECTION_KEYS if section not in sections]
+            missing_topics = []
+            if self.CHECKLIST_KEY in sections:
+                present = {item['موضوع'] for item in sections[self.CHECKLIST_KEY]}
+                missing_topics = [topic for topic in (topics or self.checklist_topics()) if topic not in present]
+            return broken, missing_topics
+
+        def _parse_response(self, response, schema: dict = None) -> Dict:
+            """
+            تبدیل پاسخ به dict و اعتبارسنجی بخش‌های درخواست شده در schema
+
+            اگر پاسخ قطع شده یا بخشی نامعتبر باشد، ExtractionDefectError همراه با
+            بخش‌های سالم برگردانده می‌شود تا فقط قسمت معیوب دوباره درخواست شود.
+            """
+            if not response or not response.text:
+                raise ValueError("API response was empty")
+            schema = schema or self.response_schema
+            root_schema = schema['properties'][self.ROOT_KEY]['properties']
+            sections = [section for section in self.SECTION_KEYS if section in root_schema]
+            topics = (root_schema[self.CHECKLIST_KEY]['items']['properties']['موضوع']['enum']
+                      if self.CHECKLIST_KEY in root_schema else None)
+
+            candidates = getattr(response, 'candidates', None) or []
+            finish_reason = getattr(candidates[0], 'finish_reason', None) if candidates else None
+            truncated = getattr(finish_reason, 'name', finish_reason) == 'MAX_TOKENS'
+            try:
+                root = json.loads(response.text).get(self.ROOT_KEY)
+            except (json.JSONDecodeError, AttributeError):
+                # JSON ناقص: بخش‌های کامل و موارد کامل چک‌لیست نجات داده می‌شوند
+                truncated = True
+                root = dict(IncrementalJSONParser(sections).feed(response.text))
+                if self.CHECKLIST_KEY in sections and self.CHECKLIST_KEY not in root:
+                    root[self.CHECKLIST_KEY] = salvage_array_items(response.text, self.CHECKLIST_KEY)
+            if not isinstance(root, dict):
+                root = {}
+
+            clean = {}
+            for section in sections:
+                value = root.get(section)
+                if section == self.CHECKLIST_KEY:
+                    if isinstance(value, list):
+                        clean[section] = self._clean_checklist(value, topics)
+                elif value is not None and not self._validator(root_schema[section]).validate(value):
+                    clean[section] = value
+
+            broken = [section for section in sections if section not in clean]
+            missing_topics = []
+            if self.CHECKLIST_KEY in clean:
+                _, missing_topics = self._remaining_defects(clean, topics)
+            if broken or missing_topics or truncated:
+                if truncated and not broken and not missing_topics:
+                    # قطع شده ولی همه بخش‌ها کامل‌اند
+                    return {self.ROOT_KEY: clean}
+                raise ExtractionDefectError({self.ROOT_KEY: clean}, broken, missing_topics, truncated)
+            return {self.ROOT_KEY: clean}
+
+        def _repair_plan(self, broken: List[str], missing_topics: List[str]) -> List[Tuple[str, dict, str]]:
+            """درخواست‌های لازم برای ترمیم: هر بخش معیوب جداگانه و موضوعات جاافتاده در یک درخواست"""
+            plan = [(section, self.section_schema(section), self.section_prompt(section)) for section in broken]
+            if missing_topics:
+                plan.append(('topics', self.checklist_schema(missing_topics), self.checklist_prompt(missing_topics)))
+            return plan
+
+        def _merge_sections(self, sections: Dict, data: Dict):
+            for section, value in data.get(self.ROOT_KEY, {}).items():
+                if section == self.CHECKLIST_KEY and section in sections:
+                    present = {item['موضوع'] for item in sections[section]}
+                    sections[section].extend(item for item in value if item['موضوع'] not in present)
+                else:
+                    sections[section] = value
+
+        def _finish_repair(self, filename: str, sections: Dict, missing_topics: List[str]) -> Dict:
+            if missing_topics:
+                # نتیجه با چک‌لیست ناقص بهتر از شکست کل فایل است
+                logger.warning(f"⚠️ {filename}: checklist topics still missing: {', '.join(missing_topics)}")
+            with self.preflight_lock:
+                self.repair_stats['files'] += 1
+            return {self.ROOT_KEY: {section: sections[section] for section in self.SECTION_KEYS}}
+
+        def _record_repair(self, filename: str, plan: list):
+            logger.info(f"🩹 {filename}: re-requesting {[label for label, _, _ in plan]}")
+            with self.preflight_lock:
+                self.repair_stats['requests'] += len(plan)
+
+        async def repair_async(self, payload: bytes, file_content: bytes, filename: str, sections: Dict) -> Dict:
+            """
+            یک دور درخواست مجدد فقط برای بخش‌های معیوب و موضوعات جاافتاده چک‌لیست (به صورت همزمان)
+            و ادغام آن‌ها با بخش‌های سالم، به جای تکرار کل فایل
+
+            اگر بخشی هنوز معیوب باشد، بخش‌های سالم در partial_sections می‌مانند و خطا بالا می‌رود
+            تا صف AsyncExtractionEngine فایل را با backoff خود دوباره بفرستد؛ تلاش بعدی فقط
+            بخش‌های باقی‌مانده را درخواست می‌کند.
+            """
+            broken, missing_topics = self._remaining_defects(sections)
+            plan = self._repair_plan(broken, missing_topics)
+            self._record_repair(filename, plan)
+            outcomes = await asyncio.gather(
+                *[
+                    self._call_model_hedged(payload, file_content, filename,
+                                            schema=schema, prompt=prompt, calibrate=False)
+                    for _, schema, prompt in plan
+                ],
+                return_exceptions=True
+            )
+            for outcome in outcomes:
+                if isinstance(outcome, ExtractionDefectError):
+                    self._merge_sections(sections, outcome.partial)
+                elif not isinstance(outcome, BaseException):
+                    self._merge_sections(sections, outcome)
+            broken, missing_topics = self._remaining_defects(sections)
+            if broken:
+                self.partial_sections[hashlib.sha256(file_content).hexdigest()] = sections
+                errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+                raise Exception(f"Incomplete response, sections still invalid: {', '.join(broken)}") \
+                    from (errors[0] if errors else None)
+            return self._finish_repair(filename, sections, missing_topics)
+
+        def _store_result(self, file_content: bytes, filename: str, data: Dict) -> Dict:
+            logger.info(f"Successfully processed {filename}")
+            if self.cache:
+                self.cache.put(file_content, self.cache_fingerprint(), data, filename)
+            return data
+
+        def _after_call(self, api_key, cache_entry, response, call_seconds, file_content, filename, calibrate,
+                        schema=None, model=None):
+            client_pool.record_call(api_key, call_seconds)
+            if self.tiering:
+                self.tiering.record_usage(model or self.model_name, response.usage_metadata)
+            if calibrate:
+                self._observe_usage(file_content, filename, response, call_seconds)
+            if cache_entry:
+                self.context_cache.record_usage(cache_entry, response.usage_metadata)
+            # خطای schema مشکل کلید نیست؛ کلید پیش از اعتبارسنجی موفق ثبت می‌شود
+            api_key_manager.mark_success(api_key, call_seconds)
+            api_key_manager.record_usage(self.session, getattr(response.usage_metadata, 'total_token_count', 0))
+            data = self._parse_response(response, schema)
+            if self.tiering and model == self.tiering.triage_model:
+                self.tiering.check_confidence(response)
+            return data
+
+        async def _call_model_hedged(self, payload: bytes, file_content: bytes, filename: str,
+                                     schema: dict = None, prompt: str = None, calibrate: bool = True,
+                                     model: str = None) -> Dict:
+            """
+            یک تلاش با hedging: اگر پاسخ از آستانه تأخیر دیرتر برسد، همان درخواست با
+            کلید دیگری هم ارسال می‌شود و اولین پاسخ معتبر برنده است
+            """
+            if not self.hedging:
+                return await self._call_model_async(payload, file_content, filename, schema, prompt, calibrate,
+                                                    model=model)
+
+            self.hedging.start_request()
+            primary_key = get_client_with_retry(model=model or self.model_name)
+            # زمان‌ها از ارسال درخواست اصلی به مدل سنجیده می‌شوند، نه از شروع انتظار rate limiter
+            timing = {}
+            primary = asyncio.create_task(self._call_model_async(
+                payload, file_content, filename, schema, prompt, calibrate, client_key=primary_key, model=model,
+                timing=timing
+            ))
+            tasks = [primary]
+            first_error = None
+            try:
+                if not await self._wait_for_hedge(primary, timing) or not self.hedging.try_acquire():
+                    data = await primary
+                    self.hedging.record(timing['seconds'])
+                    return data
+
+                logger.info(f"⚡ Hedging {filename} after {time.perf_counter() - timing['sent']:.1f}s")
+                hedge = asyncio.create_task(self._call_model_async(
+                    payload, file_content, filename, schema, prompt, calibrate,
+                    client_key=get_client_with_retry(exclude_key=primary_key[1], model=model or self.model_name),
+                    model=model
+                ))
+                tasks.append(hedge)
+                pending = set(tasks)
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is not None:
+                            first_error = first_error or task.exception()
+                            continue
+                        # درخواست بازنده در finally لغو می‌شود تا اتصال و slot همزمانی آزاد شود
+                        if task is primary:
+                            self.hedging.record(timing['seconds'])
+                        else:
+                            self.hedging.record(time.perf_counter() - timing['sent'], hedge_won=True,
+                                                primary_cancelled=primary in pending)
+                        return task.result()
+                raise first_error
+            finally:
+                # asyncio.wait درخواست‌ها را لغو نمی‌کند؛ با لغو engine (یا بازنده شدن) هیچ درخواستی رها نمی‌ماند
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+
+        async def _wait_for_hedge(self, primary: asyncio.Task, timing: dict) -> bool:
+            """
+            انتظار تا پایان درخواست اصلی یا گذشت آستانه hedge از ارسال آن به مدل؛
+            True یعنی درخواست اصلی هنوز در جریان است و hedge لازم است
+            """
+            delay = self.hedging.hedge_delay()
+            while True:
+                sent = timing.get('sent')
+                remaining = delay if sent is None else delay - (time.perf_counter() - sent)
+                if remaining <= 0:
+                    return True
+                done, _ = await asyncio.wait({primary}, timeout=remaining)
+                if done:
+                    return False
+
+        async def _call_model_async(self, payload: bytes, file_content: bytes, filename: str,
+                                    schema: dict = None, prompt: str = None, calibrate: bool = True,
+                                    client_key: Tuple = None, model: str = None, timing: dict = None) -> Dict:
+            """
+            یک تلاش asyncio: انتخاب کلید، فراخوانی مدل و ثبت آمار
+
+            timing (اختیاری) زمان ارسال ('sent') و تأخیر مدل ('seconds') را، بدون انتظار
+            rate limiter و ساخت کش زمینه، برای HedgingPolicy نگه می‌دارد.
+            """
+            cache_entry = None
+            current_api_key = None
+            reserved_tokens = self._request_tokens(file_content, schema)
+            try:
+                # کلید پس از رزرو قطعی می‌شود؛ کش زمینه باید برای همان کلید ساخته شود
+                client, current_api_key = await acquire_client_async(model or self.model_name, reserved_tokens,
+                                                                     client_key)
+                sent = False
+                try:
+                    if self.context_cache:
+                        cache_entry = await asyncio.to_thread(
+                            self._resolve_context_cache, client, current_api_key,
+                            schema or self.response_schema, prompt or self.prompt, model
+                        )
+                    call_start = time.perf_counter()
+                    if timing is not None:
+                        timing['sent'] = call_start
+                    request = self._build_request(payload, cache_entry, schema, prompt, model)
+                    sent = True
+                    if self.streaming and self._emits_summary(schema):
+                        response = await self._generate_streaming(client, request, filename)
+                    else:
+                        response = await client.aio.models.generate_content(**request)
+                except BaseException as e:
+                    # درخواستی که ارسال نشد یا سرور آن را رد کرد سهمیه مصرف نکرده است
+                    if not sent or is_rejected_request(e):
+                        rate_limiter.refund(current_api_key, model or self.model_name, reserved_tokens)
+                    raise
+                if timing is not None:
+                    timing['seconds'] = time.perf_counter() - call_start
+                rate_limiter.settle(current_api_key, model or self.model_name, reserved_tokens, response.usage_metadata)
+                if self.on_call:
+                    self.on_call(time.perf_counter() - call_start,
+                                 getattr(response.usage_metadata, 'total_token_count', None))
+                return self._after_call(current_api_key, cache_entry, response, time.perf_counter() - call_start,
+                                        file_content, filename, calibrate, schema, model)
+            except (ResponseQualityError, DailyQuotaExceededError):
+                raise
+            except Exception as e:
+                logger.error(f"Error: {str(e)}")
+                if self.on_call:
+                    self.on_call(0.0, error=e)
+                self._handle_context_cache_error(cache_entry, e)
+                if current_api_key:
+                    api_key_manager.mark_failure(current_api_key, e)
+                    api_key_manager.record_usage(self.session, failed=True)
+                raise
+
+        def _emits_summary(self, schema: dict = None) -> bool:
+            """فقط درخواست‌هایی که بخش خلاصه را تولید می‌کنند ارزش stream شدن دارند"""
+            if schema is None:
+                return True
+            return self.SECTION_KEYS[0] in schema['properties'][self.ROOT_KEY]['properties']
+
+        async def _generate_streaming(self, client, request: dict, filename: str) -> "StreamedResponse":
+            """
+            دریافت پاسخ به صورت stream؛ بخش خلاصه به محض کامل شدن از طریق on_partial
+            گزارش می‌شود، پیش از آن که کل چک‌لیست تولید شود
+            """
+            parser = IncrementalJSONParser([self.SECTION_KEYS[0]])
+            chunks = []
+            last_chunk = None
+            async for chunk in await client.aio.models.generate_content_stream(**request):
+                last_chunk = chunk
+                text = chunk.text
+                if not text:
+                    continue
+                chunks.append(text)
+                for key, value in parser.feed(text):
+                    if self.on_partial:
+                        self.on_partial(filename, key, value)
+            return StreamedResponse(''.join(chunks), last_chunk)
+
+        async def extract_table_from_page_async(self, file_content: bytes, filename: str) -> Dict:
+            """نسخه asyncio با کلاینت client.aio؛ در زمان انتظار هیچ threadی اشغال نمی‌شود"""
+
+            cached = self._get_cached(file_content, filename)
+            if cached is not None:
+                return cached
+
+            # پردازش PDF سنگین است؛ در thread جداگانه تا event loop مسدود نشود
+            payload, _ = await asyncio.to_thread(self.prepare_document, file_content, filename)
+
+            file_hash = hashlib.sha256(file_content).hexdigest()
+            if self.tiering and file_hash not in self.escalated_files:
+                data = await self.triage_async(payload, file_content, filename)
+                if data is not None:
+                    return self._store_result(file_content, filename, data)
+                # تلاش مجدد این فایل (مثلاً از صف AsyncExtractionEngine) مستقیماً به مدل اصلی می‌رود
+                self.escalated_files.add(file_hash)
+
+            async with self.tiering.slot(self.model_name) if self.tiering else contextlib.nullcontext():
+                data = await self.extract_primary_async(payload, file_content, filename)
+            return self._store_result(file_content, filename, data)
+
+        async def triage_async(self, payload: bytes, file_content: bytes, filename: str):
+            """
+            مرحله اول با مدل سبک؛ اگر نتیجه قابل قبول نباشد None برمی‌گرداند تا فایل
+            به مدل اصلی ارجاع شود
+            """
+            try:
+                async with self.tiering.slot(self.tiering.triage_model):
+                    logger.info(f"Triage {filename} with {self.tiering.triage_model}")
+                    data = await self._call_model_hedged(payload, file_content, filename, calibrate=False,
+                                                         model=self.tiering.triage_model)
+                reason = self.tiering.escalation_reason(data)
+            except ExtractionDefectError:
+                reason = 'validation'
+            except LowConfidenceError:
+                reason = 'low_confidence'
+            except Exception as e:
+                logger.warning(f"Triage failed for {filename}: {e}")
+                reason = 'error'
+            self.tiering.record_outcome(reason)
+            if reason is None:
+                return data
+            logger.info(f"⬆️ Escalating {filename} to {self.model_name} ({reason})")
+            return None
+
+        async def extract_primary_async(self, payload: bytes, file_content: bytes, filename: str) -> Dict:
+            """
+            استخراج با مدل اصلی: درخواست کامل یا موازی بخش‌ها، با ترمیم بخش‌های معیوب
+
+            خطاها بدون تلاش مجدد بالا می‌روند؛ تکرار فقط از صف AsyncExtractionEngine
+            (یا صف SQLite) و با backoff همان صف انجام می‌شود.
+            """
+            if self.section_parallel:
+                return await self.extract_sections_async(payload, file_content, filename)
+
+            # بخش‌های سالم تلاش قبلی همین فایل (وقتی ترمیم ناتمام بوده و صف آن را دوباره فرستاده است)
+            sections = self.partial_sections.pop(hashlib.sha256(file_content).hexdigest(), None)
+            if sections is not None:
+                return await self.repair_async(payload, file_content, filename, sections)
+
+            logger.info(f"Processing {filename}")
+            try:
+                return await self._call_model_hedged(payload, file_content, filename)
+            except ExtractionDefectError as defect:
+                logger.warning(f"{filename}: {defect}")
+                return await self.repair_async(payload, file_content, filename,
+                                               dict(defect.partial.get(self.ROOT_KEY, {})))
+
+        async def extract_sections_async(self, payload: bytes, file_content: bytes, filename: str) -> Dict:
+            """
+            استخراج سه بخش به صورت درخواست‌های همزمان و ادغام در ساختار اصلی
+
+            هر بخش schema فرعی خود را دارد و کلید جداگانه‌ای از APIKeyManager می‌گیرد؛
+            زمان هر فایل تقریباً برابر کندترین بخش است. بخش‌های موفق نگه داشته می‌شوند و
+            وقتی زمان‌بند بیرونی فایل را دوباره صف می‌کند فقط بخش ناموفق تکرار می‌شود.
+            """
+            # بخش‌های موفق تلاش قبلی همین فایل (وقتی زمان‌بند بیرونی آن را دوباره صف کرده است)
+            file_hash = hashlib.sha256(file_content).hexdigest()
+            sections = self.partial_sections.pop(file_hash, {})
+            broken, missing_topics = self._remaining_defects(sections) if sections else (list(self.SECTION_KEYS), [])
+            errors = {}
+
+            # بخش‌های معیوب دوباره و موضوعات جاافتاده چک‌لیست به تنهایی درخواست می‌شوند
+            plan = self._repair_plan(broken, missing_topics)
+            logger.info(f"Processing {filename} sections {[label for label, _, _ in plan]}")
+            outcomes = await asyncio.gather(
+                *[
+                    self._call_model_hedged(payload, file_content, filename,
+                                            schema=schema, prompt=prompt, calibrate=False)
+                    for _, schema, prompt in plan
+                ],
+                return_exceptions=True
+            )
+
+            for (label, _, _), outcome in zip(plan, outcomes):
+                if isinstance(outcome, ExtractionDefectError):
+                    errors[label] = outcome
+                    self._merge_sections(sections, outcome.partial)
+                elif isinstance(outcome, BaseException):
+                    errors[label] = outcome
+                else:
+                    self._merge_sections(sections, outcome)
+            broken, missing_topics = self._remaining_defects(sections)
+
+            if broken:
+                self.partial_sections[file_hash] = sections
+                failed = ", ".join(f"{section}: {errors.get(section)}" for section in broken)
+                # پاسخ ناقص مانند repair_async دوباره صف می‌شود؛ قابل تکرار بودن بقیه خطاها از متن خودشان تعیین می‌شود
+                incomplete = all(isinstance(errors.get(section), ExtractionDefectError) for section in broken)
+                raise Exception(f"{'Incomplete response, failed' if incomplete else 'Failed'} sections: {failed}") \
+                    from errors.get(broken[0])
+            if missing_topics:
+                logger.warning(f"⚠️ {filename}: checklist topics still missing: {', '.join(missing_topics)}")
+            return {self.ROOT_KEY: {section: sections[section] for section in self.SECTION_KEYS}}
+
+    async def process_single_file_async(analyzer, file_data, index, total, attempt=1, max_attempts=3):
+        """
+        پردازش یک فایل روی event loop به همراه زمان انتظار پیشنهادی سرور
+
+        هر فراخوانی یک تلاش است؛ تکرار بر عهده زمان‌بند فراخواننده است (needs_retry)
+
+        Returns:
+            tuple: (index, filename, result, error, needs_retry, retry_after)
+        """
+        filename = file_data['name'] if isinstance(file_data, dict) else file_data.name
+        file_content = file_data['content'] if isinstance(file_data, dict) else file_data.getvalue()
+
+        try:
+            logger.info(f"🔄 Processing {filename} - Attempt {attempt}/{max_attempts}")
+            result = await analyzer.extract_table_from_page_async(file_content, filename)
+            return (index, filename, result, None, False, None)
+        except Exception as e:
+            # برخی خطاهای اتصال پیام ندارند؛ خطای خالی نباید موفقیت بدون نتیجه تعبیر شود
+            error_msg = str(e) or type(e).__name__
+            logger.error(f"❌ Failed to process {filename} (Attempt {attempt}): {error_msg}")
+            needs_retry = attempt < max_attempts and is_retryable_error(error_msg)
+            return (index, filename, None, error_msg, needs_retry, retry_after_seconds(e))
+
+
+    class AdaptiveConcurrencyController:
+        """
+        کنترل پیوسته تعداد فایل‌های همزمان به روش AIMD
+
+        پس از هر پاسخ موفق با تأخیر عادی سقف همزمانی به اندازه step/limit افزایش می‌یابد
+        (حدود یک واحد به ازای هر دور کامل درخواست‌ها) و با خطای 429/503 یا جهش تأخیر
+        به صورت ضربی کاهش می‌یابد. تأخیر بر حسب ثانیه به ازای هزار توکن سنجیده می‌شود تا
+        فایل‌های بزرگ جهش تأخیر حساب نشوند. حداکثر یک کاهش در هر بازه cooldown اعمال
+        می‌شود تا یک موج خطا سقف را چند بار پشت سر هم نصف نکند.
+
+        همه متدها فقط از event loop صدا زده می‌شوند و نیازی به قفل ندارند.
+        """
+
+        OVERLOAD_PATTERNS = ['429', '503', 'resource exhausted', 'resource_exhausted', 'rate limit',
+                             'overloaded', 'unavailable']
+
+        def __init__(self, initial: int, min_limit: int = 1, max_limit: int = 50, increase_step: float = 1.0,
+                     decrease_factor: float = 0.5, latency_factor: float = 2.0, smoothing: float = 0.1):
+            """
+            Args:
+                initial: سقف اولیه (محاسبه شده از محدودیت‌های API)
+                min_limit / max_limit: بازه مجاز سقف همزمانی
+                increase_step: افزایش سقف به ازای هر دور کامل درخواست‌های موفق
+                decrease_factor: ضریب کاهش با خطای 429/503 (جهش تأخیر نصف این مقدار کاهش می‌دهد)
+                latency_factor: نسبت تأخیر به خط پایه که جهش حساب می‌شود
+                smoothing: ضریب میانگین متحرک نمایی خط پایه تأخیر
+            """
+            self.min_limit = max(1, min_limit)
+            self.max_limit = max(self.min_limit, max_limit)
+            self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+            self.increase_step = increase_step
+            self.decrease_factor = decrease_factor
+            self.latency_factor = latency_factor
+            self.smoothing = smoothing
+            self.in_flight = 0
+            self.waiters = deque()
+            self.baseline = None          # ثانیه به ازای هزار توکن
+            self.typical_seconds = None   # میانگین متحرک مدت هر فراخوانی
+            self.last_decrease = 0.0
+            self.start = time.monotonic()
+            self.history = [(0.0, self.limit, 0)]
+            self.stats = {'increases': 0, 'overload_cuts': 0, 'latency_cuts': 0, 'peak': self.limit}
+
+        async def acquire(self):
+            if self.in_flight < int(self.limit) and not self.waiters:
+                self.in_flight += 1
+            else:
+                waiter = asyncio.get_running_loop().create_future()
+                self.waiters.append(waiter)
+                try:
+                    await waiter   # ظرفیت در _wake برای این waiter رزرو می‌شود
+                except asyncio.CancelledError:
+                    if waiter.done() and not waiter.cancelled():
+                        self.release()
+                    raise
+            self._record()
+
+        def release(self):
+            self.in_flight -= 1
+            self._wake()
+
+        @contextlib.asynccontextmanager
+        async def slot(self):
+            await self.acquire()
+            try:
+                yield
+            finally:
+                self.release()
+
+        def _wake(self):
+            while self.waiters and self.in_flight < int(self.limit):
+                waiter = self.waiters.popleft()
+                if not waiter.done():
+                    self.in_flight += 1
+                    waiter.set_result(None)
+
+        def _record(self):
+            self.history.append((time.monotonic() - self.start, self.limit, self.in_flight))
+
+        def cooldown(self) -> float:
+            """فاصله حداقل بین دو کاهش: تقریباً زمان یک پاسخ عادی"""
+            return max(1.0, self.typical_seconds or 1.0)
+
+        def _decrease(self, factor: float, reason: str):
+            now = time.monotonic()
+            if now - self.last_decrease < self.cooldown():
+                return
+            self.last_decrease = now
+            self.limit = max(float(self.min_limit), self.limit * factor)
+            self.stats[reason] += 1
+            logger.info(f"📉 Concurrency limit cut to {self.limit:.1f} ({reason})")
+            self._record()
+
+        @classmethod
+        def is_overload(cls, error: BaseException) -> bool:
+            if getattr(error, 'code', None) in (429, 503):
+                return True
+            message = str(error).lower()
+            return any(pattern in message for pattern in cls.OVERLOAD_PATTERNS)
+
+        def observe(self, seconds: float, tokens: int = None, error: BaseException = None):
+            """ثبت نتیجه یک فراخوانی مدل"""
+            if error is not None:
+                if self.is_overload(error):
+                    self._decrease(self.decrease_factor, 'overload_cuts')
+                return
+
+            per_1k = seconds / max(1.0, (tokens or 1000) / 1000)
+            if self.baseline is None:
+                self.baseline = per_1k
+            elif per_1k > self.baseline * self.latency_factor:
+                self._decrease(1 - (1 - self.decrease_factor) / 2, 'latency_cuts')
+            elif self.limit < self.max_limit:
+                self.limit = min(float(self.max_limit), self.limit + self.increase_step / self.limit)
+                self.stats['increases'] += 1
+                self.stats['peak'] = max(self.stats['peak'], self.limit)
+                self._wake()
+                self._record()
+            self.baseline = (1 - self.smoothing) * self.baseline + self.smoothing * per_1k
+            self.typical_seconds = seconds if self.typical_seconds is None else \
+                (1 - self.smoothing) * self.typical_seconds + self.smoothing * seconds
+
+        def history_frame(self) -> pd.DataFrame:
+            # از thread اسکریپت Streamlit خوانده می‌شود؛ کپی لیست از تغییر هم‌زمان جلوگیری می‌کند
+            return pd.DataFrame(list(self.history), columns=['ثانیه', 'سقف همزمانی', 'فایل‌های در حال پردازش'])
+
+
+    class FairShareScheduler:
+        """
+        زمان‌بند سهم منصفانه بین تحلیلگرانی که از یک مجموعه کلید مشترک استفاده می‌کنند
+
+        هر فایل پیش از ارسال یک سهم از ظرفیت مشترک (بر حسب تعداد درخواست همزمان) می‌گیرد.
+        فایل‌های منتظر در صف جداگانه هر کاربر قرار می‌گیرند و سهم‌ها به روش Deficit Round
+        Robin با وزن هر کاربر (FAIR_SHARE_WEIGHTS) داده می‌شوند؛ بنابراین یک batch بزرگ
+        نمی‌تواند کار همکار دیگر را پشت سر خود نگه دارد. jobهای کوچک (حداکثر express_files
+        فایل) از خط سریع جداگانه و پیش از صف‌های عادی سهم می‌گیرند، اما حداکثر نیمی از ظرفیت.
+
+        ظرفیت ثابت نیست: بزرگ‌ترین سقف فعلی کنترل‌کننده‌های AIMD موتورهایی است که از زمان‌بند
+        استفاده می‌کنند (attach)، تا سقف ceiling. یک تحلیلگر تنها به اندازه سقف موتور خودش
+        درخواست می‌فرستد و زمان‌بند فقط هنگام رقابت، همان ظرفیت را بین کاربران تقسیم می‌کند.
+
+        acquire و release فقط از event loop صدا زده می‌شوند؛ آمار با قفل محافظت می‌شود
+        چون sidebar مدیر آن را از thread اسکریپت می‌خواند.
+        """
+
+        THROUGHPUT_WINDOW = 300.0   # ثانیه
+
+        def __init__(self, capacity: int = None, weights: Dict[str, float] = None, express_files: int = 5,
+                     express_reserved: int = 0, quantum: float = 1.0, ceiling: int = GEMINI_MAX_CONCURRENCY):
+            """
+            Args:
+                capacity: ظرفیت ثابت بر حسب درخواست‌های همزمان (پیش‌فرض: از سقف کنترل‌کننده‌های متصل)
+                ceiling: بیشترین ظرفیت (تعداد اتصال‌های همزمان مجاز فرایند)
+                weights: وزن هر کاربر (پیش‌فرض ۱)
+                express_files: بیشترین تعداد فایل یک job برای استفاده از خط سریع
+                express_reserved: ظرفیتی که فقط خط سریع می‌تواند از آن استفاده کند
+                quantum: سهم هر کاربر در هر دور (ضرب در وزن)
+            """
+            self.fixed_capacity = max(1, capacity) if capacity else None
+            self.ceiling = max(1, ceiling)
+            self.controllers = {}        # کنترل‌کننده همزمانی هر موتور فعال ← درخواست به ازای هر فایل
+            self.weights = weights or {}
+            self.express_files = express_files
+            self.express_reserved = express_reserved
+            self.quantum = quantum
+            self.in_flight = 0
+            self.express_in_flight = 0
+            self.queues = {}             # کاربر ← deque منتظرها
+            self.active = deque()        # ترتیب دور کاربران دارای منتظر
+            self.deficit = defaultdict(float)
+            self.turn_started = False
+            self.express = deque()
+            self.lock = threading.Lock()
+            self.stats = {}
+
+        @staticmethod
+        def parse_weights(spec: str) -> Dict[str, float]:
+            """'admin:2,fin.analyst:1' ← {'admin': 2.0, 'fin.analyst': 1.0}"""
+            weights = {}
+            for item in (spec or '').split(','):
+                user, _, weight = item.partition(':')
+                try:
+                    if user.strip():
+                        weights[user.strip()] = max(0.1, float(weight))
+                except ValueError:
+                    logger.warning(f"Invalid fair-share weight: {item}")
+            return weights
+
+        def weight(self, user: str) -> float:
+            return self.weights.get(user, 1.0)
+
+        @property
+        def capacity(self) -> int:
+            if self.fixed_capacity:
+                return self.fixed_capacity
+            with self.lock:
+                limits = [int(controller.limit) * cost for controller, cost in self.controllers.items()]
+            return max(1, min(self.ceiling, max(limits, default=self.ceiling)))
+
+        def attach(self, controller: "AdaptiveConcurrencyController", requests_per_file: int = 1):
+            """ثبت کنترل‌کننده یک موتور در حال اجرا تا ظرفیت از سقف آن پیروی کند"""
+            with self.lock:
+                self.controllers[controller] = requests_per_file
+
+        def detach(self, controller: "AdaptiveConcurrencyController"):
+            with self.lock:
+                self.controllers.pop(controller, None)
+            self._grant()
+
+        def is_express(self, num_files: int) -> bool:
+            return num_files <= self.express_files
+
+        def _user_stats(self, user: str) -> dict:
+            if user not in self.stats:
+                self.stats[user] = {'waiting': 0, 'in_flight': 0, 'granted': 0, 'completed': 0, 'express': 0,
+                                    'wait_seconds': 0.0, 'max_wait_seconds': 0.0, 'recent': deque()}
+            return self.stats[user]
+
+        async def acquire(self, user: str, cost: int = 1, express: bool = False) -> float:
+            """
+            انتظار تا گرفتن سهم برای ارسال یک فایل
+
+            Returns:
+                float: ثانیه‌های انتظار در صف
+            """
+            waiter = {'future': asyncio.get_running_loop().create_future(), 'user': user, 'cost': cost, 'express': express,
+                      'enqueued': time.monotonic()}
+            if express:
+                self.express.append(waiter)
+            else:
+                # صف خالی کاربری که هنوز در دور active است دوباره به دور اضافه نمی‌شود (دو نوبت در هر دور)
+                if user not in self.active:
+                    self.active.append(user)
+                self.queues.setdefault(user, deque()).append(waiter)
+            with self.lock:
+                self._user_stats(user)['waiting'] += 1
+            self._grant()
+            try:
+                await waiter['future']
+            except asyncio.CancelledError:
+                if waiter['future'].done() and not waiter['future'].cancelled():
+                    self.release(user, cost, express, completed=False)
+                else:
+                    with self.lock:
+                        self._user_stats(user)['waiting'] -= 1
+                raise
+            waited = time.monotonic() - waiter['enqueued']
+            with self.lock:
+                stats = self._user_stats(user)
+                stats['wait_seconds'] += waited
+                stats['max_wait_seconds'] = max(stats['max_wait_seconds'], waited)
+            return waited
+
+        def release(self, user: str, cost: int = 1, express: bool = False, completed: bool = True):
+            self.in_flight -= cost
+            if express:
+                self.express_in_flight -= cost
+            with self.lock:
+                stats = self._user_stats(user)
+                stats['in_flight'] -= 1
+                if completed:
+                    stats['completed'] += 1
+                    stats['recent'].append(time.monotonic())
+            self._grant()
+
+        def _start(self, waiter: dict):
+            self.in_flight += waiter['cost']
+            if waiter['express']:
+                self.express_in_flight += waiter['cost']
+            with self.lock:
+                stats = self._user_stats(waiter['user'])
+                stats['waiting'] -= 1
+                stats['in_flight'] += 1
+                stats['granted'] += 1
+                stats['express'] += int(waiter['express'])
+            waiter['future'].set_result(None)
+
+        def _fits(self, cost: int, limit: int) -> bool:
+            # فایلی که به تنهایی از ظرفیت بزرگ‌تر است وقتی ظرفیت خالی است ارسال می‌شود تا صف قفل نشود
+            return self.in_flight + cost <= limit or self.in_flight == 0
+
+        def _grant(self):
+            while self.in_flight < self.capacity:
+                # منتظرهای لغو شده در ابتدای صف‌ها نادیده گرفته می‌شوند
+                while self.express and self.express[0]['future'].done():
+                    self.express.popleft()
+                if self.express and self.express_in_flight < max(1, self.capacity // 2) \
+                        and self._fits(self.express[0]['cost'], self.capacity):
+                    self._start(self.express.popleft())
+                    continue
+                if not self.active:
+                    return
+                user = self.active[0]
+                queue = self.queues[user]
+                while queue and queue[0]['future'].done():
+                    queue.popleft()
+                if not queue:
+                    self.active.popleft()
+                    self.deficit[user] = 0.0
+                    self.turn_started = False
+                    continue
+                if not self.turn_started:
+                    self.deficit[user] += self.quantum * self.weight(user)
+                    self.turn_started = True
+                head = queue[0]
+                if head['cost'] > self.deficit[user]:
+                    # سهم این دور تمام شده است؛ نوبت کاربر بعدی
+                    self.active.rotate(-1)
+                    self.turn_started = False
+                    continue
+                if not self._fits(head['cost'], self.capacity - self.express_reserved):
+                    return
+                queue.popleft()
+                self.deficit[user] -= head['cost']
+                self._start(head)
+
+        @staticmethod
+        def interleave(candidates: List[dict], load: Dict[str, float], weight, limit: int) -> List[dict]:
+            """
+            ترتیب منصفانه وظایف صف مشترک: ابتدا خط سریع، سپس هر بار کاربری که کمترین بار
+            در حال اجرا (تقسیم بر وزن) را دارد. candidates به ترتیب آماده شدن هستند و کلیدهای
+            owner، express و requests دارند.
+            """
+            picked = [task for task in candidates if task['express']][:limit]
+            by_owner = defaultdict(deque)
+            for task in candidates:
+                if not task['express']:
+                    by_owner[task['owner']].append(task)
+            load = defaultdict(float, load)
+            while len(picked) < limit and by_owner:
+                owner = min(by_owner, key=lambda owner: (load[owner] / weight(owner), by_owner[owner][0]['seq']))
+                task = by_owner[owner].popleft()
+                if not by_owner[owner]:
+                    del by_owner[owner]
+                load[owner] += task['requests']
+                picked.append(task)
+            return picked
+
+        def report(self) -> List[dict]:
+            """آمار هر کاربر برای نمایش به مدیر"""
+            now = time.monotonic()
+            rows = []
+            with self.lock:
+                for user, stats in self.stats.items():
+                    while stats['recent'] and now - stats['recent'][0] > self.THROUGHPUT_WINDOW:
+                        stats['recent'].popleft()
+                    rows.append({
+                        'user': user,
+                        'weight': self.weight(user),
+                        'waiting': stats['waiting'],
+                        'in_flight': stats['in_flight'],
+                        'completed': stats['completed'],
+                        'express': stats['express'],
+                        'files_per_min': len(stats['recent']) * 60 / self.THROUGHPUT_WINDOW,
+                        'avg_wait': stats['wait_seconds'] / stats['granted'] if stats['granted'] else 0.0,
+                        'max_wait': stats['max_wait_seconds']
+                    })
+            return rows
+
+    @st.cache_resource
+    def get_fair_scheduler():
+        """یک زمان‌بند برای کل فرایند؛ همه sessionها و jobهای پس‌زمینه سهم خود را از آن می‌گیرند"""
+        # بدون FAIR_SHARE_CAPACITY ظرفیت از سقف AIMD موتورهای فعال (تا GEMINI_MAX_CONCURRENCY) پیروی می‌کند
+        return FairShareScheduler(
+            capacity=int(os.getenv("FAIR_SHARE_CAPACITY", "0")) or None,
+            weights=FairShareScheduler.parse_weights(os.getenv("FAIR_SHARE_WEIGHTS", "")),
+            express_files=int(os.getenv("FAIR_SHARE_EXPRESS_FILES", "5")),
+            express_reserved=int(os.getenv("FAIR_SHARE_EXPRESS_RESERVED", "0"))
+        )
+
+
+    class AsyncExtractionEngine:
+        """
+        موتور پردازش همزمان مبتنی بر asyncio
+
+        به جای یک thread برای هر درخواست، همه درخواست‌ها روی یک event loop اجرا
+        می‌شوند و تعداد فایل‌های همزمان با AdaptiveConcurrencyController در طول کل
+        batch تنظیم می‌شود. تلاش‌های مجدد در همان صف و با backoff جداگانه هر فایل انجام
+        می‌شوند، نه در دورهای جداگانه.
+        خروجی هر فایل همان tuple تابع process_single_file_async است.
+        """
+
+        BASE_BACKOFF = 2.0     # ثانیه
+        MAX_BACKOFF = 60.0
+
+        def __init__(self, analyzer, max_concurrency: int, max_attempts: int = 3, max_limit: int = None,
+                     scheduler: "FairShareScheduler" = None, user: str = None, express: bool = False):
+            """
+            Args:
+                analyzer: نمونه FinancialAnalyzer
+                max_concurrency: سقف اولیه درخواست‌های همزمان
+                max_attempts: حداکثر تعداد تلاش برای هر فایل
+                max_limit: بیشترین سقفی که کنترل‌کننده می‌تواند به آن برسد (پیش‌فرض: برابر سقف اولیه)
+                scheduler: زمان‌بند سهم منصفانه مشترک؛ هر فایل پیش از ارسال از آن سهم می‌گیرد
+                user: کاربری که سهم به نام او حساب می‌شود
+                express: استفاده از خط سریع زمان‌بند (jobهای کوچک)
+            """
+            self.analyzer = analyzer
+            self.scheduler = scheduler
+            self.user = user
+            self.express = express
+            self.requests_per_file = len(FinancialAnalyzer.SECTION_KEYS) if analyzer.section_parallel else 1
+            self.max_concurrency = max(1, max_concurrency)
+            self.max_attempts = max_attempts
+            self.controller = AdaptiveConcurrencyController(
+                self.max_concurrency, max_limit=max_limit or self.max_concurrency
+            )
+            analyzer.on_call = self.controller.observe
+            self.cancelled = False
+            self.cancel_stats = {'not_dispatched': 0, 'aborted': 0, 'freed_requests': 0}
+            self._refunded_before = 0
+            self._loop = None
+            self._running = set()
+            self._wakeup = None
+
+        def cancel(self):
+            """
+            لغو همکارانه از هر thread: توقف ارسال فایل‌های جدید (از جمله تلاش‌های مجدد در
+            انتظار backoff) و لغو درخواست‌های در حال اجرا. نتایج کامل شده دست نمی‌خورند و
+            رزرو درخواست‌هایی که هنوز ارسال نشده‌اند به rate limiter برمی‌گردد.
+            """
+            self.cancelled = True
+            self._refunded_before = rate_limiter.snapshot()['refunded']
+            if self._loop is not None and not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self._abort_running)
+
+        def _abort_running(self):
+            for task in list(self._running):
+                task.cancel()
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+        @classmethod
+        def backoff(cls, attempt: int, retry_after: float = None) -> float:
+            """
+            تأخیر تا تلاش بعدی یک فایل: زمان پیشنهادی سرور (Retry-After / RetryInfo) در صورت وجود،
+            وگرنه backoff نمایی با jitter تا همه فایل‌های ناموفق همزمان برنگردند
+            """
+            if retry_after is not None:
+                return min(cls.MAX_BACKOFF, max(0.0, retry_after))
+            return min(cls.MAX_BACKOFF, cls.BASE_BACKOFF * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+        async def run(self, uploaded_files: list, on_result, on_retry=None, order: List[int] = None):
+            """
+            پردازش کامل با یک صف اولویت واحد
+
+            هر فایل ناموفق با زمان آماده شدن خود به صف برمی‌گردد و بقیه فایل‌ها بدون توقف
+            ادامه می‌یابند؛ هیچ slot همزمانی در زمان انتظار backoff اشغال نمی‌شود. فایل‌ها به
+            ترتیب زمان آماده شدن (و سپس ترتیب ورود) برداشته می‌شوند.
+
+            callbackها از thread مربوط به event loop صدا زده می‌شوند و نباید مستقیماً
+            Streamlit را به‌روزرسانی کنند.
+
+            Args:
+                uploaded_files: لیست فایل‌ها
+                on_result: callback با ورودی (outcome, attempt, retry_scheduled)
+                on_retry: callback با ورودی (filename, next_attempt, delay)
+                order: ترتیب ارسال اولیه فایل‌ها (اندیس‌ها؛ پیش‌فرض ترتیب لیست)
+            """
+            total = len(uploaded_files)
+            loop = asyncio.get_running_loop()
+            order = range(total) if order is None else order
+            ready_queue = [(0.0, seq, index, 1) for seq, index in enumerate(order)]   # (ready_at, seq, index, attempt)
+            heapq.heapify(ready_queue)
+            sequence = itertools.count(total)
+            running = set()
+            wakeup = asyncio.Event()
+            aborted = []
+            unsent = []    # فایل‌هایی که در صف زمان‌بند سهم منصفانه لغو شدند
+            self._loop, self._running, self._wakeup = loop, running, wakeup
+            if self.scheduler is not None:
+                self.scheduler.attach(self.controller, self.requests_per_file)
+
+            async def run_one(index, attempt):
+                granted = self.scheduler is None
+                try:
+                    if not granted:
+                        await self.scheduler.acquire(self.user, self.requests_per_file, self.express)
+                        granted = True
+                    outcome = await process_single_file_async(
+                        self.analyzer, uploaded_files[index], index, total, attempt, self.max_attempts
+                    )
+                except asyncio.CancelledError:
+                    (aborted if granted else unsent).append(index)
+                    raise
+                finally:
+                    if granted and self.scheduler is not None:
+                        self.scheduler.release(self.user, self.requests_per_file, self.express)
+                    self.controller.release()
+                retry_scheduled = bool(outcome[3]) and outcome[4] and attempt < self.max_attempts
+                if retry_scheduled:
+                    delay = self.backoff(attempt, outcome[5])
+                    heapq.heappush(ready_queue, (loop.time() + delay, next(sequence), index, attempt + 1))
+                    if on_retry:
+                        on_retry(outcome[1], attempt + 1, delay)
+                on_result(outcome[:5], attempt, retry_scheduled)
+
+            def on_done(task):
+                # بیدار کردن حلقه پس از خروج task از running (نه قبل از آن)
+                running.discard(task)
+                wakeup.set()
+
+            try:
+                while (ready_queue or running) and not self.cancelled:
+                    if ready_queue and ready_queue[0][0] <= loop.time():
+                        await self.controller.acquire()
+                        if self.cancelled:
+                            self.controller.release()
+                            break
+                        # در زمان انتظار برای slot ممکن است فایل زودتر آماده‌ای به صف اضافه شده باشد
+                        _, _, index, attempt = heapq.heappop(ready_queue)
+                        task = asyncio.create_task(run_one(index, attempt))
+                        running.add(task)
+                        task.add_done_callback(on_done)
+                        continue
+                    wakeup.clear()
+                    timeout = ready_queue[0][0] - loop.time() if ready_queue else None
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+
+                if self.cancelled:
+                    self._abort_running()
+                    if running:
+                        await asyncio.gather(*running, return_exceptions=True)
+                    # فایل‌های ارسال نشده (از جمله تلاش‌های مجدد در انتظار) و درخواست‌هایی که پیش از ارسال لغو شدند
+                    not_dispatched = len(ready_queue) + len(unsent)
+                    self.cancel_stats = {
+                        'not_dispatched': not_dispatched,
+                        'aborted': len(aborted),
+                        'freed_requests': not_dispatched * self.requests_per_file +
+                                          rate_limiter.snapshot()['refunded'] - self._refunded_before
+                    }
+                    ready_queue.clear()
+            finally:
+                if self.scheduler is not None:
+                    self.scheduler.detach(self.controller)
+            return self.cancel_stats
+
+
+    class SQLiteTaskQueue:
+        """
+        صف مشترک وظایف استخراج در SQLite (روی دیسک مشترک بین replicaها)
+
+        هر replica فایل‌های job خود را به صف اضافه می‌کند و workerها (در هر node) وظایف را
+        با lease برمی‌دارند. برداشتن وظیفه در یک تراکنش BEGIN IMMEDIATE انجام می‌شود و همان‌جا
+        سقف‌های سراسری اعمال می‌شوند: تعداد وظایف در حال اجرا و مجموع درخواست و توکن
+        ارسال شده در ۶۰ ثانیه اخیر روی همه workerها. وظیفه worker از کار افتاده پس از پایان
+        lease دوباره قابل برداشتن است.
+        """
+
+        def __init__(self, db_path: str, lease_seconds: float = 300.0):
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self.db_path = db_path
+            self.lease_seconds = lease_seconds
+            with contextlib.closing(self._connect()) as conn:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS batches (
+                        batch_id TEXT PRIMARY KEY,
+                        settings TEXT NOT NULL,
+                        created_at REAL NOT NULL,
+                        owner TEXT,
+                        express INTEGER NOT NULL DEFAULT 0
+                    )
+                """)
+                # صف‌های ساخته شده پیش از زمان‌بندی سهم منصفانه
+                for column in ('owner TEXT', 'express INTEGER NOT NULL DEFAULT 0'):
+                    with contextlib.suppress(sqlite3.OperationalError):
+                        conn.execute(f'ALTER TABLE batches ADD COLUMN {column}')
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS tasks (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        batch_id TEXT NOT NULL,
+                        position INTEGER NOT NULL,
+                        name TEXT NOT NULL,
+                        content BLOB NOT NULL,
+                        tokens INTEGER NOT NULL DEFAULT 0,
+                        requests INTEGER NOT NULL DEFAULT 1,
+                        state TEXT NOT NULL DEFAULT 'queued',
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        max_attempts INTEGER NOT NULL DEFAULT 5,
+                        ready_at REAL NOT NULL DEFAULT 0,
+                        worker TEXT,
+                        lease_expires REAL,
+                        result TEXT,
+                        error TEXT,
+                        summary TEXT,
+                        updated_at REAL NOT NULL DEFAULT 0
+                    )
+                """)
+                conn.execute('CREATE INDEX IF NOT EXISTS tasks_ready ON tasks (state, ready_at)')
+                conn.execute('CREATE INDEX IF NOT EXISTS tasks_batch ON tasks (batch_id)')
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS dispatches (
+                        ts REAL NOT NULL,
+                        requests INTEGER NOT NULL,
+                        tokens INTEGER NOT NULL
+                    )
+                """)
+
+        def _connect(self):
+            return sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+
+        def enqueue(self, batch_id: str, tasks: List[dict], settings: dict, max_attempts: int = 5,
+                    owner: str = None, express: bool = False):
+            """
+            Args:
+                tasks: لیست dict با کلیدهای position، name، content و در صورت وجود tokens و requests
+                settings: تنظیمات analyzer که workerها با آن فایل‌های این batch را پردازش می‌کنند
+                owner / express: کاربر صاحب batch و استفاده از خط سریع در ترتیب سهم منصفانه
+            """
+            now = time.time()
+            with contextlib.closing(self._connect()) as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute(
+                    'INSERT OR REPLACE INTO batches (batch_id, settings, created_at, owner, express) VALUES (?, ?, ?, ?, ?)',
+                    (batch_id, json.dumps(settings, ensure_ascii=False), now, owner, int(express))
+                )
+                conn.executemany("""
+                    INSERT INTO tasks (batch_id, position, name, content, tokens, requests, max_attempts, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, [(batch_id, task['position'], task['name'], task['content'], int(task.get('tokens', 0)),
+                       int(task.get('requests', 1)), max_attempts, now) for task in tasks])
+                conn.execute('COMMIT')
+
+        def claim(self, worker_id: str, limit: int, max_in_flight: int = None,
+                  requests_per_min: int = None, tokens_per_min: int = None,
+                  weights: Dict[str, float] = None) -> List[dict]:
+            """
+            برداشتن حداکثر limit وظیفه آماده با رعایت سقف‌های سراسری
 
-            prompt =  """لطفاً گزارش حسابرس را تحلیل کنید. نکته بسیار مهم برای بخش۳_چک_لیست_موضوعی:
-            - باید تمام  موضوع ها را چک کنید و در خروجی بیاورید
-            - برای هر موضوع، فیلد "در_گزارش_آمده" را مشخص کنید (true یا false)
-            - همه موضوع ها باید در آرایه بخش۳_چک_لیست_موضوعی باشند"""
-            
-            for attempt in range(max_retries):
-                try:
-                    client, current_api_key = get_client_with_retry()
-                    logger.info(f"Processing {filename} - Attempt {attempt + 1}")
-                    response = client.models.generate_content(
-                        model="gemini-2.5-flash",
-                        contents=[types.Part.from_bytes(data=file_content, mime_type="application/pdf"), prompt],
-                        config={
-                            'system_instruction': "شما تحلیلگر مالی هستید.",
-                            "response_mime_type": "application/json",
-                            "response_schema": self.response_schema,
-                            "temperature": 0.5
-                        }
+            وظایف به ترتیب سهم منصفانه برداشته می‌شوند: ابتدا batchهای خط سریع، سپس هر بار
+            کاربری که کمترین درخواست در حال اجرا (تقسیم بر وزن او) را روی همه workerها دارد.
+
+            Returns:
+                لیست dict وظایف (به همراه settings مربوط به batch)
+            """
+            now = time.time()
+            claimed = []
+            with contextlib.closing(self._connect()) as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('DELETE FROM dispatches WHERE ts < ?', (now - 60,))
+                if max_in_flight:
+                    in_flight = conn.execute(
+                        "SELECT COUNT(*) FROM tasks WHERE state = 'leased' AND lease_expires > ?", (now,)
+                    ).fetchone()[0]
+                    limit = min(limit, max_in_flight - in_flight)
+                sent_requests, sent_tokens = conn.execute(
+                    'SELECT COALESCE(SUM(requests), 0), COALESCE(SUM(tokens), 0) FROM dispatches'
+                ).fetchone()
+                limit = max(0, limit)
+                # interleave از هر کاربر (و هر خط) حداکثر limit وظیفه برمی‌دارد؛ بقیه صف خوانده نمی‌شود
+                candidates = [{'id': task_id, 'owner': owner, 'express': bool(express), 'requests': requests, 'seq': seq}
+                              for seq, (task_id, owner, express, requests) in enumerate(conn.execute("""
+                    SELECT id, owner, express, requests FROM (
+                        SELECT t.id, b.owner, b.express, t.requests, t.ready_at,
+                               ROW_NUMBER() OVER (PARTITION BY b.owner, b.express ORDER BY t.ready_at, t.id) AS rank
+                        FROM tasks t JOIN batches b ON b.batch_id = t.batch_id
+                        WHERE (t.state = 'queued' AND t.ready_at <= ?) OR (t.state = 'leased' AND t.lease_expires <= ?)
+                    ) WHERE rank <= ?
+                    ORDER BY ready_at, id
+                """, (now, now, limit)).fetchall())] if limit else []
+                load = dict(conn.execute("""
+                    SELECT b.owner, SUM(t.requests) FROM tasks t JOIN batches b ON b.batch_id = t.batch_id
+                    WHERE t.state = 'leased' AND t.lease_expires > ? GROUP BY b.owner
+                """, (now,)).fetchall())
+                weights = weights or {}
+                picked = [task['id'] for task in FairShareScheduler.interleave(
+                    candidates, load, lambda owner: weights.get(owner, 1.0), limit
+                )]
+                by_id = {row[0]: row for row in conn.execute(f"""
+                    SELECT t.id, t.batch_id, t.position, t.name, t.content, t.tokens, t.requests, t.attempts,
+                           t.max_attempts, b.settings
+                    FROM tasks t JOIN batches b ON b.batch_id = t.batch_id
+                    WHERE t.id IN ({','.join('?' * len(picked))})
+                """, picked).fetchall()} if picked else {}
+                rows = [by_id[task_id] for task_id in picked]
+                for row in rows:
+                    task_id, batch_id, position, name, content, tokens, requests, attempts, max_attempts, settings = row
+                    # وظیفه اول حتی اگر به تنهایی از سقف بیشتر باشد ارسال می‌شود تا صف قفل نشود
+                    if sent_requests and (
+                            (requests_per_min and sent_requests + requests > requests_per_min) or
+                            (tokens_per_min and sent_tokens + tokens > tokens_per_min)):
+                        break
+                    sent_requests += requests
+                    sent_tokens += tokens
+                    conn.execute("""
+                        UPDATE tasks SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1,
+                                         updated_at = ? WHERE id = ?
+                    """, (worker_id, now + self.lease_seconds, now, task_id))
+                    conn.execute('INSERT INTO dispatches VALUES (?, ?, ?)', (now, requests, tokens))
+                    claimed.append({
+                        'id': task_id, 'batch_id': batch_id, 'position': position, 'name': name,
+                        'content': content, 'tokens': tokens, 'attempt': attempts + 1,
+                        'max_attempts': max_attempts, 'settings': json.loads(settings)
+                    })
+                conn.execute('COMMIT')
+            return claimed
+
+        def heartbeat(self, worker_id: str, task_ids: List[int]):
+            """تمدید lease وظایف در حال اجرای یک worker"""
+            if not task_ids:
+                return
+            with contextlib.closing(self._connect()) as conn:
+                conn.execute(
+                    f"UPDATE tasks SET lease_expires = ? WHERE worker = ? AND state = 'leased' "
+                    f"AND id IN ({','.join('?' * len(task_ids))})",
+                    (time.time() + self.lease_seconds, worker_id, *task_ids)
+                )
+
+        def complete(self, task_id: int, worker_id: str, result: dict) -> bool:
+            """
+            ثبت نتیجه فقط اگر این worker هنوز lease معتبر وظیفه را داشته باشد
+
+            Returns:
+                bool: False یعنی lease منقضی شده یا وظیفه به worker دیگری رسیده (یا لغو شده) و نتیجه کنار گذاشته شد
+            """
+            now = time.time()
+            with contextlib.closing(self._connect()) as conn:
+                updated = conn.execute(
+                    "UPDATE tasks SET state = 'done', result = ?, error = NULL, updated_at = ? "
+                    "WHERE id = ? AND worker = ? AND state = 'leased' AND lease_expires > ?",
+                    (json.dumps(result, ensure_ascii=False), now, task_id, worker_id, now)
+                ).rowcount
+            return updated > 0
+
+        def fail(self, task_id: int, worker_id: str, error: str, retry_at: float = None):
+            """ثبت خطا؛ با retry_at وظیفه دوباره در صف قرار می‌گیرد و بدون آن نهایی می‌شود"""
+            with contextlib.closing(self._connect()) as conn:
+                if retry_at is None:
+                    conn.execute(
+                        "UPDATE tasks SET state = 'failed', error = ?, updated_at = ? "
+                        "WHERE id = ? AND worker = ? AND state = 'leased'",
+                        (error, time.time(), task_id, worker_id)
+                    )
+                else:
+                    conn.execute(
+                        "UPDATE tasks SET state = 'queued', error = ?, ready_at = ?, worker = NULL, updated_at = ? "
+                        "WHERE id = ? AND worker = ? AND state = 'leased'",
+                        (error, retry_at, time.time(), task_id, worker_id)
                     )
-                    if not response or not response.text:
-                        raise ValueError("API response was empty")
-                    data = json.loads(response.text)
-                    api_key_manager.mark_success(current_api_key)
-                    logger.info(f"Successfully processed {filename}")
-                    return data
-                except Exception as e:
-                    logger.error(f"Error: {str(e)}")
-                    api_key_manager.mark_failure(current_api_key)
-                    if attempt < max_retries - 1:
-                        time.sleep(min(15, (2 ** attempt)))
-                    else:
-                        raise
-            raise Exception(f"Failed after {max_retries} attempts")
 
-    # ========================================================================
-    # ✅ تابع جدید: پردازش همزمان با ThreadPoolExecutor
-    # ========================================================================
+        def set_summary(self, task_id: int, summary: dict):
+            with contextlib.closing(self._connect()) as conn:
+                conn.execute('UPDATE tasks SET summary = ? WHERE id = ?',
+                             (json.dumps(summary, ensure_ascii=False), task_id))
+
+        def batch_status(self, batch_id: str, since: float = 0.0) -> List[dict]:
+            """وظایف batch که پس از since تغییر کرده‌اند (بدون محتوای PDF)"""
+            with contextlib.closing(self._connect()) as conn:
+                rows = conn.execute("""
+                    SELECT id, position, state, attempts, error, result, summary, updated_at
+                    FROM tasks WHERE batch_id = ? AND updated_at > ?
+                """, (batch_id, since)).fetchall()
+            return [{
+                'id': task_id, 'position': position, 'state': state, 'attempts': attempts, 'error': error,
+                'result': json.loads(result) if result else None,
+                'summary': json.loads(summary) if summary else None, 'updated_at': updated_at
+            } for task_id, position, state, attempts, error, result, summary, updated_at in rows]
+
+        def cancel(self, batch_id: str) -> dict:
+            """
+            لغو وظایف باقی‌مانده batch: وظایف در صف دیگر برداشته نمی‌شوند و workerهایی که
+            وظیفه‌ای از آن را در حال اجرا دارند در دور بعدی حلقه خود آن را قطع می‌کنند
+
+            Returns:
+                dict: {'not_dispatched', 'aborted', 'freed_requests'}
+            """
+            now = time.time()
+            with contextlib.closing(self._connect()) as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                queued, freed = conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(requests), 0) FROM tasks WHERE batch_id = ? AND state = 'queued'",
+                    (batch_id,)
+                ).fetchone()
+                aborted = conn.execute(
+                    "SELECT COUNT(*) FROM tasks WHERE batch_id = ? AND state = 'leased'", (batch_id,)
+                ).fetchone()[0]
+                conn.execute(
+                    "UPDATE tasks SET state = 'cancelled', updated_at = ? WHERE batch_id = ? AND state IN ('queued', 'leased')",
+                    (now, batch_id)
+                )
+                conn.execute('COMMIT')
+            return {'not_dispatched': queued, 'aborted': aborted, 'freed_requests': freed}
+
+        def cancelled(self, task_ids: List[int]) -> List[int]:
+            """وظایفی از task_ids که لغو یا حذف شده‌اند"""
+            if not task_ids:
+                return []
+            with contextlib.closing(self._connect()) as conn:
+                alive = {row[0] for row in conn.execute(
+                    f"SELECT id FROM tasks WHERE state != 'cancelled' AND id IN ({','.join('?' * len(task_ids))})",
+                    task_ids
+                ).fetchall()}
+            return [task_id for task_id in task_ids if task_id not in alive]
+
+        def purge(self, batch_id: str, positions: List[int] = None):
+            """حذف وظایف batch (یا فقط positions)"""
+            with contextlib.closing(self._connect()) as conn:
+                if positions is None:
+                    conn.execute('DELETE FROM tasks WHERE batch_id = ?', (batch_id,))
+                    conn.execute('DELETE FROM batches WHERE batch_id = ?', (batch_id,))
+                else:
+                    conn.executemany('DELETE FROM tasks WHERE batch_id = ? AND position = ?',
+                                     [(batch_id, position) for position in positions])
+
+        def owner_stats(self) -> Dict[str, dict]:
+            """تعداد وظایف در صف و در حال اجرای هر کاربر: {owner: {'queued', 'leased'}}"""
+            owners = defaultdict(lambda: {'queued': 0, 'leased': 0})
+            with contextlib.closing(self._connect()) as conn:
+                for owner, state, count in conn.execute("""
+                    SELECT b.owner, t.state, COUNT(*) FROM tasks t JOIN batches b ON b.batch_id = t.batch_id
+                    WHERE t.state IN ('queued', 'leased') GROUP BY b.owner, t.state
+                """).fetchall():
+                    owners[owner][state] = count
+            return dict(owners)
+
+        def stats(self) -> dict:
+            """تعداد وظایف در هر وضعیت و workerهای دارای lease فعال"""
+            now = time.time()
+            with contextlib.closing(self._connect()) as conn:
+                counts = dict(conn.execute('SELECT state, COUNT(*) FROM tasks GROUP BY state').fetchall())
+                workers = conn.execute(
+                    "SELECT COUNT(DISTINCT worker) FROM tasks WHERE state = 'leased' AND lease_expires > ?", (now,)
+                ).fetchone()[0]
+            return {'states': counts, 'workers': workers}
+
+
+    class LocalTaskQueue(SQLiteTaskQueue):
+        """
+        جایگزین محلی صف مشترک برای اجرای تک replica: همان SQLiteTaskQueue در پوشه کش محلی
+        که وظایف آن را worker داخلی همین فرایند اجرا می‌کند
+        """
+
+        def __init__(self, lease_seconds: float = 300.0):
+            super().__init__(
+                os.path.join(os.getenv("ANALYSIS_CACHE_DIR", ".analysis_cache"), 'local_task_queue.sqlite3'),
+                lease_seconds=lease_seconds
+            )
+
 
-    def process_single_file(analyzer, file_data, index, total, attempt=1, max_attempts=3):
+    class ExtractionWorker:
         """
-        پردازش یک فایل با قابلیت retry خودکار
-        
-        Args:
-            analyzer: نمونه FinancialAnalyzer
-            file_data: داده فایل (dict یا file object)
-            index: شماره فایل
-            total: تعداد کل فایل‌ها
-            attempt: تلاش فعلی (1، 2، 3)
-            max_attempts: حداکثر تعداد تلاش
-        
-        Returns:
-            tuple: (index, filename, result, error, needs_retry)
+        worker صف مشترک: برداشتن وظایف، اجرای extract_table_from_page با همان مسیر
+        process_single_file_async و ثبت نتیجه یا زمان تلاش مجدد در صف
+
+        تعداد وظایف همزمان هر worker با AdaptiveConcurrencyController تنظیم می‌شود و
+        سقف‌های سراسری (همزمانی، RPM و TPM مجموع کلیدها) در خود صف اعمال می‌شوند.
         """
-        filename = file_data['name'] if isinstance(file_data, dict) else file_data.name
-        file_content = file_data['content'] if isinstance(file_data, dict) else file_data.getvalue()
-        
-        try:
-            logger.info(f"🔄 Processing {filename} - Attempt {attempt}/{max_attempts}")
-            result = analyzer.extract_table_from_page(file_content, filename)
-            return (index, filename, result, None, False)  # ✅ اضافه شدن False
-        except Exception as e:
-            error_msg = str(e)
-            logger.error(f"❌ Failed to process {filename} (Attempt {attempt}): {error_msg}")
-            
-            # بررسی اینکه آیا نیاز به retry دارد یا نه
-            needs_retry = attempt < max_attempts and is_retryable_error(error_msg)
-            
-            return (index, filename, None, error_msg, needs_retry)  # ✅ اضافه شدن needs_retry
-        
+
+        POLL_SECONDS = 1.0
+        # (batch_id, position) وظیفه‌ای که coroutine جاری برای آن اجرا می‌شود؛ analyzer بین batchها مشترک است
+        # و on_partial فقط نام فایل را می‌دهد
+        CURRENT_TASK = contextvars.ContextVar('extraction_task', default=None)
+
+        def __init__(self, task_queue: SQLiteTaskQueue, concurrency: int = 4, worker_id: str = None,
+                     max_in_flight: int = None):
+            """
+            محدودیت هر کلید همان API_LIMITS فرایند است (متغیرهای محیطی GEMINI_RPM/TPM/RPD)
+
+            Args:
+                max_in_flight: سقف سراسری وظایف در حال اجرا روی همه workerها
+            """
+            self.task_queue = task_queue
+            self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{hashlib.sha256(os.urandom(4)).hexdigest()[:4]}"
+            self.controller = AdaptiveConcurrencyController(concurrency, max_limit=concurrency)
+            self.max_in_flight = max_in_flight
+            self.analyzers = {}   # تنظیمات batch -> FinancialAnalyzer
+            self.running = {}     # task id -> asyncio.Task
+            self.task_ids = {}    # (batch_id, position) در حال اجرا -> task id (برای ثبت خلاصه زودهنگام)
+            self.stats = {'completed': 0, 'failed': 0, 'retried': 0, 'cancelled': 0, 'lease_lost': 0}
+
+        def _analyzer(self, settings: dict) -> "FinancialAnalyzer":
+            key = json.dumps(settings, sort_keys=True)
+            if key not in self.analyzers:
+                analyzer = FinancialAnalyzer(
+                    cache=get_extraction_cache(),
+                    page_targeting=settings.get('page_targeting', True),
+                    cost_estimator=get_cost_estimator(),
+                    context_cache=get_context_cache_manager() if settings.get('context_caching') else None,
+                    section_parallel=settings.get('section_parallel', False),
+                    streaming=settings.get('streaming', True),
+                    hedging=HedgingPolicy(**settings['hedging']) if settings.get('hedging') else None
+                )
+                if settings.get('tiering'):
+                    tiering = settings['tiering']
+                    analyzer.tiering = ModelTiering(
+                        tiering['triage_model'], analyzer.model_name, concurrency=tiering['concurrency'],
+                        min_avg_logprob=tiering['min_avg_logprob']
+                    )
+                analyzer.on_call = self.controller.observe
+                analyzer.on_partial = self._on_partial
+                self.analyzers[key] = analyzer
+            return self.analyzers[key]
+
+        def _on_partial(self, filename, key, value):
+            task_id = self.task_ids.get(self.CURRENT_TASK.get())
+            if task_id is not None:
+                self.task_queue.set_summary(task_id, value)
+
+        async def _run_task(self, task: dict):
+            analyzer = self._analyzer(task['settings'])
+            # هر asyncio.Task کپی جداگانه‌ای از context دارد؛ درخواست‌های فرزند (بخش‌ها، hedge) هم آن را می‌بینند
+            self.CURRENT_TASK.set((task['batch_id'], task['position']))
+            try:
+                outcome = await process_single_file_async(
+                    analyzer, {'name': task['name'], 'content': task['content']}, task['position'], 0,
+                    task['attempt'], task['max_attempts']
+                )
+            finally:
+                self.controller.release()
+            _, _, result, error, needs_retry, retry_after = outcome
+            if not error:
+                if await asyncio.to_thread(self.task_queue.complete, task['id'], self.worker_id, result):
+                    self.stats['completed'] += 1
+                else:
+                    logger.warning(f"Task {task['id']} ({task['name']}): lease lost, result discarded")
+                    self.stats['lease_lost'] += 1
+            elif needs_retry and task['attempt'] < task['max_attempts']:
+                retry_at = time.time() + AsyncExtractionEngine.backoff(task['attempt'], retry_after)
+                await asyncio.to_thread(self.task_queue.fail, task['id'], self.worker_id, str(error), retry_at)
+                self.stats['retried'] += 1
+            else:
+                await asyncio.to_thread(self.task_queue.fail, task['id'], self.worker_id, str(error))
+                self.stats['failed'] += 1
+
+        def _forget(self, task: dict):
+            self.running.pop(task['id'], None)
+            self.task_ids.pop((task['batch_id'], task['position']), None)
+
+        async def run(self, stop: asyncio.Event = None):
+            """حلقه اصلی worker تا زمان set شدن stop"""
+            stop = stop or asyncio.Event()
+            keys = max(1, len(api_key_manager.api_keys))
+            last_heartbeat = time.monotonic()
+            logger.info(f"Extraction worker {self.worker_id} started")
+            while not stop.is_set():
+                free = int(self.controller.limit) - len(self.running)
+                tasks = []
+                if free > 0:
+                    tasks = await asyncio.to_thread(
+                        self.task_queue.claim, self.worker_id, free, self.max_in_flight,
+                        API_LIMITS['rpm'] * keys, API_LIMITS['tpm'] * keys, get_fair_scheduler().weights
+                    )
+                for task in tasks:
+                    await self.controller.acquire()
+                    self.task_ids[(task['batch_id'], task['position'])] = task['id']
+                    running = asyncio.create_task(self._run_task(task))
+                    self.running[task['id']] = running
+                    running.add_done_callback(lambda _, task=task: self._forget(task))
+                if self.running:
+                    for task_id in await asyncio.to_thread(self.task_queue.cancelled, list(self.running)):
+                        # batch لغو شده است؛ درخواست در حال اجرا قطع و رزرو ارسال نشده آزاد می‌شود
+                        if task_id in self.running:
+                            self.running[task_id].cancel()
+                            self.stats['cancelled'] += 1
+                if time.monotonic() - last_heartbeat > self.task_queue.lease_seconds / 3:
+                    await asyncio.to_thread(self.task_queue.heartbeat, self.worker_id, list(self.running))
+                    last_heartbeat = time.monotonic()
+                if not tasks:
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(stop.wait(), self.POLL_SECONDS)
+            if self.running:
+                await asyncio.gather(*self.running.values(), return_exceptions=True)
+            logger.info(f"Extraction worker {self.worker_id} stopped: {self.stats}")
+
+    @st.cache_resource
+    def get_task_queue():
+        """صف مشترک وظایف (TASK_QUEUE_BACKEND=sqlite یا local) یا None برای اجرای داخلی بدون صف"""
+        backend_name = os.getenv("TASK_QUEUE_BACKEND", "")
+        lease_seconds = float(os.getenv("TASK_QUEUE_LEASE_SECONDS", "300"))
+        if backend_name == "sqlite":
+            return SQLiteTaskQueue(os.getenv("TASK_QUEUE_PATH", os.path.join(
+                os.getenv("ANALYSIS_CACHE_DIR", ".analysis_cache"), "task_queue.sqlite3")), lease_seconds=lease_seconds)
+        if backend_name == "local":
+            return LocalTaskQueue(lease_seconds=lease_seconds)
+        return None
+
+
+    def retry_after_seconds(error: BaseException):
+        """
+        زمان انتظار پیشنهادی سرور برای تلاش مجدد (ثانیه) یا None
+
+        به ترتیب از هدر Retry-After پاسخ، RetryInfo.retryDelay در جزئیات خطای Gemini و
+        عبارت «retry in Ns» در متن خطا خوانده می‌شود؛ خطاهای زنجیره‌ای (cause) هم بررسی می‌شوند.
+        """
+        seen = set()
+        while error is not None and id(error) not in seen:
+            seen.add(id(error))
+            headers = getattr(getattr(error, 'response', None), 'headers', None)
+            value = headers.get('retry-after') if headers is not None else None
+            if value:
+                try:
+                    return float(value)
+                except ValueError:
+                    try:
+                        return max(0.0, (parsedate_to_datetime(value) - datetime.now(dt_timezone.utc)).total_seconds())
+                    except (TypeError, ValueError):
+                        pass
+            details = getattr(error, 'details', None)
+            if isinstance(details, dict):
+                for item in details.get('error', {}).get('details', []) or []:
+                    match = re.fullmatch(r'([0-9.]+)s', str(item.get('retryDelay', '')))
+                    if match:
+                        return float(match.group(1))
+            match = re.search(r'retry(?:Delay)?\W{0,4}(?:in\s+)?([0-9]+(?:\.[0-9]+)?)\s*s', str(error), re.IGNORECASE)
+            if match:
+                return float(match.group(1))
+            error = error.__cause__ or error.__context__
+        return None
+
 
     def is_retryable_error(error_msg: str) -> bool:
         """
@@ -1728,10 +5672,11 @@ if st.session_state.authentication_status:
         - Server error (500, 503)
         - Network errors
         - API overloaded
+        - Invalid API key: circuit breaker همان کلید را کنار می‌گذارد و تلاش بعدی با کلید دیگری انجام می‌شود
+        - Incomplete response: بخش‌های سالم نگه داشته شده‌اند و تلاش بعدی فقط بخش‌های معیوب را درخواست می‌کند
         
         خطاهای غیرقابل retry:
         - Invalid file format
-        - Authentication error (403)
         - File too large
         """
         retryable_patterns = [
@@ -1747,18 +5692,1119 @@ if st.session_state.authentication_status:
             'overloaded',
             'temporarily unavailable',
             'try again later',
-            'unavailable'
+            'unavailable',
+            # خطای یک کلید مشخص؛ تلاش بعدی با کلید دیگری انجام می‌شود
+            'api key not valid',
+            'api_key_invalid',
+            # ترمیم ناتمام بخش‌های معیوب (FinancialAnalyzer.repair_async)
+            'incomplete response'
         ]
         
         error_lower = error_msg.lower()
         return any(pattern in error_lower for pattern in retryable_patterns)
     
  
+    # ============================================================================
+    # 📦 حالت Batch برای حجم‌های بالا (بدون نیاز به باز ماندن مرورگر)
+    # ============================================================================
+
+    def to_rest_schema(schema):
+        """تبدیل schema برنامه به قالب REST (نوع‌ها با حروف بزرگ) برای فایل JSONL"""
+        if isinstance(schema, dict):
+            return {
+                key: value.upper() if key == 'type' and isinstance(value, str) else to_rest_schema(value)
+                for key, value in schema.items()
+            }
+        if isinstance(schema, list):
+            return [to_rest_schema(item) for item in schema]
+        return schema
+
+
+    def normalize_job_state(state) -> str:
+        """JOB_STATE_SUCCEEDED / BATCH_STATE_SUCCEEDED -> succeeded"""
+        name = getattr(state, 'name', None) or str(state or 'pending')
+        return name.replace('JOB_STATE_', '').replace('BATCH_STATE_', '').lower()
+
+
+    class GeminiBatchBackend:
+        """ارسال فایل JSONL به Batch API سرویس Gemini و دریافت فایل خروجی"""
+
+        local = False
+
+        def submit(self, client, model: str, jsonl_path: str, display_name: str) -> str:
+            uploaded = client.files.upload(
+                file=jsonl_path,
+                config=types.UploadFileConfig(display_name=display_name, mime_type='jsonl')
+            )
+            job = client.batches.create(model=model, src=uploaded.name, config={'display_name': display_name})
+            return job.name
+
+        def status(self, client, job_name: str) -> str:
+            return normalize_job_state(client.batches.get(name=job_name).state)
+
+        def fetch_results(self, client, job_name: str) -> bytes:
+            job = client.batches.get(name=job_name)
+            return client.files.download(file=job.dest.file_name)
+
+        def cancel(self, client, job_name: str):
+            client.batches.cancel(name=job_name)
+
+
+    class LocalBatchBackend:
+        """
+        جایگزین محلی Batch API بر پایه فایل
+
+        خطوط JSONL در پس‌زمینه روی event loop دائمی و با همان endpoint تعاملی
+        (مثلاً tools/fake_gemini_server.py) اجرا و در فایل خروجی نوشته می‌شوند.
+        وضعیت هر job در state.json کنار فایل ورودی نگهداری می‌شود.
+        """
+
+        local = True
+
+        def __init__(self, max_concurrency: int = 4):
+            self.max_concurrency = max(1, max_concurrency)
+            self.active = set()
+
+        @staticmethod
+        def _paths(job_name: str) -> Tuple[str, str]:
+            job_dir = job_name.split('local:', 1)[1]
+            return os.path.join(job_dir, 'output.jsonl'), os.path.join(job_dir, 'state.json')
+
+        def submit(self, client, model: str, jsonl_path: str, display_name: str) -> str:
+            job_name = f"local:{os.path.dirname(os.path.abspath(jsonl_path))}"
+            self.active.add(job_name)
+            self._write_state(job_name, 'pending')
+            get_event_loop_runner().submit(self._run(client, model, jsonl_path, job_name))
+            return job_name
+
+        def _write_state(self, job_name: str, state: str, **extra):
+            _, state_path = self._paths(job_name)
+            with open(state_path, 'w', encoding='utf-8') as f:
+                json.dump({'state': state, **extra}, f)
+
+        async def _run(self, client, model: str, jsonl_path: str, job_name: str):
+            output_path, _ = self._paths(job_name)
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            write_lock = asyncio.Lock()
+            with open(jsonl_path, encoding='utf-8') as f:
+                lines = [json.loads(line) for line in f if line.strip()]
+
+            async def run_line(line, out):
+                request = line['request']
+                async with semaphore:
+                    if job_name not in self.active:
+                        return
+                    try:
+                        response = await client.aio.models.generate_content(
+                            model=model,
+                            contents=[types.Content.model_validate(c) for c in request['contents']],
+                            config=types.GenerateContentConfig.model_validate({
+                                **request['generation_config'],
+                                'system_instruction': request.get('system_instruction')
+                            })
+                        )
+                        record = {'key': line['key'], 'response': response.model_dump(mode='json', exclude_none=True)}
+                    except Exception as e:
+                        record = {'key': line['key'], 'error': {'message': str(e)}}
+                async with write_lock:
+                    out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    out.flush()
+
+            self._write_state(job_name, 'running', total=len(lines))
+            try:
+                with open(output_path, 'w', encoding='utf-8') as out:
+                    async with asyncio.TaskGroup() as tg:
+                        for line in lines:
+                            tg.create_task(run_line(line, out))
+                self._write_state(job_name, 'succeeded' if job_name in self.active else 'cancelled', total=len(lines))
+            except Exception as e:
+                logger.error(f"Local batch {job_name} failed: {e}")
+                self._write_state(job_name, 'failed', error=str(e))
+            finally:
+                self.active.discard(job_name)
+
+        def status(self, client, job_name: str) -> str:
+            _, state_path = self._paths(job_name)
+            try:
+                with open(state_path, encoding='utf-8') as f:
+                    state = json.load(f)['state']
+            except (OSError, ValueError):
+                return 'failed'
+            if state in ('pending', 'running') and job_name not in self.active:
+                # پردازش پس‌زمینه با راه‌اندازی مجدد سرور متوقف شده است
+                return 'failed'
+            return state
+
+        def fetch_results(self, client, job_name: str) -> bytes:
+            output_path, _ = self._paths(job_name)
+            with open(output_path, 'rb') as f:
+                return f.read()
+
+        def cancel(self, client, job_name: str):
+            self.active.discard(job_name)
+
+
+    class BatchJobManager:
+        """
+        ساخت، پیگیری و جمع‌آوری jobهای Batch
+
+        هر job یک پوشه روی دیسک دارد (manifest.json، requests.jsonl و در پایان
+        results.json) تا با بستن مرورگر یا ورود مجدد کاربر از دست نرود. فایل‌های
+        موجود در کش نتایج ارسال نمی‌شوند و نتیجه نهایی همان لیست
+        (filename, result) مسیر تعاملی است.
+        """
+
+        TERMINAL_STATES = ('succeeded', 'failed', 'cancelled', 'expired', 'partially_succeeded')
+        MAX_JSONL_BYTES = 1900 * 1024 * 1024  # سقف فایل ورودی Batch API حدود 2GB است
+
+        def __init__(self, backend, jobs_dir: str, cache: "ExtractionCache" = None):
+            self.backend = backend
+            self.jobs_dir = jobs_dir
+            self.cache = cache
+            self.lock = threading.Lock()
+            os.makedirs(jobs_dir, exist_ok=True)
+
+        def _job_dir(self, job_id: str) -> str:
+            return os.path.join(self.jobs_dir, job_id)
+
+        def load(self, job_id: str) -> dict:
+            with open(os.path.join(self._job_dir(job_id), 'manifest.json'), encoding='utf-8') as f:
+                return json.load(f)
+
+        def _save(self, manifest: dict):
+            path = os.path.join(self._job_dir(manifest['id']), 'manifest.json')
+            with self.lock:
+                with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump(manifest, f, ensure_ascii=False)
+                os.replace(path + '.tmp', path)
+
+        def list_jobs(self, owner: str = None) -> List[dict]:
+            jobs = []
+            for job_id in os.listdir(self.jobs_dir):
+                try:
+                    manifest = self.load(job_id)
+                except (OSError, ValueError):
+                    continue
+                if owner is None or manifest.get('owner') == owner:
+                    jobs.append(manifest)
+            return sorted(jobs, key=lambda m: m['created_at'], reverse=True)
+
+        @staticmethod
+        def _key_id(api_key: str) -> str:
+            # خود کلید روی دیسک ذخیره نمی‌شود؛ فقط شناسه‌ای برای یافتن دوباره آن
+            return api_key_id(api_key)
+
+        def _client_for(self, manifest: dict):
+            for api_key in st.session_state.api_keys:
+                if self._key_id(api_key) == manifest['key_id']:
+                    return client_pool.get(api_key)
+            raise ValueError("کلید API که این job با آن ثبت شده در تنظیمات فعلی وجود ندارد")
+
+        def submit(self, analyzer: "FinancialAnalyzer", uploaded_files, owner: str = None) -> dict:
+            """ساخت فایل JSONL، ارسال به backend و ثبت manifest"""
+            job_id = datetime.now().strftime('%Y%m%d-%H%M%S-') + hashlib.sha256(os.urandom(8)).hexdigest()[:6]
+            job_dir = self._job_dir(job_id)
+            os.makedirs(job_dir)
+            jsonl_path = os.path.join(job_dir, 'requests.jsonl')
+            fingerprint = analyzer.cache_fingerprint(batch=True)
+
+            files = []
+            written = 0
+            with open(jsonl_path, 'w', encoding='utf-8') as f:
+                for index, uploaded in enumerate(uploaded_files):
+                    filename = uploaded['name'] if isinstance(uploaded, dict) else uploaded.name
+                    content = uploaded['content'] if isinstance(uploaded, dict) else uploaded.getvalue()
+                    entry = {'key': f"file-{index}", 'filename': filename,
+                             'file_hash': ExtractionCache.file_hash(content)}
+                    if self.cache and self.cache.get(content, fingerprint) is not None:
+                        entry['cached'] = True
+                    else:
+                        payload, _ = analyzer.prepare_document(content, filename)
+                        line = json.dumps(
+                            {'key': entry['key'], 'request': analyzer.build_batch_request(payload)},
+                            ensure_ascii=False
+                        ) + '\n'
+                        written += len(line.encode('utf-8'))
+                        if written > self.MAX_JSONL_BYTES:
+                            raise ValueError("حجم درخواست‌ها از سقف یک job بیشتر است؛ فایل‌ها را در چند job ارسال کنید")
+                        f.write(line)
+                    files.append(entry)
+
+            api_key = api_key_manager.get_next_key()
+            manifest = {
+                'id': job_id,
+                'owner': owner,
+                'created_at': time.time(),
+                'model': analyzer.model_name,
+                'fingerprint': fingerprint,
+                'key_id': self._key_id(api_key),
+                'local': self.backend.local,
+                'files': files,
+                'remote_name': None,
+                'state': 'succeeded',
+                'collected': False
+            }
+            pending = sum(1 for entry in files if not entry.get('cached'))
+            if pending:
+                manifest['remote_name'] = self.backend.submit(
+                    client_pool.get(api_key), analyzer.model_name, jsonl_path, f"financial-analyzer-{job_id}"
+                )
+                manifest['state'] = 'pending'
+            self._save(manifest)
+            logger.info(f"📦 Batch job {job_id}: {pending} requests submitted, {len(files) - pending} from cache")
+            return manifest
+
+        def refresh(self, job_id: str) -> dict:
+            manifest = self.load(job_id)
+            if manifest['state'] in self.TERMINAL_STATES or not manifest['remote_name']:
+                return manifest
+            try:
+                manifest['state'] = self.backend.status(self._client_for(manifest), manifest['remote_name'])
+            except Exception as e:
+                logger.warning(f"Batch status check failed for {job_id}: {e}")
+                return manifest
+            self._save(manifest)
+            return manifest
+
+        def cancel(self, job_id: str) -> dict:
+            manifest = self.load(job_id)
+            if manifest['remote_name'] and manifest['state'] not in self.TERMINAL_STATES:
+                self.backend.cancel(self._client_for(manifest), manifest['remote_name'])
+                manifest['state'] = 'cancelled'
+                self._save(manifest)
+            return manifest
+
+        def collect(self, job_id: str) -> List[Tuple[str, Dict]]:
+            """خواندن خروجی job و تبدیل آن به لیست (filename, result) به ترتیب ارسال"""
+            manifest = self.load(job_id)
+            results_path = os.path.join(self._job_dir(job_id), 'results.json')
+            if manifest['collected'] and os.path.exists(results_path):
+                with open(results_path, encoding='utf-8') as f:
+                    return [tuple(item) for item in json.load(f)]
+
+            # خروجی Batch همان اعتبارسنجی پاسخ‌های تعاملی را می‌گذراند (مدل و schema همان درخواست ارسال شده)
+            analyzer = FinancialAnalyzer()
+            analyzer.model_name = manifest['model']
+            outputs = {}
+            if manifest['remote_name']:
+                raw = self.backend.fetch_results(self._client_for(manifest), manifest['remote_name'])
+                for line in raw.decode('utf-8').splitlines():
+                    if line.strip():
+                        record = json.loads(line)
+                        outputs[record['key']] = record
+
+            results = []
+            for entry in manifest['files']:
+                filename = entry['filename']
+                if entry.get('cached'):
+                    data = self.cache.get_by_hash(entry['file_hash'], manifest['fingerprint']) if self.cache else None
+                    results.append((filename, data if data is not None
+                                    else {"error": "خطا: نتیجه کش شده منقضی شده است"}))
+                    continue
+                record = outputs.get(entry['key'])
+                if record is None:
+                    results.append((filename, {"error": "خطا: پاسخی در خروجی Batch یافت نشد"}))
+                    continue
+                if 'response' not in record:
+                    message = record.get('error', {}).get('message', record.get('error'))
+                    results.append((filename, {"error": f"خطا: {message}"}))
+                    continue
+                cacheable = True
+                try:
+                    response = types.GenerateContentResponse.model_validate(record['response'])
+                    data = analyzer._parse_response(response)
+                except ExtractionDefectError as defect:
+                    if defect.broken_sections:
+                        results.append((filename, {"error": f"خطا: {defect}"}))
+                        continue
+                    # فقط موضوعاتی از چک‌لیست نیامده‌اند: نتیجه نمایش داده می‌شود ولی در کش نمی‌رود
+                    # تا پردازش تعاملی بعدی آن را کامل کند
+                    logger.warning(f"⚠️ {filename}: {defect}")
+                    data, cacheable = defect.partial, False
+                except Exception as e:
+                    results.append((filename, {"error": f"خطا: {e}"}))
+                    continue
+                if self.cache and cacheable:
+                    self.cache.put(None, manifest['fingerprint'], data, filename, file_hash=entry['file_hash'])
+                results.append((filename, data))
+
+            with open(results_path, 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False)
+            manifest['collected'] = True
+            self._save(manifest)
+            return results
+
+    @st.cache_resource
+    def get_batch_manager():
+        backend_name = os.getenv("GEMINI_BATCH_BACKEND", "gemini")
+        backend = (LocalBatchBackend(max_concurrency=int(os.getenv("LOCAL_BATCH_CONCURRENCY", "4")))
+                   if backend_name == "local" else GeminiBatchBackend())
+        jobs_dir = os.getenv("BATCH_JOBS_DIR",
+                             os.path.join(os.getenv("ANALYSIS_CACHE_DIR", ".analysis_cache"), "batch_jobs"))
+        return BatchJobManager(backend, jobs_dir, cache=get_extraction_cache())
+
+
+    class ProcessingJobStore:
+        """
+        وضعیت jobهای پردازش پس‌زمینه روی دیسک
+
+        هر job یک پوشه دارد: job.json (تنظیمات، وضعیت کلی و فهرست فایل‌های یکتا)،
+        files.jsonl (تغییرات وضعیت هر فایل، فقط افزودنی)، inputs/ (محتوای PDFها تا اجرای
+        job به فایل‌های بارگذاری شده در مرورگر وابسته نباشد) و results/ (نتیجه کامل هر فایل
+        به محض اتمام). ثبت وضعیت یک فایل فقط یک خط به files.jsonl اضافه می‌کند و job.json را
+        بازنویسی نمی‌کند؛ load خط‌ها را به ترتیب روی job.json اعمال می‌کند و خط نیمه‌نوشته
+        (خاموش شدن سرور در میانه نوشتن) نادیده گرفته می‌شود.
+
+        callbackهای event loop از defer استفاده می‌کنند: نوشتن‌ها به ترتیب در thread دفتر
+        انجام می‌شوند و loop منتظر دیسک نمی‌ماند.
+
+        پردازش تعاملی هم در همین دفتر ثبت می‌شود؛ پس از crash یا redeploy فقط فایل‌هایی که
+        نتیجه موفق ندارند دوباره پردازش می‌شوند. jobهای قدیمی‌تر از keep_days حذف می‌شوند.
+        """
+
+        ACTIVE_STATES = ('queued', 'running')
+        FINAL_FILE_STATES = ('succeeded', 'failed')
+
+        def __init__(self, jobs_dir: str, keep_days: int = 7):
+            self.jobs_dir = jobs_dir
+            self.lock = threading.Lock()
+            self.writes = queue.Queue()
+            os.makedirs(jobs_dir, exist_ok=True)
+            cutoff = time.time() - keep_days * 86400
+            for job in self.list_jobs():
+                if job['state'] not in self.ACTIVE_STATES and job.get('updated_at', job['created_at']) < cutoff:
+                    shutil.rmtree(self._job_dir(job['id']), ignore_errors=True)
+            threading.Thread(target=self._write_loop, name='job-journal', daemon=True).start()
+
+        def _job_dir(self, job_id: str) -> str:
+            return os.path.join(self.jobs_dir, job_id)
+
+        def _write_loop(self):
+            while True:
+                method, args, kwargs = self.writes.get()
+                try:
+                    method(*args, **kwargs)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Job journal write failed: {e}")
+                finally:
+                    self.writes.task_done()
+
+        def defer(self, method, *args, **kwargs):
+            """اجرای یک نوشتن در thread دفتر، به ترتیب ثبت"""
+            self.writes.put((method, args, kwargs))
+
+        def flush(self):
+            """انتظار تا انجام همه نوشتن‌های defer شده"""
+            self.writes.join()
+
+        @staticmethod
+        def _write_json(path: str, data):
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+
+        def create(self, all_files, duplicates: Dict[int, dict], owner: str = None, settings: dict = None) -> dict:
+            """ثبت job جدید؛ فقط فایل‌های یکتا روی دیسک نوشته و پردازش می‌شوند"""
+            job_id = datetime.now().strftime('%Y%m%d-%H%M%S-') + hashlib.sha256(os.urandom(8)).hexdigest()[:6]
+            job_dir = self._job_dir(job_id)
+            os.makedirs(os.path.join(job_dir, 'inputs'))
+            os.makedirs(os.path.join(job_dir, 'results'))
+
+            names = [f['name'] if isinstance(f, dict) else f.name for f in all_files]
+            unique_indices = [i for i in range(len(all_files)) if i not in duplicates]
+            hashes = []
+            for position, index in enumerate(unique_indices):
+                f = all_files[index]
+                content = f['content'] if isinstance(f, dict) else f.getvalue()
+                hashes.append(hashlib.sha256(content).hexdigest())
+                with open(os.path.join(job_dir, 'inputs', f'{position}.pdf'), 'wb') as out:
+                    out.write(content)
+
+            job = {
+                'id': job_id,
+                'owner': owner,
+                'created_at': time.time(),
+                'updated_at': time.time(),
+                'state': 'queued',
+                'names': names,
+                'unique_indices': unique_indices,
+                'duplicates': {str(index): duplicate for index, duplicate in duplicates.items()},
+                'settings': settings or {},
+                'files': [{'name': names[index], 'hash': file_hash, 'status': 'pending', 'attempt': 0}
+                          for index, file_hash in zip(unique_indices, hashes)],
+                'stats': {}
+            }
+            with self.lock:
+                self._write_json(os.path.join(job_dir, 'job.json'), job)
+            return job
+
+        def load(self, job_id: str) -> dict:
+            job_dir = self._job_dir(job_id)
+            with open(os.path.join(job_dir, 'job.json'), encoding='utf-8') as f:
+                job = json.load(f)
+            try:
+                with open(os.path.join(job_dir, 'files.jsonl'), encoding='utf-8') as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                lines = []
+            for line in lines:
+                try:
+                    change = json.loads(line)
+                except ValueError:
+                    continue
+                job['files'][change['position']].update(change['fields'])
+                job['updated_at'] = max(job['updated_at'], change['at'])
+            return job
+
+        def update(self, job_id: str, **fields) -> dict:
+            with self.lock:
+                job = self.load(job_id)
+                job.update(fields, updated_at=time.time())
+                self._write_json(os.path.join(self._job_dir(job_id), 'job.json'), job)
+            return job
+
+        def update_file(self, job_id: str, position: int, result=None, **fields):
+            """ثبت وضعیت یک فایل؛ نتیجه کامل (در صورت وجود) جداگانه ذخیره می‌شود تا job.json کوچک بماند"""
+            if result is not None:
+                self._write_json(os.path.join(self._job_dir(job_id), 'results', f'{position}.json'), result)
+            self.update_files(job_id, [position], **fields)
+
+        def update_files(self, job_id: str, positions: List[int], **fields):
+            """افزودن تغییر وضعیت چند فایل به files.jsonl با یک بار fsync"""
+            now = time.time()
+            lines = ''.join(
+                json.dumps({'position': position, 'at': now, 'fields': fields}, ensure_ascii=False) + '\n'
+                for position in positions
+            )
+            with self.lock:
+                with open(os.path.join(self._job_dir(job_id), 'files.jsonl'), 'a', encoding='utf-8') as f:
+                    f.write(lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+        def list_jobs(self, owner: str = None) -> List[dict]:
+            jobs = []
+            for job_id in os.listdir(self.jobs_dir):
+                try:
+                    job = self.load(job_id)
+                except (OSError, ValueError):
+                    continue
+                if owner is None or job.get('owner') == owner:
+                    jobs.append(job)
+            return sorted(jobs, key=lambda job: job['created_at'], reverse=True)
+
+        def record_outcome(self, job_id: str, position: int, outcome: tuple, attempt: int, retry_scheduled: bool):
+            """ثبت خروجی موتور پردازش (همان callback on_result) برای یک فایل"""
+            _, _, result, error, _ = outcome
+            if retry_scheduled:
+                self.update_file(job_id, position, status='retrying', attempt=attempt, error=str(error))
+            elif error:
+                message = f"خطا: {error}" if attempt == 1 else f"خطا بعد از {attempt} تلاش: {error}"
+                self.update_file(job_id, position, result={"error": message},
+                                 status='failed', attempt=attempt, error=str(error))
+            else:
+                self.update_file(job_id, position, result=result, status='succeeded', attempt=attempt, error=None)
+
+        def mark_cancelled(self, job_id: str) -> int:
+            """علامت‌گذاری فایل‌هایی که تا لحظه لغو نتیجه نهایی نگرفته‌اند؛ تعداد آن‌ها برگردانده می‌شود"""
+            job = self.load(job_id)
+            positions = [position for position, entry in enumerate(job['files'])
+                         if entry['status'] not in self.FINAL_FILE_STATES]
+            self.update_files(job_id, positions, status='cancelled')
+            return len(positions)
+
+        def unfinished(self, job: dict) -> List[int]:
+            """فایل‌هایی که نتیجه موفق ذخیره شده ندارند (ناموفق، در صف یا قطع شده)"""
+            results_dir = os.path.join(self._job_dir(job['id']), 'results')
+            return [position for position, entry in enumerate(job['files'])
+                    if entry['status'] != 'succeeded' or not os.path.exists(os.path.join(results_dir, f'{position}.json'))]
+
+        def inputs(self, job: dict, positions: List[int] = None) -> List[dict]:
+            """فایل‌های یکتای job (یا فقط positions) به همان شکل dict که موتور پردازش می‌پذیرد"""
+            inputs = []
+            for position in (range(len(job['files'])) if positions is None else positions):
+                with open(os.path.join(self._job_dir(job['id']), 'inputs', f'{position}.pdf'), 'rb') as f:
+                    inputs.append({'name': job['files'][position]['name'], 'content': f.read()})
+            return inputs
+
+        def results(self, job_id: str) -> list:
+            """
+            نتایج به ترتیب فایل‌های بارگذاری شده (با نتیجه فایل اصلی برای تکراری‌ها)؛
+            فایل‌هایی که هنوز تمام نشده‌اند با پیام خطا برگردانده می‌شوند
+            """
+            job = self.load(job_id)
+            results = []
+            for position, entry in enumerate(job['files']):
+                path = os.path.join(self._job_dir(job_id), 'results', f'{position}.json')
+                try:
+                    with open(path, encoding='utf-8') as f:
+                        results.append((entry['name'], json.load(f)))
+                except (OSError, ValueError):
+                    message = "پردازش این فایل لغو شد" if entry['status'] == 'cancelled' else "پردازش این فایل تمام نشده است"
+                    results.append((entry['name'], {"error": message}))
+            duplicates = {int(index): duplicate for index, duplicate in job['duplicates'].items()}
+            return expand_duplicate_results(results, job['names'], duplicates, job['unique_indices'])
+
+
+    class BackgroundJobRunner:
+        """
+        اجرای jobهای پردازش روی event loop دائمی سرور
+
+        job مستقل از اجرای اسکریپت Streamlit و اتصال مرورگر ادامه می‌یابد؛ rerun، بستن
+        تب یا قطع اتصال فقط polling صفحه را متوقف می‌کند. وضعیت هر فایل همان لحظه در
+        ProcessingJobStore ثبت می‌شود و صفحه با خواندن آن پیشرفت را نمایش می‌دهد.
+
+        با تنظیم صف مشترک (TASK_QUEUE_BACKEND)، فایل‌ها به جای موتور داخلی به صف سپرده
+        می‌شوند و این کلاس فقط وضعیت وظایف را از صف به ProcessingJobStore منتقل می‌کند.
+        """
+
+        QUEUE_POLL_SECONDS = 1.0
+
+        def __init__(self, store: ProcessingJobStore, loop_runner: "EventLoopRunner",
+                     task_queue: SQLiteTaskQueue = None):
+            self.store = store
+            self.loop_runner = loop_runner
+            self.task_queue = task_queue
+            self.worker = None
+            self.active = {}   # job_id -> (future, engine)
+            self.finishing = set()   # jobهای تمام شده‌ای که وضعیت نهایی‌شان هنوز در صف نوشتن دفتر است
+            self.cancel_stats = {}   # job_id -> آمار لغو jobهای صف مشترک
+            self.lock = threading.Lock()
+
+        def start_worker(self, concurrency: int, max_in_flight: int = None):
+            """اجرای یک ExtractionWorker روی event loop همین فرایند (یک بار برای هر فرایند)"""
+            with self.lock:
+                if self.worker is not None or self.task_queue is None:
+                    return
+                self.worker = ExtractionWorker(self.task_queue, concurrency=concurrency, max_in_flight=max_in_flight)
+            self.loop_runner.submit(self.worker.run())
+
+        async def _run_queued(self, job_id: str, positions: List[int], files: List[dict], tokens: List[int],
+                              analyzer: "FinancialAnalyzer", max_attempts: int, on_result, on_summary,
+                              order: List[int] = None):
+            """
+            سپردن فایل‌ها به صف مشترک و انتقال وضعیت وظایف به ProcessingJobStore تا پایان همه آن‌ها
+
+            شماره وظیفه در صف همان شماره فایل در job است؛ در ادامه یک job قطع شده، وظایفی که
+            هنوز در صف هستند یا workerها تمامشان کرده‌اند دوباره ارسال نمی‌شوند.
+            """
+            # worker همان analyzer را از این تنظیمات دوباره می‌سازد (ExtractionWorker._analyzer)
+            settings = {
+                'page_targeting': analyzer.page_targeting,
+                'context_caching': analyzer.context_cache is not None,
+                'section_parallel': analyzer.section_parallel,
+                'streaming': analyzer.streaming,
+                'hedging': {
+                    'percentile': analyzer.hedging.percentile,
+                    'budget_ratio': analyzer.hedging.budget_ratio
+                } if analyzer.hedging else None,
+                'tiering': {
+                    'triage_model': analyzer.tiering.triage_model,
+                    'concurrency': analyzer.tiering.concurrency,
+                    'min_avg_logprob': analyzer.tiering.min_avg_logprob
+                } if analyzer.tiering else None
+            }
+            requests = len(FinancialAnalyzer.SECTION_KEYS) if analyzer.section_parallel else 1
+            index_of = {position: index for index, position in enumerate(positions)}
+            existing = {task['position']: task['state'] for task in
+                        await asyncio.to_thread(self.task_queue.batch_status, job_id)}
+            failed = [position for position in positions if existing.get(position) in ('failed', 'cancelled')]
+            if failed:
+                await asyncio.to_thread(self.task_queue.purge, job_id, failed)
+            # workerها وظایف آماده را به ترتیب درج برمی‌دارند
+            await asyncio.to_thread(self.task_queue.enqueue, job_id, [
+                {'position': positions[index], 'name': files[index]['name'], 'content': files[index]['content'],
+                 'tokens': tokens[index] if tokens else 0, 'requests': requests}
+                for index in (range(len(positions)) if order is None else order)
+                if existing.get(positions[index], 'failed') in ('failed', 'cancelled')
+            ], settings, max_attempts, owner=(await asyncio.to_thread(self.store.load, job_id)).get('owner'),
+                express=get_fair_scheduler().is_express(len(positions)))
+
+            pending = set(positions)
+            seen = {}   # position -> (state, attempts, خلاصه ثبت شده)
+            since = 0.0
+            while pending:
+                await asyncio.sleep(self.QUEUE_POLL_SECONDS)
+                # همپوشانی چند ثانیه‌ای برای تغییراتی که با ساعت کمی عقب‌تر workerهای دیگر ثبت شده‌اند
+                tasks = await asyncio.to_thread(self.task_queue.batch_status, job_id, since - 5)
+                for task in tasks:
+                    since = max(since, task['updated_at'])
+                    position = task['position']
+                    key = (task['state'], task['attempts'], task['summary'] is not None)
+                    if position not in pending or seen.get(position) == key:
+                        continue
+                    index = index_of[position]
+                    if task['summary'] and not (seen.get(position) or (None, None, False))[2]:
+                        on_summary(index, task['summary'])
+                    seen[position] = key
+                    name = files[index]['name']
+                    if task['state'] == 'done':
+                        pending.discard(position)
+                        on_result((index, name, task['result'], None, False), task['attempts'], False)
+                    elif task['state'] == 'failed':
+                        pending.discard(position)
+                        on_result((index, name, None, task['error'], False), task['attempts'], False)
+                    elif task['state'] == 'queued' and task['error']:
+                        on_result((index, name, None, task['error'], True), task['attempts'], True)
+                    elif task['state'] == 'cancelled':
+                        pending.discard(position)
+            await asyncio.to_thread(self.task_queue.purge, job_id)
+
+        def is_running(self, job_id: str) -> bool:
+            with self.lock:
+                entry = self.active.get(job_id)
+                finishing = job_id in self.finishing
+            return entry is not None and (not entry[0].done() or finishing)
+
+        def engine(self, job_id: str):
+            with self.lock:
+                entry = self.active.get(job_id)
+            return entry[1] if entry else None
+
+        def cancel(self, job_id: str) -> bool:
+            """
+            لغو همکارانه job در حال اجرا؛ نتایج ثبت شده حفظ می‌شوند و فایل‌های باقی‌مانده
+            با وضعیت cancelled برای ادامه بعدی علامت می‌خورند
+
+            Returns:
+                bool: False اگر job در این فرایند در حال اجرا نباشد
+            """
+            with self.lock:
+                entry = self.active.get(job_id)
+            if entry is None or entry[0].done():
+                return False
+            future, engine = entry
+            if engine is not None:
+                engine.cancel()
+            else:
+                # حلقه _run_queued نتایج تکمیل شده را منتقل می‌کند و با دیدن وظایف لغو شده پایان می‌یابد
+                try:
+                    self.cancel_stats[job_id] = self.task_queue.cancel(job_id)
+                except sqlite3.Error as e:
+                    logger.warning(f"Task queue cancel failed for {job_id}: {e}")
+                    self.cancel_stats[job_id] = {'not_dispatched': 0, 'aborted': 0, 'freed_requests': 0}
+                    future.cancel()
+            return True
+
+        def display_state(self, job: dict) -> str:
+            """jobهایی که در حال اجرا ثبت شده‌اند اما worker آن‌ها وجود ندارد (راه‌اندازی مجدد سرور) قطع شده‌اند"""
+            if job['state'] in ProcessingJobStore.ACTIVE_STATES and not self.is_running(job['id']):
+                return 'interrupted'
+            return job['state']
+
+        def track(self, job_id: str, future, engine: "AsyncExtractionEngine" = None):
+            """
+            ثبت اجرای یک job در این فرایند؛ وضعیت نهایی با پایان future در دفتر ثبت می‌شود
+            (حتی اگر اسکریپتی که آن را شروع کرده با rerun متوقف شده باشد)
+            """
+            started = time.time()
+            self.store.update(job_id, state='running', started_at=started, error=None)
+
+            def finish(done, finished_at):
+                try:
+                    stats = {'duration': finished_at - started}
+                    if engine is not None:
+                        stats.update(controller=engine.controller.stats, final_concurrency=engine.controller.limit)
+                    cancel_stats = self.cancel_stats.pop(job_id, None)
+                    if cancel_stats is not None or (engine is not None and engine.cancelled):
+                        stats['cancel'] = dict(cancel_stats or engine.cancel_stats,
+                                               cancelled_files=self.store.mark_cancelled(job_id))
+                        logger.info(f"Processing job {job_id} cancelled: {stats['cancel']}")
+                        self.store.update(job_id, state='cancelled', finished_at=finished_at, stats=stats)
+                        return
+                    if done.cancelled() or done.exception() is not None:
+                        error = 'cancelled' if done.cancelled() else str(done.exception())
+                        logger.error(f"Processing job {job_id} failed: {error}")
+                        self.store.update(job_id, state='failed', error=error, finished_at=finished_at)
+                        return
+                    self.store.update(job_id, state='completed', finished_at=finished_at, stats=stats)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Job journal update failed for {job_id}: {e}")
+                finally:
+                    with self.lock:
+                        self.finishing.discard(job_id)
+
+            def on_done(done):
+                # callback روی thread مربوط به event loop اجرا می‌شود؛ وضعیت نهایی پس از نتایج فایل‌ها در thread دفتر ثبت می‌شود
+                with self.lock:
+                    self.finishing.add(job_id)
+                self.store.defer(finish, done, time.time())
+
+            with self.lock:
+                self.active[job_id] = (future, engine)
+            future.add_done_callback(on_done)
+
+        def start(self, job_id: str, analyzer: "FinancialAnalyzer", initial_concurrency: int,
+                  max_concurrency: int, max_attempts: int = 5, tokens: List[int] = None,
+                  positions: List[int] = None, order: List[int] = None):
+            """
+            Args:
+                tokens: توکن تخمینی هر فایل، هم‌ترتیب با positions (برای سقف TPM سراسری در حالت صف مشترک)
+                positions: فایل‌هایی که باید پردازش شوند (پیش‌فرض: همه؛ در ادامه job فقط فایل‌های ناتمام)
+                order: ترتیب ارسال (اندیس‌های positions)
+            """
+            job = self.store.load(job_id)
+            positions = list(range(len(job['files']))) if positions is None else list(positions)
+            files = self.store.inputs(job, positions)
+            self.store.update_files(job_id, positions, status='pending', attempt=0, error=None)
+            index_by_name = {f['name']: index for index, f in enumerate(files)}
+            summaries = set()
+
+            def on_summary(index, value):
+                if index not in summaries:
+                    summaries.add(index)
+                    self.store.defer(self.store.update_file, job_id, positions[index], summary=value)
+
+            def on_partial(filename, key, value):
+                if filename in index_by_name:
+                    on_summary(index_by_name[filename], value)
+
+            def on_result(outcome, attempt, retry_scheduled):
+                # اندیس موتور مربوط به لیست files است و به شماره فایل در job تبدیل می‌شود
+                self.store.defer(self.store.record_outcome, job_id, positions[outcome[0]], outcome, attempt,
+                                 retry_scheduled)
+
+            analyzer.on_partial = on_partial
+            if self.task_queue is not None:
+                future = self.loop_runner.submit(self._run_queued(
+                    job_id, positions, files, tokens, analyzer, max_attempts, on_result, on_summary, order
+                ))
+                self.track(job_id, future)
+            else:
+                fair_scheduler = get_fair_scheduler()
+                engine = AsyncExtractionEngine(analyzer, max_concurrency=initial_concurrency,
+                                               max_attempts=max_attempts, max_limit=max_concurrency,
+                                               scheduler=fair_scheduler, user=job['owner'],
+                                               express=fair_scheduler.is_express(len(positions)))
+                future = self.loop_runner.submit(engine.run(files, on_result, order=order))
+                self.track(job_id, future, engine)
+            return future
+
+    @st.cache_resource
+    def get_background_job_runner():
+        jobs_dir = os.getenv("PROCESSING_JOBS_DIR",
+                             os.path.join(os.getenv("ANALYSIS_CACHE_DIR", ".analysis_cache"), "processing_jobs"))
+        return BackgroundJobRunner(ProcessingJobStore(jobs_dir), get_event_loop_runner(), task_queue=get_task_queue())
+
+
+    BATCH_SUGGEST_THRESHOLD = int(os.getenv("BATCH_SUGGEST_THRESHOLD", "200"))
+
+    BATCH_STATE_LABELS = {
+        'pending': '⏳ در صف',
+        'queued': '⏳ در صف',
+        'running': '🔄 در حال اجرا',
+        'succeeded': '✅ تکمیل شده',
+        'partially_succeeded': '⚠️ تکمیل ناقص',
+        'failed': '❌ ناموفق',
+        'cancelled': '⛔ لغو شده',
+        'expired': '⌛ منقضی شده'
+    }
+
+    def submit_batch_job(uploaded_files):
+        """ارسال فایل‌ها به صورت Batch با همان تنظیمات پیش‌پردازش و کش"""
+        analyzer = FinancialAnalyzer(
+            cache=get_extraction_cache(),
+            page_targeting=st.session_state.get('page_targeting', True)
+        )
+        with st.spinner("📦 در حال آماده‌سازی و ارسال فایل‌ها به صورت Batch..."):
+            manifest = get_batch_manager().submit(analyzer, uploaded_files, owner=st.session_state.get('username'))
+        cached = sum(1 for entry in manifest['files'] if entry.get('cached'))
+        st.success(
+            f"📦 Job `{manifest['id']}` ثبت شد ({len(manifest['files']) - cached} درخواست، {cached} فایل از کش). "
+            "می‌توانید این صفحه را ببندید و بعداً برای دریافت نتایج بازگردید."
+        )
+
+    def create_batch_jobs_section():
+        """فهرست jobهای Batch کاربر با امکان بروزرسانی وضعیت، لغو و دریافت نتایج"""
+        manager = get_batch_manager()
+        jobs = manager.list_jobs(owner=st.session_state.get('username'))
+        if not jobs:
+            return
+
+        with st.expander(f"📦 Jobهای Batch ({len(jobs)})", expanded=any(
+                job['state'] not in BatchJobManager.TERMINAL_STATES for job in jobs)):
+            if st.button("🔄 بروزرسانی وضعیت", key="batch_refresh"):
+                jobs = [manager.refresh(job['id']) for job in jobs]
+
+            for job in jobs:
+                col_info, col_action = st.columns([3, 1])
+                with col_info:
+                    created = datetime.fromtimestamp(job['created_at']).strftime('%Y-%m-%d %H:%M')
+                    backend_label = " (محلی)" if job.get('local') else ""
+                    st.markdown(
+                        f"**{job['id']}**{backend_label} | {len(job['files'])} فایل | {created} | "
+                        f"{BATCH_STATE_LABELS.get(job['state'], job['state'])}"
+                    )
+                with col_action:
+                    if job['state'] in ('succeeded', 'partially_succeeded'):
+                        if st.button("📥 دریافت نتایج", key=f"batch_collect_{job['id']}", use_container_width=True):
+                            try:
+                                st.session_state.results = manager.collect(job['id'])
+                                st.session_state.processing_active = False
+                                st.rerun()
+                            except Exception as e:
+                                st.error(f"❌ خطا در دریافت نتایج: {e}")
+                    elif job['state'] not in BatchJobManager.TERMINAL_STATES:
+                        if st.button("⛔ لغو", key=f"batch_cancel_{job['id']}", use_container_width=True):
+                            manager.cancel(job['id'])
+                            st.rerun()
+
+    PROCESSING_JOB_STATE_LABELS = {
+        'queued': '⏳ در صف',
+        'running': '🔄 در حال اجرا',
+        'completed': '✅ تکمیل شده',
+        'failed': '❌ ناموفق',
+        'cancelled': '⛔ لغو شده',
+        'interrupted': '⚠️ قطع شده (راه‌اندازی مجدد سرور)'
+    }
+
+    PROCESSING_FILE_STATUS_LABELS = {
+        'pending': '⏳ در صف',
+        'retrying': '🔄 تلاش مجدد',
+        'succeeded': '✅ موفق',
+        'failed': '❌ ناموفق',
+        'cancelled': '⛔ لغو شده'
+    }
+
+    def show_daily_limit_error(num_files: int, optimization: dict):
+        st.error(
+            f"⚠️ تعداد فایل‌های یکتا ({num_files}) بیشتر از ظرفیت باقی‌مانده امروز "
+            f"({optimization['limits']['max_daily']}) است. "
+            f"لطفاً تعداد فایل‌ها را کاهش دهید، API key های بیشتری اضافه کنید یا پس از بازنشانی سهمیه "
+            f"({quota_ledger.next_reset().strftime('%H:%M')}) دوباره تلاش کنید."
+        )
+
+    def launch_planned_job(job_id: str, plan: dict, num_files: int, positions: List[int] = None):
+        """سپردن فایل‌های برنامه‌ریزی شده یک job به worker سرور (یا صف مشترک)"""
+        runner = get_background_job_runner()
+        analyzer = plan['analyzer']
+        max_concurrency = batch_concurrency_limit(plan['optimal_workers'], num_files)
+        if isinstance(runner.task_queue, LocalTaskQueue) or os.getenv("TASK_QUEUE_EMBEDDED_WORKER") == "1":
+            # صف محلی مصرف‌کننده دیگری ندارد؛ در صف مشترک این replica هم می‌تواند worker باشد
+            runner.start_worker(max_concurrency, max_in_flight=GEMINI_MAX_CONCURRENCY)
+        runner.start(job_id, analyzer, plan['optimal_workers'], max_concurrency,
+                     tokens=[estimate['total_tokens'] for estimate in plan['file_estimates']], positions=positions,
+                     order=plan['optimization']['dispatch_order'])
+
+    def start_background_job(uploaded_files):
+        """
+        برنامه‌ریزی batch با همان محاسبات پردازش تعاملی و سپردن اجرای آن به worker سرور؛
+        شناسه job یا None (در صورت کافی نبودن سهمیه روزانه) برگردانده می‌شود
+        """
+        duplicates = find_duplicate_files(uploaded_files)
+        unique_files = [f for i, f in enumerate(uploaded_files) if i not in duplicates]
+        plan = plan_processing(unique_files)
+        optimization = plan['optimization']
+        if not optimization['limits']['daily_limit_ok']:
+            show_daily_limit_error(len(unique_files), optimization)
+            return None
+
+        job = get_background_job_runner().store.create(
+            uploaded_files, duplicates, owner=st.session_state.get('username'), settings={
+                'mode': 'background',
+                'model': plan['analyzer'].model_name,
+                'optimal_workers': plan['optimal_workers'],
+                'estimated_time_minutes': optimization['estimated_time_minutes']
+            }
+        )
+        launch_planned_job(job['id'], plan, len(unique_files))
+        return job['id']
+
+    def resume_processing_job(job_id: str) -> bool:
+        """
+        ادامه job قطع شده (crash، redeploy یا بستن اسکریپت) یا دارای فایل ناموفق: فقط فایل‌هایی که
+        نتیجه موفق در دفتر ندارند با تنظیمات فعلی دوباره پردازش می‌شوند
+        """
+        runner = get_background_job_runner()
+        job = runner.store.load(job_id)
+        positions = runner.store.unfinished(job)
+        if positions:
+            files = runner.store.inputs(job, positions)
+            plan = plan_processing(files)
+            if not plan['optimization']['limits']['daily_limit_ok']:
+                show_daily_limit_error(len(files), plan['optimization'])
+                return False
+            runner.store.update(job_id, resumed=job.get('resumed', 0) + 1)
+            launch_planned_job(job_id, plan, len(files), positions=positions)
+        else:
+            runner.store.update(job_id, state='completed')
+        return True
+
+    def cancel_processing_job(job_id: str, timeout: float = 15.0) -> bool:
+        """
+        لغو job در حال اجرا (پس‌زمینه یا تعاملی) و ثبت گزارش سهمیه آزاد شده در session؛
+        تا ثبت وضعیت نهایی در دفتر (حداکثر timeout ثانیه) منتظر می‌ماند
+        """
+        runner = get_background_job_runner()
+        if not runner.cancel(job_id):
+            return False
+        deadline = time.time() + timeout
+        job = runner.store.load(job_id)
+        while job['state'] in ProcessingJobStore.ACTIVE_STATES and time.time() < deadline:
+            time.sleep(0.2)
+            job = runner.store.load(job_id)
+
+        cancel = job.get('stats', {}).get('cancel', {})
+        succeeded = len([entry for entry in job['files'] if entry['status'] == 'succeeded'])
+        model = job['settings'].get('model', FinancialAnalyzer.DEFAULT_MODEL)
+        remaining = quota_ledger.remaining(api_key_manager.api_keys, model, rate_limiter.daily_limit(model))
+        st.session_state.cancel_report = (
+            f"⛔ پردازش لغو شد: نتایج {succeeded} فایل تکمیل شده حفظ شد، "
+            f"{cancel.get('not_dispatched', 0)} فایل ارسال نشد و {cancel.get('aborted', 0)} فایل در حال پردازش "
+            f"قطع شد | {cancel.get('freed_requests', 0)} درخواست از سهمیه امروز آزاد ماند "
+            f"(باقی‌مانده امروز: {remaining:,} درخواست). فایل‌های لغو شده از «کارهای پردازش من» قابل ادامه هستند."
+        )
+        return True
+
+    def finish_background_job(job_id: str):
+        """بارگذاری نتایج job در session و پایان polling"""
+        st.session_state.results = get_background_job_runner().store.results(job_id)
+        st.session_state.processing_active = False
+        st.session_state.active_job_id = None
+        st.query_params.pop('job', None)
+
+    @st.fragment(run_every=2)
+    def render_background_job_progress(job_id: str):
+        """نمایش پیشرفت job با خواندن وضعیت ذخیره شده روی دیسک (بدون مسدود کردن اسکریپت)"""
+        runner = get_background_job_runner()
+        try:
+            job = runner.store.load(job_id)
+        except (OSError, ValueError):
+            st.session_state.active_job_id = None
+            st.query_params.pop('job', None)
+            return
+        state = runner.display_state(job)
+        files = job['files']
+        counts = defaultdict(int)
+        for entry in files:
+            counts[entry['status']] += 1
+        done = counts['succeeded'] + counts['failed']
+
+        st.markdown(f"#### 🛰️ Job `{job_id}` | {PROCESSING_JOB_STATE_LABELS.get(state, state)}")
+        st.progress(done / max(1, len(files)))
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("✅ موفق", counts['succeeded'])
+        col2.metric("❌ ناموفق", counts['failed'])
+        col3.metric("🔄 در انتظار تلاش مجدد", counts['retrying'])
+        col4.metric("📊 کل", len(files))
+
+        elapsed = (job.get('finished_at') or time.time()) - job.get('started_at', job['created_at'])
+        st.caption(
+            f"⏱️ زمان: {elapsed:.0f}s | تکراری‌ها: {len(job['duplicates'])} | "
+            "می‌توانید این صفحه را ببندید؛ پردازش روی سرور ادامه می‌یابد."
+        )
+        engine = runner.engine(job_id)
+        if engine is not None:
+            st.line_chart(engine.controller.history_frame().set_index('ثانیه'), height=160)
+        elif runner.task_queue is not None and state in ProcessingJobStore.ACTIVE_STATES:
+            queue_stats = runner.task_queue.stats()
+            st.caption(
+                f"🌐 صف مشترک: {queue_stats['workers']} worker فعال | "
+                f"{queue_stats['states'].get('queued', 0)} فایل در صف و {queue_stats['states'].get('leased', 0)} "
+                f"فایل در حال پردازش (همه replicaها)"
+            )
+
+        pending_summaries = [entry for entry in files if entry.get('summary') and entry['status'] != 'succeeded']
+        if pending_summaries:
+            with st.expander(f"📡 خلاصه‌های آماده شده ({len(pending_summaries)})", expanded=False):
+                for entry in pending_summaries:
+                    render_summary_card(entry['name'], entry['summary'], pending=True)
+
+        with st.expander("📄 وضعیت فایل‌ها", expanded=False):
+            st.dataframe(pd.DataFrame([{
+                'فایل': entry['name'],
+                'وضعیت': PROCESSING_FILE_STATUS_LABELS.get(entry['status'], entry['status']),
+                'تلاش': entry['attempt'],
+                'خطا': entry.get('error') or ''
+            } for entry in files]), use_container_width=True, hide_index=True)
+
+        if state in ProcessingJobStore.ACTIVE_STATES and runner.is_running(job_id):
+            if st.button("⛔ لغو پردازش", key=f"job_cancel_{job_id}", use_container_width=True,
+                         help="ارسال فایل‌های جدید متوقف و درخواست‌های در حال اجرا قطع می‌شوند؛ نتایج تکمیل شده حفظ می‌شوند"):
+                cancel_processing_job(job_id)
+                finish_background_job(job_id)
+                st.rerun(scope="app")
+        elif state == 'completed':
+            finish_background_job(job_id)
+            st.rerun(scope="app")
+        elif state in ('failed', 'interrupted', 'cancelled'):
+            if state == 'cancelled':
+                st.warning("⛔ این job لغو شده است؛ فایل‌های لغو شده را می‌توانید ادامه دهید.")
+            else:
+                st.error(f"❌ اجرای job متوقف شد: {job.get('error') or 'سرور یا اسکریپت در حین پردازش متوقف شد'}")
+            col_resume, col_collect = st.columns(2)
+            if col_resume.button("▶️ ادامه پردازش فایل‌های ناتمام", key=f"job_resume_{job_id}",
+                                 type="primary", use_container_width=True):
+                if resume_processing_job(job_id):
+                    st.rerun(scope="app")
+            if col_collect.button("📥 دریافت نتایج تکمیل شده", key=f"job_partial_{job_id}", use_container_width=True):
+                finish_background_job(job_id)
+                st.rerun(scope="app")
+
+    def create_background_jobs_section():
+        """پیشرفت job فعال (حتی پس از refresh صفحه) و فهرست jobهای پس‌زمینه کاربر"""
+        runner = get_background_job_runner()
+        username = st.session_state.get('username')
+        # پس از refresh یا بازگشت با لینک، شناسه job از آدرس صفحه بازیابی می‌شود
+        if not st.session_state.get('active_job_id') and st.query_params.get('job'):
+            try:
+                if runner.store.load(st.query_params['job']).get('owner') == username:
+                    st.session_state.active_job_id = st.query_params['job']
+            except (OSError, ValueError):
+                st.query_params.pop('job', None)
+
+        if st.session_state.get('active_job_id'):
+            render_background_job_progress(st.session_state.active_job_id)
+
+        jobs = runner.store.list_jobs(owner=username)
+        if not jobs:
+            return
+        interrupted = [job for job in jobs if runner.display_state(job) in ('failed', 'interrupted', 'cancelled')]
+        with st.expander(f"🛰️ کارهای پردازش من ({len(jobs)})", expanded=bool(interrupted)):
+            for job in jobs:
+                state = runner.display_state(job)
+                done = len([entry for entry in job['files'] if entry['status'] in ('succeeded', 'failed')])
+                failed = len([entry for entry in job['files'] if entry['status'] == 'failed'])
+                col_info, col_action = st.columns([3, 1])
+                with col_info:
+                    created = datetime.fromtimestamp(job['created_at']).strftime('%Y-%m-%d %H:%M')
+                    mode_label = " (تعاملی)" if job['settings'].get('mode') == 'inline' else ""
+                    failed_label = f"، {failed} ناموفق" if failed else ""
+                    st.markdown(
+                        f"**{job['id']}**{mode_label} | {len(job['names'])} فایل "
+                        f"({done}/{len(job['files'])} پردازش شده{failed_label}) | "
+                        f"{created} | {PROCESSING_JOB_STATE_LABELS.get(state, state)}"
+                    )
+                with col_action:
+                    if state in ProcessingJobStore.ACTIVE_STATES:
+                        if job['id'] != st.session_state.get('active_job_id') and st.button(
+                                "👁️ پیگیری", key=f"job_follow_{job['id']}", use_container_width=True):
+                            st.session_state.active_job_id = job['id']
+                            st.query_params['job'] = job['id']
+                            st.rerun()
+                        if st.button("⛔ لغو", key=f"job_list_cancel_{job['id']}", use_container_width=True):
+                            cancel_processing_job(job['id'])
+                            st.rerun()
+                        continue
+                    if (state in ('failed', 'interrupted', 'cancelled') or failed) and st.button(
+                            "▶️ ادامه", key=f"job_resume_{job['id']}", use_container_width=True,
+                            help="فقط فایل‌های ناتمام یا ناموفق دوباره پردازش می‌شوند"):
+                        if resume_processing_job(job['id']):
+                            st.session_state.active_job_id = job['id']
+                            st.query_params['job'] = job['id']
+                            st.rerun()
+                    if st.button("📥 دریافت نتایج", key=f"job_collect_{job['id']}", use_container_width=True):
+                        finish_background_job(job['id'])
+                        st.rerun()
+
+
     # ========================================================================
     # ✅ تابع اصلاح شده: create_processing_section
     # ========================================================================
 
-    def create_processing_section(uploaded_files):
+    def create_processing_section(uploaded_files, live_results_container=None):
         """
         بخش پردازش فایل‌ها با مدیریت حالت کامل (آماده، در حال پردازش، انجام شده)
         و قابلیت تحلیل مجدد - با استفاده از نام یکسان session_state
@@ -1811,7 +6857,7 @@ if st.session_state.authentication_status:
                 if st.session_state.results:
                     status_text = "تکمیل شد ✅"
                     status_class = "metric-status-done"
-                elif st.session_state.processing_active:
+                elif st.session_state.processing_active or st.session_state.get('active_job_id'):
                     status_text = "در حال پردازش 🔄"
                     status_class = "metric-status-processing"
                 else:
@@ -1833,6 +6879,9 @@ if st.session_state.authentication_status:
             # بخش 2: دکمه‌ها و منطق پردازش (بر اساس حالت فعلی)
             # =========================================================================
 
+            if st.session_state.get('cancel_report'):
+                st.warning(st.session_state.pop('cancel_report'))
+
             # حالت 1: پردازش انجام شده و نتایج موجود است
             if st.session_state.results:
                 # محاسبه تعداد فایل‌های موفق
@@ -1877,9 +6926,29 @@ if st.session_state.authentication_status:
                     </div>
                     """
                 st.markdown(info_html, unsafe_allow_html=True)
+                runner = get_background_job_runner()
+                inline_job_id = st.session_state.get('inline_job_id')
+                if st.button("⛔ توقف پردازش", key="cancel_inline_processing",
+                             help="ارسال فایل‌های جدید متوقف و درخواست‌های در حال اجرا قطع می‌شوند؛ نتایج تکمیل شده حفظ می‌شوند"):
+                    st.session_state.processing_active = False
+                    if inline_job_id and cancel_processing_job(inline_job_id):
+                        st.session_state.results = runner.store.results(inline_job_id)
+                    st.rerun()
+                if inline_job_id and runner.is_running(inline_job_id):
+                    if st.session_state.get('inline_job_inputs') == uploaded_files_fingerprint(uploaded_files):
+                        # rerun عادی (تغییر تنظیمات، کلیک در تب دیگر): job روی event loop سرور ادامه دارد و
+                        # مانند حالت پس‌زمینه فقط پیشرفت آن از دفتر پردازش نمایش داده می‌شود
+                        st.session_state.processing_active = False
+                        st.session_state.inline_job_id = None
+                        st.session_state.active_job_id = inline_job_id
+                        st.query_params['job'] = inline_job_id
+                        st.rerun()
+                    # فایل‌های بارگذاری شده تغییر کرده‌اند؛ batch قبلی دیگر نباید سهمیه مصرف کند
+                    runner.cancel(inline_job_id)
+                    st.session_state.inline_job_id = None
                 # در این حالت، تابع اصلی پردازش فراخوانی می‌شود
                 try:
-                    results = process_files_concurrent_smart(uploaded_files)
+                    results = process_files_concurrent_smart(uploaded_files, live_results_container)
                     st.session_state.results = results
                     st.session_state.processing_active = False
                     st.rerun()  # بازخوانی صفحه برای نمایش حالت "انجام شده"
@@ -1892,10 +6961,41 @@ if st.session_state.authentication_status:
 
             # حالت 3: آماده برای شروع پردازش
             else:
-                if st.button("🚀 شروع تحلیل", type="primary", use_container_width=True):
+                if len(uploaded_files) >= BATCH_SUGGEST_THRESHOLD:
+                    st.info(
+                        f"💡 برای {len(uploaded_files)} فایل، حالت Batch پیشنهاد می‌شود: محدودیت درخواست در دقیقه "
+                        "اعمال نمی‌شود و نیازی به باز ماندن مرورگر نیست."
+                    )
+                col_start, col_batch = st.columns(2)
+                with col_start:
+                    start = st.button("🚀 شروع تحلیل", type="primary", use_container_width=True,
+                                      disabled=bool(st.session_state.get('active_job_id')))
+                if start and st.session_state.background_jobs:
+                    st.session_state.results = None
+                    try:
+                        job_id = start_background_job(uploaded_files)
+                    except Exception as e:
+                        job_id = None
+                        st.error(f"❌ خطا در شروع پردازش پس‌زمینه: {str(e)}")
+                        logger.error(f"Background job start error: {traceback.format_exc()}")
+                    if job_id:
+                        st.session_state.active_job_id = job_id
+                        st.query_params['job'] = job_id
+                        st.rerun()
+                elif start:
                     st.session_state.processing_active = True
+                    st.session_state.inline_job_id = None
                     st.session_state.results = None  # اطمینان از پاک بودن نتایج قبلی
                     st.rerun()
+                with col_batch:
+                    submit_batch = st.button("📦 ارسال به صورت Batch", use_container_width=True,
+                                             help="پردازش آفلاین در صف Batch؛ نتایج بعداً از بخش Jobهای Batch دریافت می‌شود")
+                if submit_batch:
+                    try:
+                        submit_batch_job(uploaded_files)
+                    except Exception as e:
+                        st.error(f"❌ خطا در ارسال Batch: {str(e)}")
+                        logger.error(f"Batch submit error: {traceback.format_exc()}")
 
 
     def get_risk_class(risk_level):
@@ -1940,34 +7040,89 @@ if st.session_state.authentication_status:
                     st.error(f'❌ خطا: {e}')
         return uploaded_files
 
-    def process_files(uploaded_files):
-        analyzer = FinancialAnalyzer()
-        results = []
-        st.markdown('<div class="modern-card"><h3>در حال پردازش...</h3></div>', unsafe_allow_html=True)
-        progress_bar = st.progress(0)
-        status_placeholder = st.empty()
-        total_files = len(uploaded_files)
-        start_time = time.time()
-        for i, file in enumerate(uploaded_files):
-            filename = file['name'] if isinstance(file, dict) else file.name
-            file_content = file['content'] if isinstance(file, dict) else file.getvalue()
-            status_placeholder.info(f'📄 در حال تحلیل فایل {i+1} از {total_files}: {filename}')
-            try:
-                result = analyzer.extract_table_from_page(file_content, filename)
-                results.append((filename, result))
-                status_placeholder.success(f'✅ **{filename}** با موفقیت تحلیل شد.')
-            except Exception as e:
-                error_msg = str(e)
-                logger.error(f"Failed to process {filename}: {error_msg}\n{traceback.format_exc()}")
-                results.append((filename, {"error": f"خطا در تحلیل: {error_msg}"}))
-                status_placeholder.error(f'❌ خطا در تحلیل **{filename}**: {error_msg[:100]}...')
-            progress_bar.progress((i + 1) / total_files)
-        total_duration = time.time() - start_time
-        status_placeholder.success(f'🎉 تحلیل تکمیل شد! {total_files} فایل در {total_duration/60:.1f} دقیقه پردازش شد.')
-        return results
-    
-
+    def render_quota_status(placeholder):
+        """نمایش درخواست‌های باقی‌مانده امروز از دفتر مصرف مشترک در sidebar"""
+        model = FinancialAnalyzer.DEFAULT_MODEL
+        daily_limit = st.session_state.max_requests_per_day
+        usage = quota_ledger.usage(st.session_state.api_keys, model)
+        remaining = sum(max(0, daily_limit - item['requests']) for item in usage.values())
+        total = daily_limit * len(usage)
+        tokens = sum(item['tokens'] for item in usage.values())
+        with placeholder.container():
+            st.progress(remaining / total if total else 0.0)
+            st.caption(
+                f"📒 سهمیه باقی‌مانده امروز ({model}): {remaining:,} از {total:,} درخواست | "
+                f"توکن مصرفی: {tokens:,} | بازنشانی: {quota_ledger.next_reset().strftime('%H:%M')}"
+            )
 
+    KEY_STATE_LABELS = {
+        APIKeyManager.CLOSED: '🟢 فعال',
+        APIKeyManager.HALF_OPEN: '🟡 آزمایشی',
+        APIKeyManager.OPEN: '🔴 قطع موقت'
+    }
+
+    def render_key_health(placeholder):
+        """نمایش وضعیت circuit breaker، نرخ موفقیت و تأخیر هر کلید برای اپراتور"""
+        report = api_key_manager.health_report()
+        usage = quota_ledger.usage(api_key_manager.api_keys, FinancialAnalyzer.DEFAULT_MODEL)
+        requests_today = {api_key_id(key): item['requests'] for key, item in usage.items()}
+        with placeholder.container():
+            with st.expander("🩺 سلامت کلیدهای API", expanded=False):
+                st.dataframe(pd.DataFrame([{
+                    'کلید': item['key'],
+                    'وضعیت': KEY_STATE_LABELS[item['state']],
+                    'نرخ موفقیت': f"{item['success_rate']:.0%}",
+                    'تأخیر (s)': f"{item['latency']:.1f}" if item['latency'] else '-',
+                    'موفق/ناموفق': f"{item['successes']}/{item['failures']}",
+                    'درخواست امروز': requests_today.get(item['key_id'], 0),
+                    'پایان قطع (s)': f"{item['cooldown_left']:.0f}" if item['cooldown_left'] else '-'
+                } for item in report]), hide_index=True, use_container_width=True)
+                errors = [item for item in report if item['state'] != APIKeyManager.CLOSED and item['last_error']]
+                for item in errors:
+                    st.caption(f"{item['key']}: {item['last_error']}")
+                sessions = api_key_manager.session_report()
+                if sessions:
+                    st.caption("👥 مصرف sessionهای این فرایند")
+                    st.dataframe(pd.DataFrame([{
+                        'کاربر': item['user'],
+                        'session': item['session_id'][:8],
+                        'درخواست': item['requests'],
+                        'ناموفق': item['failures'],
+                        'توکن': f"{item['tokens']:,}",
+                        'آخرین فعالیت': datetime.fromtimestamp(item['last_seen']).strftime('%H:%M:%S')
+                    } for item in sessions]), hide_index=True, use_container_width=True)
+
+    FAIR_SHARE_ADMIN = os.getenv("FAIR_SHARE_ADMIN", "admin")
+
+    def render_fair_share_stats(placeholder):
+        """سهم هر تحلیلگر از ظرفیت مشترک، گذردهی و زمان انتظار در صف؛ فقط برای حساب مدیر"""
+        if st.session_state.get('username') != FAIR_SHARE_ADMIN:
+            return
+        scheduler = get_fair_scheduler()
+        rows = {item['user']: item for item in scheduler.report()}
+        task_queue = get_background_job_runner().task_queue
+        queued = task_queue.owner_stats() if task_queue is not None else {}
+        if not rows and not queued:
+            return
+        with placeholder.container():
+            with st.expander("⚖️ سهم منصفانه تحلیلگران", expanded=False):
+                st.caption(
+                    f"ظرفیت مشترک: {scheduler.capacity} درخواست همزمان | در حال استفاده: {scheduler.in_flight} | "
+                    f"خط سریع: jobهای تا {scheduler.express_files} فایل"
+                )
+                st.dataframe(pd.DataFrame([{
+                    'کاربر': user or '-',
+                    'وزن': f"{scheduler.weight(user):g}",
+                    'در حال پردازش': rows.get(user, {}).get('in_flight', 0),
+                    'در صف': rows.get(user, {}).get('waiting', 0),
+                    'صف مشترک (در صف/در حال اجرا)': (f"{queued[user]['queued']}/{queued[user]['leased']}"
+                                                     if user in queued else '-'),
+                    'تکمیل شده': rows.get(user, {}).get('completed', 0),
+                    'خط سریع': rows.get(user, {}).get('express', 0),
+                    'گذردهی (فایل/دقیقه)': f"{rows.get(user, {}).get('files_per_min', 0.0):.1f}",
+                    'میانگین انتظار (s)': f"{rows.get(user, {}).get('avg_wait', 0.0):.1f}",
+                    'بیشترین انتظار (s)': f"{rows.get(user, {}).get('max_wait', 0.0):.1f}"
+                } for user in sorted(set(rows) | set(queued), key=str)]), hide_index=True, use_container_width=True)
 
     @st.cache_data
     def convert_to_excel(results):
@@ -2198,6 +7353,17 @@ if st.session_state.authentication_status:
                 logger.error(f"Traceback: {traceback.format_exc()}")
         
         return excel_files
+    def render_summary_card(filename, analysis, pending=False):
+        """کارت خلاصه یک فایل؛ pending برای نتایج زودهنگام streaming که هنوز کامل نشده‌اند"""
+        company_name = analysis.get('نام_شرکت', 'N/A')
+        auditor_name = analysis.get('نام_حسابرس', 'N/A')
+        opinion_type = analysis.get('نوع_اظهارنظر', 'N/A')
+        risk_level = analysis.get('سطح_ریسک_کلی_بنا_به_گزارش', 'N/A')
+        financial_year = analysis.get('دوره_مالی', 'N/A')
+        risk_class = get_risk_class(risk_level)
+        status_icon = '<span class="status-icon">⏳</span>' if pending else '<span class="status-icon success">✓</span>'
+        st.markdown(f'<div class="new-result-card"><div class="card-header"><h5>{filename} {status_icon}</h5></div><div class="new-card-grid"><div class="new-info-box"><div class="new-info-label">🏢 شرکت</div><div class="new-info-value">{company_name}</div></div><div class="new-info-box"><div class="new-info-label">📅 دوره مالی</div><div class="new-info-value">{financial_year}</div></div><div class="new-info-box"><div class="new-info-label">👨‍💼 حسابرس</div><div class="new-info-value">{auditor_name}</div></div><div class="new-info-box"><div class="new-info-label">📋 اظهارنظر</div><div class="new-info-value">{opinion_type}</div></div><div class="new-info-box new-risk-box {risk_class}"><div class="new-info-label">⚠️ سطح ریسک</div><div class="new-info-value">{risk_level}</div></div></div></div>', unsafe_allow_html=True)
+
     def create_results_section(results):
         if not results:
             return
@@ -2210,13 +7376,7 @@ if st.session_state.authentication_status:
                     continue
                 try:
                     analysis = result['تحلیل_جامع_گزارش_حسابرسی']['بخش۱_خلاصه_و_اطلاعات_کلیدی']
-                    company_name = analysis.get('نام_شرکت', 'N/A')
-                    auditor_name = analysis.get('نام_حسابرس', 'N/A')
-                    opinion_type = analysis.get('نوع_اظهارنظر', 'N/A')
-                    risk_level = analysis.get('سطح_ریسک_کلی_بنا_به_گزارش', 'N/A')
-                    financial_year = analysis.get('دوره_مالی', 'N/A')
-                    risk_class = get_risk_class(risk_level)
-                    st.markdown(f'<div class="new-result-card"><div class="card-header"><h5>{filename} <span class="status-icon success">✓</span></h5></div><div class="new-card-grid"><div class="new-info-box"><div class="new-info-label">🏢 شرکت</div><div class="new-info-value">{company_name}</div></div><div class="new-info-box"><div class="new-info-label">📅 دوره مالی</div><div class="new-info-value">{financial_year}</div></div><div class="new-info-box"><div class="new-info-label">👨‍💼 حسابرس</div><div class="new-info-value">{auditor_name}</div></div><div class="new-info-box"><div class="new-info-label">📋 اظهارنظر</div><div class="new-info-value">{opinion_type}</div></div><div class="new-info-box new-risk-box {risk_class}"><div class="new-info-label">⚠️ سطح ریسک</div><div class="new-info-value">{risk_level}</div></div></div></div>', unsafe_allow_html=True)
+                    render_summary_card(filename, analysis)
                 except Exception as e:
                     st.warning(f"⚠️ خطایی در نمایش نتایج فایل {filename} رخ داد: {e}")
         st.markdown("---")
@@ -3494,7 +8654,16 @@ if st.session_state.authentication_status:
             st.session_state.processing_active = False
 
         create_header()
+        render_quota_status(quota_status_placeholder)
+        render_key_health(key_health_placeholder)
+        render_fair_share_stats(fair_share_placeholder)
         tab1, tab2, tab3, tab4 = st.tabs(["📤 آپلود و پردازش", "📊نتایج تحلیل", "📈 اطلاعات آماری", "📉 ترند و نمودارها"])
+
+        # در حین پردازش، خلاصه هر فایل به محض آماده شدن در تب نتایج نمایش داده می‌شود
+        live_results_container = None
+        if st.session_state.processing_active:
+            with tab2:
+                live_results_container = st.container()
         
         with tab1:
             with st.expander("📋 راهنمای بارگذاری فایل", expanded=False):
@@ -3531,12 +8700,14 @@ if st.session_state.authentication_status:
 
             uploaded_files = create_file_upload_section()
             if uploaded_files:
-                create_processing_section(uploaded_files)
+                create_processing_section(uploaded_files, live_results_container)
+            create_background_jobs_section()
+            create_batch_jobs_section()
 
         with tab2:
             if st.session_state.results:
                 create_results_section(st.session_state.results)
-            else:
+            elif not live_results_container:
                 st.info("هنوز فایلی پردازش نشده است.")
         
         with tab3:
@@ -0,0 +1,37 @@
+"""
+بارگذاری app.py بیرون از Streamlit برای تست‌ها (همان مسیر tools/extraction_worker.py)
+
+هیچ درخواستی به Gemini ارسال نمی‌شود؛ کلیدها ساختگی هستند و پوشه کش موقتی است.
+"""
+import os
+import runpy
+import tempfile
+
+import pytest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+
+
+@pytest.fixture(scope='session')
+def app():
+    os.environ.setdefault("GOOGLE_API_KEYS", "test-key-1,test-key-2,test-key-3")
+    os.environ.setdefault("ANALYSIS_CACHE_DIR", tempfile.mkdtemp(prefix='app-tests-'))
+    cwd = os.getcwd()
+    # config.yaml و style.css نسبت به پوشه برنامه خوانده می‌شوند
+    os.chdir(os.path.dirname(APP_PATH))
+    try:
+        namespace = runpy.run_path(APP_PATH, run_name='__extraction_worker__')
+    finally:
+        os.chdir(cwd)
+    return namespace
+
+
+@pytest.fixture
+def app_globals(app):
+    """globals واقعی توابع app.py (خروجی run_path فقط یک کپی است)؛ برای monkeypatch.setitem"""
+    return app['acquire_client_async'].__globals__
+
+
+@pytest.fixture
+def ledger(app, tmp_path):
+    return app['QuotaLedger'](str(tmp_path / 'ledger'))
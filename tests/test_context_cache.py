@@ -0,0 +1,65 @@
+import threading
+import time
+
+
+class SlowBackend:
+    """به جای Gemini: ساخت هر کش delay ثانیه طول می‌کشد"""
+
+    local = True
+
+    def __init__(self, delay=0.3, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.created = []
+        self.deleted = []
+
+    def create(self, client, model, system_instruction, text, ttl_seconds):
+        name = f'cache-{len(self.created)}'
+        self.created.append(name)
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError('quota')
+        return {'name': name, 'token_count': 100}
+
+    def delete(self, client, name):
+        self.deleted.append(name)
+
+
+def test_concurrent_callers_share_one_creation_per_key(app):
+    backend = SlowBackend()
+    manager = app['ContextCacheManager'](backend)
+    entries = {}
+
+    def get(index, api_key):
+        entries[index] = manager.get_or_create(None, api_key, 'm', 'sys', 'schema')
+
+    threads = [threading.Thread(target=get, args=(index, api_key)) for index, api_key in enumerate('aaab')]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # ساخت کش کلید b پشت ساخت کلید a منتظر نمی‌ماند
+    assert time.time() - start < 0.5
+    assert len(backend.created) == 2
+    assert entries[0] is entries[1] is entries[2]
+    assert entries[3]['name'] != entries[0]['name']
+
+
+def test_failed_creation_is_not_retried_during_cooldown(app):
+    backend = SlowBackend(delay=0, fail=True)
+    manager = app['ContextCacheManager'](backend)
+    assert manager.get_or_create(None, 'a', 'm', 'sys', 'schema') is None
+    assert manager.get_or_create(None, 'a', 'm', 'sys', 'schema') is None
+    assert len(backend.created) == 1
+
+
+def test_entry_close_to_expiry_is_rebuilt_and_old_cache_deleted(app):
+    backend = SlowBackend(delay=0)
+    manager = app['ContextCacheManager'](backend)
+    first = manager.get_or_create(None, 'a', 'm', 'sys', 'schema')
+    first['expires_at'] = time.time() + manager.REFRESH_MARGIN_SECONDS - 1
+    second = manager.get_or_create(None, 'a', 'm', 'sys', 'schema')
+    assert second['name'] != first['name']
+    assert backend.deleted == [first['name']]
@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+WORDS = [f'واژه{i}' for i in range(400)]
+
+
+def report(seed, count=300):
+    rng = random.Random(seed)
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+@pytest.fixture
+def detector(app, monkeypatch):
+    """محتوای هر «فایل» به صورت «تعداد صفحات|متن» است تا بدون ساخت PDF فقط MinHash آزموده شود"""
+    detector = app['DuplicateDetector'](threshold=0.9)
+
+    def fingerprint(content):
+        pages, text = content.decode('utf-8').split('|', 1)
+        return {'pages': int(pages), 'signature': detector.signature(text)}
+
+    monkeypatch.setattr(detector, 'fingerprint', fingerprint)
+    return detector
+
+
+def file(text, pages=10):
+    return f'{pages}|{text}'.encode('utf-8')
+
+
+def test_normalization_unifies_arabic_letters_and_zwnj(app):
+    assert app['DuplicateDetector'].normalize_words('كتاب‌ها  عليـ') == ['کتابها', 'علی']
+    assert app['AuditorReportLocator'].normalize_text('گزارش  حسابرس') == 'گزارشحسابرس'
+
+
+def test_exact_copies_point_to_the_first_file(detector):
+    text = report(1)
+    duplicates = detector.find_duplicates([file(text), file(report(2)), file(text), file(text)])
+    assert duplicates == {2: {'of': 0, 'kind': 'exact', 'similarity': 1.0},
+                          3: {'of': 0, 'kind': 'exact', 'similarity': 1.0}}
+
+
+def test_resaved_report_is_a_near_duplicate(detector):
+    text = report(1)
+    # همان گزارش با یک کلمه اضافه در انتها (ذخیره مجدد با متادیتای متفاوت)
+    duplicates = detector.find_duplicates([file(text), file(text + ' پایان')])
+    assert duplicates[1]['of'] == 0 and duplicates[1]['kind'] == 'similar'
+    assert duplicates[1]['similarity'] >= 0.9
+
+
+def test_different_reports_or_page_counts_are_kept(detector):
+    text = report(1)
+    assert detector.find_duplicates([file(text), file(report(2))]) == {}
+    assert detector.find_duplicates([file(text), file(text + ' پایان', pages=11)]) == {}
+
+
+def test_short_text_is_only_compared_by_hash(detector):
+    assert detector.signature(report(1, count=20)) is None
+    assert detector.find_duplicates([file(report(1, count=20)), file(report(1, count=20) + ' x')]) == {}
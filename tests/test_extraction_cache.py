@@ -0,0 +1,54 @@
+import pytest
+
+
+@pytest.fixture
+def cache(app, tmp_path):
+    return app['ExtractionCache'](str(tmp_path / 'cache'))
+
+
+def test_miss_then_hit_after_put(cache):
+    assert cache.get(b'%PDF-1', 'fp') is None
+    cache.put(b'%PDF-1', 'fp', {'ok': 1}, 'a.pdf')
+    assert cache.get(b'%PDF-1', 'fp') == {'ok': 1}
+    assert cache.contains(b'%PDF-1', 'fp')
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+
+
+def test_key_is_content_addressed(cache):
+    cache.put(b'%PDF-1', 'fp', {'ok': 1}, 'a.pdf')
+    # نام فایل در کلید نیست؛ محتوای متفاوت نتیجه دیگری است
+    assert cache.get_by_hash(cache.file_hash(b'%PDF-1'), 'fp') == {'ok': 1}
+    assert cache.get(b'%PDF-2', 'fp') is None
+
+
+def test_changed_settings_invalidate_results(app, cache):
+    analyzer = app['FinancialAnalyzer'](cache=cache)
+    cache.put(b'%PDF-1', analyzer.cache_fingerprint(), {'ok': 1})
+    assert analyzer._get_cached(b'%PDF-1', 'a.pdf') == {'ok': 1}
+
+    analyzer.model_name = 'gemini-2.5-pro'
+    assert analyzer._get_cached(b'%PDF-1', 'a.pdf') is None
+    analyzer.model_name = analyzer.DEFAULT_MODEL
+    analyzer.prompt += ' '
+    assert analyzer._get_cached(b'%PDF-1', 'a.pdf') is None
+
+
+def test_expired_entries_are_misses_and_evicted(app, tmp_path):
+    cache = app['ExtractionCache'](str(tmp_path / 'cache'))
+    cache.max_age_seconds = -1
+    cache.put(b'%PDF-1', 'fp', {'ok': 1})
+    assert not cache.contains(b'%PDF-1', 'fp')
+    assert cache.get(b'%PDF-1', 'fp') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_size_limit_evicts_least_recently_used(app, tmp_path):
+    cache = app['ExtractionCache'](str(tmp_path / 'cache'), max_size_mb=0)
+    cache.max_size_bytes = 60
+    cache.put(b'a', 'fp', {'v': 'x' * 20})
+    cache.put(b'b', 'fp', {'v': 'y' * 20})
+    cache.get(b'a', 'fp')
+    cache.put(b'c', 'fp', {'v': 'z' * 20})
+    assert cache.contains(b'a', 'fp') and cache.contains(b'c', 'fp')
+    assert not cache.contains(b'b', 'fp')
@@ -0,0 +1,166 @@
+import asyncio
+import threading
+
+import pytest
+
+
+class StubAnalyzer:
+    """به جای FinancialAnalyzer: هر فایل پس از delay ثانیه نتیجه می‌دهد یا خطای errors را بالا می‌برد"""
+
+    section_parallel = False
+
+    def __init__(self, delay=0.05, errors=None):
+        self.delay = delay
+        self.errors = dict(errors or {})
+        self.on_call = None
+        self.calls = []
+
+    async def extract_table_from_page_async(self, file_content, filename):
+        self.calls.append(filename)
+        await asyncio.sleep(self.delay)
+        if self.errors.get(filename):
+            raise Exception(self.errors[filename].pop(0))
+        return {'file': filename}
+
+
+def make_files(count):
+    return [{'name': f'{i}.pdf', 'content': b'%PDF'} for i in range(count)]
+
+
+def run_engine(engine, files, order=None):
+    outcomes = []
+    stats = asyncio.run(engine.run(files, lambda outcome, attempt, retry: outcomes.append((outcome, retry)), order=order))
+    return outcomes, stats
+
+
+def test_transient_errors_are_retried_in_the_queue(app, monkeypatch):
+    monkeypatch.setattr(app['AsyncExtractionEngine'], 'BASE_BACKOFF', 0.01)
+    analyzer = StubAnalyzer(errors={'1.pdf': ['503 unavailable']})
+    engine = app['AsyncExtractionEngine'](analyzer, max_concurrency=2)
+    outcomes, _ = run_engine(engine, make_files(3))
+
+    final = {outcome[1]: outcome for outcome, retry in outcomes if not retry}
+    assert set(final) == {'0.pdf', '1.pdf', '2.pdf'}
+    assert all(outcome[3] is None for outcome in final.values())
+    assert analyzer.calls.count('1.pdf') == 2
+
+
+def test_permanent_errors_are_not_retried(app):
+    analyzer = StubAnalyzer(errors={'0.pdf': ['invalid pdf structure']})
+    engine = app['AsyncExtractionEngine'](analyzer, max_concurrency=1)
+    outcomes, _ = run_engine(engine, make_files(1))
+    assert [(outcome[3], retry) for outcome, retry in outcomes] == [('invalid pdf structure', False)]
+
+
+def test_incomplete_repair_is_requeued_with_the_healthy_sections(app, monkeypatch):
+    monkeypatch.setattr(app['AsyncExtractionEngine'], 'BASE_BACKOFF', 0.01)
+    analyzer = app['FinancialAnalyzer']()
+    summary, analysis, checklist = analyzer.SECTION_KEYS
+    healthy = {analysis: {'ok': True}, checklist: [{'موضوع': topic} for topic in analyzer.checklist_topics()]}
+    repairs = []
+
+    async def call(payload, file_content, filename, schema=None, prompt=None, calibrate=True, model=None):
+        if schema is None:
+            raise app['ExtractionDefectError']({analyzer.ROOT_KEY: dict(healthy)}, [summary], [], False)
+        repairs.append(prompt)
+        if len(repairs) == 1:
+            raise Exception('503 unavailable')
+        return {analyzer.ROOT_KEY: {summary: {'ok': True}}}
+
+    analyzer._call_model_hedged = call
+    engine = app['AsyncExtractionEngine'](analyzer, max_concurrency=1)
+    outcomes, _ = run_engine(engine, [{'name': 'a.pdf', 'content': b'%PDF-1'}])
+
+    assert outcomes[0][1] is True
+    assert 'Incomplete response' in outcomes[0][0][3]
+    final = outcomes[-1][0]
+    assert final[3] is None
+    assert final[2][analyzer.ROOT_KEY] == {summary: {'ok': True}, **healthy}
+    # تلاش دوم فقط بخش معیوب را دوباره درخواست کرده است، نه کل فایل را
+    assert repairs == [analyzer.section_prompt(summary)] * 2
+    assert analyzer.partial_sections == {}
+
+
+def test_dispatch_follows_order(app):
+    analyzer = StubAnalyzer(delay=0.01)
+    engine = app['AsyncExtractionEngine'](analyzer, max_concurrency=1)
+    run_engine(engine, make_files(3), order=[2, 0, 1])
+    assert analyzer.calls == ['2.pdf', '0.pdf', '1.pdf']
+
+
+def test_longest_first_shortens_the_batch(app):
+    limits = app['APILimitsManager']
+    seconds = [10, 10, 10, 10, 40]
+    order = limits.dispatch_order(seconds, 'longest')
+    assert order[0] == 4
+    assert limits.dispatch_order(seconds, 'shortest')[-1] == 4
+    assert limits.dispatch_order(seconds, 'upload') == [0, 1, 2, 3, 4]
+    # با دو worker، فایل بزرگ در انتهای صف تنها نمی‌ماند
+    assert limits.simulate_makespan(seconds, 2, order) == 40
+    assert limits.simulate_makespan(seconds, 2, [0, 1, 2, 3, 4]) == 60
+
+
+def test_cancel_keeps_finished_results_and_skips_the_rest(app):
+    analyzer = StubAnalyzer(delay=0.2)
+    engine = app['AsyncExtractionEngine'](analyzer, max_concurrency=2)
+    files = make_files(6)
+    # لغو از thread دیگر، مانند دکمه توقف در Streamlit
+    timer = threading.Timer(0.3, engine.cancel)
+    timer.start()
+    try:
+        outcomes, stats = run_engine(engine, files)
+    finally:
+        timer.cancel()
+
+    finished = [outcome for outcome, _ in outcomes]
+    assert 1 <= len(finished) < len(files)
+    assert all(outcome[3] is None for outcome in finished)
+    assert stats['aborted'] + stats['not_dispatched'] + len(finished) == len(files)
+    assert stats['not_dispatched'] >= 1
+    assert stats['freed_requests'] >= stats['not_dispatched']
+
+
+@pytest.mark.parametrize('express', [False, True])
+def test_fair_share_scheduler_releases_every_grant(app, express):
+    scheduler = app['FairShareScheduler'](capacity=1)
+    engine = app['AsyncExtractionEngine'](StubAnalyzer(delay=0.01), max_concurrency=3, scheduler=scheduler,
+                                          user='alice', express=express)
+    outcomes, _ = run_engine(engine, make_files(4))
+    assert len(outcomes) == 4
+    assert scheduler.in_flight == 0 and scheduler.express_in_flight == 0
+
+
+def test_capacity_follows_attached_controllers(app):
+    scheduler = app['FairShareScheduler'](ceiling=20)
+    assert scheduler.capacity == 20
+    small = app['AdaptiveConcurrencyController'](initial=3)
+    large = app['AdaptiveConcurrencyController'](initial=4)
+    scheduler.attach(small, requests_per_file=2)
+    assert scheduler.capacity == 6
+    scheduler.attach(large, requests_per_file=6)
+    # سقف فرایند رعایت می‌شود
+    assert scheduler.capacity == 20
+    scheduler.detach(large)
+    assert scheduler.capacity == 6
+    assert app['FairShareScheduler'](capacity=2, ceiling=20).capacity == 2
+
+
+def test_waiting_users_are_served_round_robin(app):
+    scheduler = app['FairShareScheduler'](capacity=1)
+    granted = []
+
+    async def work(user):
+        await scheduler.acquire(user)
+        granted.append(user)
+        await asyncio.sleep(0.01)
+        scheduler.release(user)
+
+    async def main():
+        tasks = [asyncio.create_task(work('alice')) for _ in range(6)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(work('bob')) for _ in range(2)]
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    # batch کوچک bob پشت شش فایل alice نمی‌ماند
+    assert granted[:5].count('bob') == 2
@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+import pytest
+
+
+def test_delay_uses_fallback_until_enough_samples(app):
+    policy = app['HedgingPolicy'](percentile=50, min_delay=0.5, fallback_delay=30)
+    for seconds in range(1, policy.MIN_SAMPLES):
+        policy.record(float(seconds))
+    assert policy.hedge_delay() == 30
+    policy.record(10.0)
+    assert policy.hedge_delay() == pytest.approx(5.5)
+
+
+def test_delay_never_drops_below_min_delay(app):
+    policy = app['HedgingPolicy'](min_delay=5)
+    for _ in range(policy.MIN_SAMPLES):
+        policy.record(0.1)
+    assert policy.hedge_delay() == 5
+
+
+def test_budget_limits_hedges_to_ratio_of_requests(app):
+    policy = app['HedgingPolicy'](budget_ratio=0.1)
+    for _ in range(20):
+        policy.start_request()
+    assert [policy.try_acquire() for _ in range(3)] == [True, True, False]
+    assert policy.report()['budget_denied'] == 1
+
+
+def test_cancelled_primary_stays_in_window_and_is_estimated(app):
+    policy = app['HedgingPolicy']()
+    for seconds in (1.0, 2.0, 12.0, 20.0):
+        policy.record(seconds)
+    policy.record(8.0, hedge_won=True, primary_cancelled=True)
+    # زمان لغو حد پایین تأخیر درخواست اصلی است و از پنجره صدک حذف نمی‌شود
+    assert list(policy.samples)[-1] == 8.0
+    report = policy.report()
+    assert report['hedge_wins'] == 1 and report['estimated'] == 1 and report['lower_bound'] == 0
+    # تأخیر تخمینی درخواست لغو شده: میانه تأخیرهای کندتر از ۸ ثانیه (۱۶)
+    assert report['with_hedging']['p50'] == 8.0
+    assert report['without_hedging']['p50'] == 12.0
+
+
+def test_hedge_only_records_a_lower_bound_without_slower_samples(app):
+    policy = app['HedgingPolicy']()
+    policy.record(1.0)
+    policy.record(8.0, hedge_won=True, primary_cancelled=True)
+    assert policy.report()['lower_bound'] == 1
+
+
+class FakeModel:
+    """به جای _call_model_async: تأخیر هر کلید از delays خوانده می‌شود"""
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.cancelled = []
+
+    async def __call__(self, payload, file_content, filename, schema=None, prompt=None, calibrate=True,
+                       client_key=None, model=None, timing=None):
+        await asyncio.sleep(0.05)   # انتظار rate limiter؛ جزو تأخیر مدل نیست
+        if timing is not None:
+            timing['sent'] = time.perf_counter()
+        try:
+            await asyncio.sleep(self.delays[client_key[1]])
+        except asyncio.CancelledError:
+            self.cancelled.append(client_key[1])
+            raise
+        if timing is not None:
+            timing['seconds'] = time.perf_counter() - timing['sent']
+        return {'key': client_key[1]}
+
+
+@pytest.fixture
+def hedged_analyzer(app, app_globals, monkeypatch):
+    monkeypatch.setitem(app_globals, 'get_client_with_retry',
+                        lambda exclude_key=None, model=None: (None, 'backup' if exclude_key else 'primary'))
+    policy = app['HedgingPolicy'](fallback_delay=0.1)
+    return app['FinancialAnalyzer'](hedging=policy)
+
+
+def test_slow_primary_is_hedged_and_cancelled(hedged_analyzer):
+    fake = hedged_analyzer._call_model_async = FakeModel({'primary': 2.0, 'backup': 0.05})
+    data = asyncio.run(hedged_analyzer._call_model_hedged(b'', b'', 'a.pdf'))
+    assert data == {'key': 'backup'}
+    assert fake.cancelled == ['primary']
+    report = hedged_analyzer.hedging.report()
+    assert report['hedges'] == 1 and report['hedge_wins'] == 1
+    # تأخیر از ارسال درخواست اصلی به مدل سنجیده می‌شود: آستانه ۰٫۱ ثانیه + ۰٫۱ ثانیه hedge
+    assert hedged_analyzer.hedging.effective_latencies[0] < 0.3
+
+
+def test_fast_primary_records_model_latency_only(hedged_analyzer):
+    hedged_analyzer._call_model_async = FakeModel({'primary': 0.02})
+    assert asyncio.run(hedged_analyzer._call_model_hedged(b'', b'', 'a.pdf')) == {'key': 'primary'}
+    assert hedged_analyzer.hedging.hedges == 0
+    assert list(hedged_analyzer.hedging.samples)[0] < 0.05
+
+
+def test_cancelling_during_hedge_delay_cancels_primary(hedged_analyzer):
+    hedged_analyzer.hedging.fallback_delay = 5
+    fake = hedged_analyzer._call_model_async = FakeModel({'primary': 2.0})
+
+    async def cancel_early():
+        task = asyncio.create_task(hedged_analyzer._call_model_hedged(b'', b'', 'a.pdf'))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0)
+
+    asyncio.run(cancel_early())
+    assert fake.cancelled == ['primary']
@@ -0,0 +1,43 @@
+import json
+
+
+def feed_in_chunks(parser, text, size):
+    completed = []
+    for start in range(0, len(text), size):
+        completed += parser.feed(text[start:start + size])
+    return completed
+
+
+DOCUMENT = json.dumps({
+    'root': {
+        'summary': {'name': 'شرکت "الف" {سهامی}', 'points': ['a', 'b]']},
+        'checklist': [{'topic': 'x', 'ok': True}, {'topic': 'y\\', 'ok': False}]
+    }
+}, ensure_ascii=False)
+
+
+def test_sections_are_emitted_as_soon_as_they_close(app):
+    parser = app['IncrementalJSONParser'](['summary', 'checklist'])
+    end_of_summary = DOCUMENT.index('"checklist"')
+    first = parser.feed(DOCUMENT[:end_of_summary])
+    assert first == [('summary', {'name': 'شرکت "الف" {سهامی}', 'points': ['a', 'b]']})]
+    rest = parser.feed(DOCUMENT[end_of_summary:])
+    assert rest == [('checklist', [{'topic': 'x', 'ok': True}, {'topic': 'y\\', 'ok': False}])]
+
+
+def test_chunk_boundaries_do_not_change_the_result(app):
+    expected = app['IncrementalJSONParser'](['summary', 'checklist']).feed(DOCUMENT)
+    for size in (1, 2, 7, 64):
+        assert feed_in_chunks(app['IncrementalJSONParser'](['summary', 'checklist']), DOCUMENT, size) == expected
+
+
+def test_only_target_keys_are_emitted_once(app):
+    parser = app['IncrementalJSONParser'](['points'])
+    text = '{"a": {"points": [1]}, "b": {"points": [2]}, "other": [3]}'
+    assert parser.feed(text) == [('points', [1])]
+
+
+def test_truncated_section_is_not_emitted(app):
+    parser = app['IncrementalJSONParser'](['summary', 'checklist'])
+    cut = DOCUMENT.index('"y')
+    assert [key for key, _ in parser.feed(DOCUMENT[:cut])] == ['summary']
@@ -0,0 +1,93 @@
+import pytest
+
+
+@pytest.fixture
+def store(app, tmp_path):
+    return app['ProcessingJobStore'](str(tmp_path / 'jobs'))
+
+
+def make_files(count):
+    return [{'name': f'report-{i}.pdf', 'content': b'%PDF-' + bytes([i])} for i in range(count)]
+
+
+def test_duplicates_are_stored_once_and_share_results(store):
+    files = make_files(2) + [{'name': 'copy.pdf', 'content': b'%PDF-' + bytes([0])}]
+    job = store.create(files, {2: {'of': 0}}, owner='alice')
+    assert [entry['name'] for entry in job['files']] == ['report-0.pdf', 'report-1.pdf']
+    assert len(store.inputs(job)) == 2
+
+
+def test_resume_returns_only_unfinished_files(store):
+    job = store.create(make_files(4), {}, owner='alice')
+    store.record_outcome(job['id'], 0, (0, 'report-0.pdf', {'ok': 0}, None, False), 1, False)
+    store.record_outcome(job['id'], 1, (1, 'report-1.pdf', None, '503', True), 1, True)
+    store.record_outcome(job['id'], 2, (2, 'report-2.pdf', None, 'bad pdf', False), 3, False)
+
+    job = store.load(job['id'])
+    assert [entry['status'] for entry in job['files']] == ['succeeded', 'retrying', 'failed', 'pending']
+    assert store.unfinished(job) == [1, 2, 3]
+    assert [item['name'] for item in store.inputs(job, store.unfinished(job))] == \
+        ['report-1.pdf', 'report-2.pdf', 'report-3.pdf']
+
+
+def test_succeeded_file_without_result_is_resumed(store, tmp_path):
+    job = store.create(make_files(1), {})
+    store.record_outcome(job['id'], 0, (0, 'report-0.pdf', {'ok': 0}, None, False), 1, False)
+    (tmp_path / 'jobs' / job['id'] / 'results' / '0.json').unlink()
+    assert store.unfinished(store.load(job['id'])) == [0]
+
+
+def test_file_updates_append_to_the_journal_without_rewriting_job_json(store, tmp_path):
+    job = store.create(make_files(2), {})
+    job_json = tmp_path / 'jobs' / job['id'] / 'job.json'
+    before = job_json.read_bytes()
+    store.update_file(job['id'], 0, status='retrying', attempt=1)
+    store.update_files(job['id'], [0, 1], status='pending', attempt=0)
+    store.update_file(job['id'], 1, summary={'risk': 'low'})
+
+    assert job_json.read_bytes() == before
+    assert len((tmp_path / 'jobs' / job['id'] / 'files.jsonl').read_text(encoding='utf-8').splitlines()) == 4
+    files = store.load(job['id'])['files']
+    assert [(entry['status'], entry['attempt']) for entry in files] == [('pending', 0), ('pending', 0)]
+    assert files[1]['summary'] == {'risk': 'low'}
+
+
+def test_torn_journal_line_is_ignored(store, tmp_path):
+    job = store.create(make_files(2), {})
+    store.record_outcome(job['id'], 0, (0, 'report-0.pdf', {'ok': 0}, None, False), 1, False)
+    # خاموش شدن سرور در میانه نوشتن خط بعدی
+    with open(tmp_path / 'jobs' / job['id'] / 'files.jsonl', 'a', encoding='utf-8') as f:
+        f.write('{"position": 1, "at": 1, "fie')
+    assert [entry['status'] for entry in store.load(job['id'])['files']] == ['succeeded', 'pending']
+
+
+def test_deferred_writes_keep_their_order(store):
+    job = store.create(make_files(1), {})
+    store.defer(store.update_file, job['id'], 0, status='retrying', attempt=1)
+    store.defer(store.record_outcome, job['id'], 0, (0, 'report-0.pdf', {'ok': 0}, None, False), 2, False)
+    store.defer(store.update, job['id'], state='completed')
+    store.flush()
+    job = store.load(job['id'])
+    assert job['state'] == 'completed'
+    assert (job['files'][0]['status'], job['files'][0]['attempt']) == ('succeeded', 2)
+
+
+def test_mark_cancelled_keeps_finished_results(store):
+    job = store.create(make_files(3), {})
+    store.record_outcome(job['id'], 0, (0, 'report-0.pdf', {'ok': 0}, None, False), 1, False)
+    assert store.mark_cancelled(job['id']) == 2
+
+    results = store.results(job['id'])
+    assert results[0] == ('report-0.pdf', {'ok': 0})
+    assert results[1] == ('report-1.pdf', {'error': 'پردازش این فایل لغو شد'})
+    # فایل‌های لغو شده در ادامه job دوباره پردازش می‌شوند
+    assert store.unfinished(store.load(job['id'])) == [1, 2]
+
+
+def test_inline_job_inputs_fingerprint_detects_changed_uploads(app):
+    fingerprint = app['uploaded_files_fingerprint']
+    files = make_files(2)
+    # rerun با همان فایل‌ها به job در حال اجرا وصل می‌شود؛ تغییر فایل‌ها آن را لغو می‌کند
+    assert fingerprint(files) == fingerprint([dict(f) for f in files])
+    assert fingerprint(files) != fingerprint(files[:1])
+    assert fingerprint(files) != fingerprint([files[0], dict(files[1], content=b'%PDF-x')])
@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def manager(app):
+    return app['APIKeyManager'](['key-a', 'key-b'])
+
+
+def picks(manager, count=50, **kwargs):
+    return {manager.get_next_key(**kwargs) for _ in range(count)}
+
+
+def open_circuit(manager, key='key-a'):
+    for _ in range(manager.max_failures):
+        manager.mark_failure(key, Exception('503 unavailable'))
+
+
+def test_repeated_failures_open_the_circuit(manager):
+    open_circuit(manager)
+    assert manager.health['key-a']['state'] == manager.OPEN
+    assert picks(manager) == {'key-b'}
+
+
+def test_auth_error_opens_with_long_cooldown(manager):
+    manager.mark_failure('key-a', Exception('400 API key not valid. Please pass a valid API key.'))
+    assert manager.health['key-a']['cooldown'] == manager.AUTH_COOLDOWN
+
+
+def test_half_open_sends_a_single_probe(manager):
+    open_circuit(manager)
+    manager.health['key-a']['open_until'] = time.monotonic()
+    # کلید دیگر ترجیح داده نمی‌شود تا probe حتماً به key-a برسد
+    assert manager.get_next_key(exclude={'key-b'}) == 'key-a'
+    assert manager.health['key-a']['state'] == manager.HALF_OPEN
+    assert picks(manager) == {'key-b'}
+
+
+def test_probe_success_closes_and_failure_doubles_cooldown(manager):
+    open_circuit(manager)
+    manager.health['key-a']['open_until'] = time.monotonic()
+    manager.get_next_key(exclude={'key-b'})
+    manager.mark_failure('key-a', Exception('503 unavailable'))
+    assert manager.health['key-a']['state'] == manager.OPEN
+    assert manager.health['key-a']['cooldown'] == 2 * manager.BASE_COOLDOWN
+
+    manager.health['key-a']['open_until'] = time.monotonic()
+    manager.get_next_key(exclude={'key-b'})
+    manager.mark_success('key-a', latency=1.0)
+    assert manager.health['key-a']['state'] == manager.CLOSED
+    assert 'key-a' in picks(manager, count=200)
+
+
+def test_keys_without_daily_quota_are_skipped(manager):
+    assert picks(manager, remaining={'key-a': 0.0, 'key-b': 0.5}) == {'key-b'}
+
+
+def test_all_circuits_open_falls_back_to_soonest_recovery(manager):
+    open_circuit(manager, 'key-a')
+    open_circuit(manager, 'key-b')
+    manager.health['key-b']['open_until'] -= 10
+    assert manager.get_next_key() == 'key-b'
@@ -0,0 +1,90 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+TRIAGE_MODEL = 'gemini-2.5-flash-lite'
+
+
+def result(app, risk):
+    analyzer = app['FinancialAnalyzer']
+    return {analyzer.ROOT_KEY: {analyzer.SECTION_KEYS[0]: {'سطح_ریسک_کلی_بنا_به_گزارش': risk}}}
+
+
+@pytest.fixture
+def analyzer(app):
+    analyzer = app['FinancialAnalyzer']()
+    analyzer.tiering = app['ModelTiering'](TRIAGE_MODEL, analyzer.model_name,
+                                           concurrency={TRIAGE_MODEL: 2, analyzer.model_name: 1})
+    return analyzer
+
+
+def stub_models(analyzer, outcomes):
+    """پاسخ هر مدل از outcomes؛ مقدار Exception بالا برده می‌شود"""
+    calls = []
+
+    async def call(payload, file_content, filename, schema=None, prompt=None, calibrate=True, model=None):
+        model = model or analyzer.model_name
+        calls.append(model)
+        outcome = outcomes[model]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    analyzer._call_model_hedged = call
+    return calls
+
+
+def extract(analyzer, content=b'%PDF-1'):
+    return asyncio.run(analyzer.extract_table_from_page_async(content, 'a.pdf'))
+
+
+def test_low_risk_triage_result_is_accepted(app, analyzer):
+    calls = stub_models(analyzer, {TRIAGE_MODEL: result(app, 'پایین')})
+    assert extract(analyzer) == result(app, 'پایین')
+    assert calls == [TRIAGE_MODEL]
+    assert analyzer.tiering.report()['accepted'] == 1
+
+
+@pytest.mark.parametrize('triage, reason', [
+    ('high_risk', 'high_risk'),
+    ('low_confidence', 'low_confidence'),
+    ('error', 'error'),
+])
+def test_unreliable_triage_escalates_to_main_model(app, analyzer, triage, reason):
+    outcomes = {
+        'high_risk': result(app, 'بحرانی'),
+        'low_confidence': app['LowConfidenceError']('avg_logprobs -0.90 < -0.5'),
+        'error': RuntimeError('500 internal'),
+    }
+    calls = stub_models(analyzer, {TRIAGE_MODEL: outcomes[triage], analyzer.model_name: result(app, 'متوسط')})
+    assert extract(analyzer) == result(app, 'متوسط')
+    assert calls == [TRIAGE_MODEL, analyzer.model_name]
+    assert analyzer.tiering.report()['reasons'] == {reason: 1}
+
+
+def test_retried_escalated_file_skips_triage(app, analyzer):
+    calls = stub_models(analyzer, {TRIAGE_MODEL: result(app, 'بالا'),
+                                   analyzer.model_name: RuntimeError('503 unavailable')})
+    with pytest.raises(RuntimeError):
+        extract(analyzer)
+    calls = stub_models(analyzer, {analyzer.model_name: result(app, 'بالا')})
+    extract(analyzer)
+    assert calls == [analyzer.model_name]
+
+
+def test_confidence_threshold(app, analyzer):
+    def response(avg_logprobs):
+        return SimpleNamespace(candidates=[SimpleNamespace(avg_logprobs=avg_logprobs)])
+
+    analyzer.tiering.check_confidence(response(-0.1))
+    analyzer.tiering.check_confidence(response(None))
+    with pytest.raises(app['LowConfidenceError']):
+        analyzer.tiering.check_confidence(response(-0.9))
+
+
+def test_triage_model_is_part_of_the_cache_fingerprint(app, analyzer):
+    plain = app['FinancialAnalyzer']()
+    assert analyzer.cache_fingerprint() != plain.cache_fingerprint()
+    # درخواست Batch بدون triage است
+    assert analyzer.cache_fingerprint(batch=True) == plain.cache_fingerprint(batch=True)
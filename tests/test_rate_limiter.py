@@ -0,0 +1,143 @@
+import asyncio
+import time
+
+import pytest
+
+MODEL = 'test-model'
+
+
+def make_limiter(app, ledger, rpm=2, tpm=1000, rpd=3):
+    return app['RateLimiter'](ledger=ledger, default_limits={'rpm': rpm, 'tpm': tpm, 'rpd': rpd})
+
+
+def test_ledger_enforces_daily_limit_and_refund(ledger):
+    assert ledger.try_consume('k1', MODEL, 2)
+    assert ledger.try_consume('k1', MODEL, 2)
+    assert not ledger.try_consume('k1', MODEL, 2)
+    assert ledger.remaining(['k1', 'k2'], MODEL, 2) == 2
+
+    ledger.refund('k1', MODEL)
+    assert ledger.usage(['k1'], MODEL)['k1']['requests'] == 1
+    assert ledger.try_consume('k1', MODEL, 2)
+
+
+def test_ledger_tracks_tokens_per_key(ledger):
+    ledger.add_tokens('k1', MODEL, 500)
+    ledger.add_tokens('k1', MODEL, 250)
+    usage = ledger.usage(['k1', 'k2'], MODEL)
+    assert usage['k1']['tokens'] == 750
+    assert usage['k2'] == {'requests': 0, 'tokens': 0}
+
+
+def test_ledger_is_shared_by_every_process_using_the_directory(app, ledger, tmp_path):
+    other = app['QuotaLedger'](str(tmp_path / 'ledger'))
+    assert other.try_consume('k1', MODEL, 1)
+    assert not ledger.try_consume('k1', MODEL, 1)
+
+
+def test_daily_usage_is_served_from_a_refreshed_snapshot(app, ledger):
+    limiter = make_limiter(app, ledger, rpd=10)
+    ledger.try_consume('k1', MODEL, 10)
+    ledger.try_consume('k1', MODEL, 10)
+    # اولین خواندن منتظر SQLite نمی‌ماند؛ snapshot در پس‌زمینه پر می‌شود
+    assert limiter.daily_usage(['k1', 'k2'], MODEL) == {'k1': 0, 'k2': 0}
+    deadline = time.time() + 2
+    while limiter.daily_usage(['k1', 'k2'], MODEL)['k1'] != 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert limiter.daily_usage(['k1', 'k2'], MODEL) == {'k1': 2, 'k2': 0}
+
+    # رزروهای همین فرایند بدون خواندن دوباره دفتر در snapshot دیده می‌شوند
+    limiter.reserve('k2', MODEL, 10)
+    limiter.refund('k1', MODEL, 10)
+    assert limiter.daily_usage(['k1', 'k2'], MODEL) == {'k1': 1, 'k2': 1}
+
+
+def test_reserve_waits_once_bucket_is_empty(app, ledger):
+    limiter = make_limiter(app, ledger, rpm=2, rpd=10)
+    assert limiter.reserve('k1', MODEL, 10) == 0
+    assert limiter.reserve('k1', MODEL, 10) == 0
+    # سطل دو درخواست در دقیقه: درخواست سوم حدود ۳۰ ثانیه منتظر می‌ماند
+    assert limiter.reserve('k1', MODEL, 10) == pytest.approx(30, abs=0.5)
+    # سطل هر کلید جداگانه است
+    assert limiter.reserve('k2', MODEL, 10) == 0
+    assert limiter.snapshot()['waited'] == 1
+
+
+def test_reserve_waits_for_token_budget(app, ledger):
+    limiter = make_limiter(app, ledger, rpm=100, tpm=1000, rpd=10)
+    assert limiter.reserve('k1', MODEL, 1000) == 0
+    assert limiter.reserve('k1', MODEL, 500) == pytest.approx(30, abs=0.5)
+
+
+def test_reserve_raises_when_key_daily_quota_is_exhausted(app, ledger):
+    limiter = make_limiter(app, ledger, rpm=100, rpd=1)
+    limiter.reserve('k1', MODEL, 10)
+    with pytest.raises(app['DailyQuotaExceededError']):
+        limiter.reserve('k1', MODEL, 10)
+
+
+def test_refund_restores_bucket_and_ledger(app, ledger):
+    limiter = make_limiter(app, ledger, rpm=1, rpd=10)
+    limiter.reserve('k1', MODEL, 10)
+    limiter.refund('k1', MODEL, 10)
+    assert limiter.reserve('k1', MODEL, 10) == 0
+    assert ledger.usage(['k1'], MODEL)['k1']['requests'] == 1
+    assert limiter.snapshot()['refunded'] == 1
+
+
+def test_cancelled_acquire_is_refunded(app, ledger):
+    limiter = make_limiter(app, ledger, rpm=1, rpd=10)
+    limiter.reserve('k1', MODEL, 10)
+
+    async def cancel_waiting_acquire():
+        task = asyncio.create_task(limiter.acquire_async('k1', MODEL, 10))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_waiting_acquire())
+    assert limiter.snapshot()['refunded'] == 1
+    assert ledger.usage(['k1'], MODEL)['k1']['requests'] == 1
+
+
+def test_cancel_during_daily_quota_check_refunds_it(app, ledger, monkeypatch):
+    limiter = make_limiter(app, ledger, rpm=100, rpd=10)
+    try_consume = ledger.try_consume
+
+    def slow_consume(*args):
+        time.sleep(0.2)
+        return try_consume(*args)
+
+    monkeypatch.setattr(ledger, 'try_consume', slow_consume)
+
+    async def cancel_during_consume():
+        task = asyncio.create_task(limiter.acquire_async('k1', MODEL, 10))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # ثبت دفتر در thread ادامه می‌یابد و پس از پایان برگردانده می‌شود
+        await asyncio.sleep(0.4)
+
+    asyncio.run(cancel_during_consume())
+    assert ledger.usage(['k1'], MODEL)['k1']['requests'] == 0
+
+
+def test_acquire_client_skips_exhausted_keys(app, app_globals, ledger, monkeypatch):
+    keys = app_globals['api_key_manager'].api_keys
+    limiter = make_limiter(app, ledger, rpm=100, rpd=1)
+    monkeypatch.setitem(app_globals, 'rate_limiter', limiter)
+    monkeypatch.setitem(app_globals, 'quota_ledger', ledger)
+    ledger.try_consume(keys[0], MODEL, 1)
+
+    async def acquire_all():
+        # کلید پیشنهادی سهمیه ندارد؛ کلید دیگری انتخاب می‌شود
+        _, first = await app['acquire_client_async'](MODEL, 10, (None, keys[0]))
+        rest = [(await app['acquire_client_async'](MODEL, 10))[1] for _ in keys[2:]]
+        return [first, *rest]
+
+    used = asyncio.run(acquire_all())
+    assert sorted(used) == sorted(keys[1:])
+    with pytest.raises(app['DailyQuotaExceededError'], match='all API keys'):
+        asyncio.run(app['acquire_client_async'](MODEL, 10))
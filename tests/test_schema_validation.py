@@ -0,0 +1,97 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'name': {'type': 'string'},
+        'opinion': {'type': 'string', 'enum': ['مقبول', 'مشروط']},
+        'points': {'type': 'array', 'items': {'type': 'string'}},
+        'ok': {'type': 'boolean'}
+    },
+    'required': ['name', 'opinion']
+}
+
+
+def sample(schema):
+    """کوچک‌ترین نمونه معتبر برای schema"""
+    if 'enum' in schema:
+        return schema['enum'][0]
+    kind = schema.get('type')
+    if kind == 'object':
+        return {key: sample(sub) for key, sub in schema.get('properties', {}).items()}
+    if kind == 'array':
+        return [sample(schema['items'])] if 'items' in schema else []
+    return {'string': 'x', 'boolean': True, 'integer': 0, 'number': 0.0}.get(kind)
+
+
+def test_valid_document_has_no_errors(app):
+    validator = app['SchemaValidator'](SCHEMA)
+    assert validator.validate({'name': 'a', 'opinion': 'مقبول', 'points': ['x'], 'ok': False}) == []
+
+
+def test_errors_report_path_and_kind(app):
+    validator = app['SchemaValidator'](SCHEMA)
+    errors = validator.validate({'opinion': 'نامشخص', 'points': ['x', 3], 'ok': 1})
+    assert sorted(errors) == sorted([
+        (('name',), 'missing', 'required field'),
+        (('opinion',), 'enum', "'نامشخص' is not an allowed value"),
+        (('points', 1), 'type', 'expected string'),
+        (('ok',), 'type', 'expected boolean'),
+    ])
+
+
+def test_root_type_mismatch_stops_descent(app):
+    assert app['SchemaValidator'](SCHEMA).validate([]) == [((), 'type', 'expected object')]
+
+
+@pytest.fixture
+def analyzer(app):
+    return app['FinancialAnalyzer']()
+
+
+def full_result(analyzer):
+    root_schema = analyzer.response_schema['properties'][analyzer.ROOT_KEY]['properties']
+    root = {section: sample(root_schema[section]) for section in analyzer.SECTION_KEYS}
+    item = root[analyzer.CHECKLIST_KEY][0]
+    root[analyzer.CHECKLIST_KEY] = [dict(item, **{'موضوع': topic}) for topic in analyzer.checklist_topics()]
+    return {analyzer.ROOT_KEY: root}
+
+
+def respond(data):
+    text = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+    return SimpleNamespace(text=text, candidates=[])
+
+
+def test_valid_response_is_accepted(analyzer):
+    data = full_result(analyzer)
+    assert analyzer._parse_response(respond(data)) == data
+
+
+def test_invalid_section_is_reported_with_the_healthy_ones(app, analyzer):
+    data = full_result(analyzer)
+    broken, healthy, checklist = analyzer.SECTION_KEYS
+    data[analyzer.ROOT_KEY][broken] = {'نام_شرکت': 3}
+    dropped = data[analyzer.ROOT_KEY][checklist].pop()
+
+    with pytest.raises(app['ExtractionDefectError']) as defect:
+        analyzer._parse_response(respond(data))
+    assert defect.value.broken_sections == [broken]
+    assert defect.value.missing_topics == [dropped['موضوع']]
+    assert set(defect.value.partial[analyzer.ROOT_KEY]) == {healthy, checklist}
+    # فقط بخش معیوب و موضوع جاافتاده دوباره درخواست می‌شوند
+    assert [label for label, _, _ in analyzer._repair_plan(defect.value.broken_sections,
+                                                            defect.value.missing_topics)] == [broken, 'topics']
+
+
+def test_truncated_json_salvages_complete_checklist_items(app, analyzer):
+    data = full_result(analyzer)
+    text = json.dumps(data, ensure_ascii=False)
+    cut = text.rindex('{"موضوع"')
+    with pytest.raises(app['ExtractionDefectError']) as defect:
+        analyzer._parse_response(respond(text[:cut]))
+    assert defect.value.truncated and defect.value.broken_sections == []
+    topics = analyzer.checklist_topics()
+    assert defect.value.missing_topics == topics[-1:]
@@ -0,0 +1,93 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def task_queue(app, tmp_path):
+    return app['SQLiteTaskQueue'](str(tmp_path / 'queue.sqlite3'), lease_seconds=0.3)
+
+
+def enqueue(task_queue, batch_id='b1', count=1, **kwargs):
+    task_queue.enqueue(batch_id, [
+        {'position': position, 'name': f'{position}.pdf', 'content': b'%PDF', 'tokens': 10, 'requests': 1}
+        for position in range(count)
+    ], {'streaming': False}, 3, **kwargs)
+
+
+def test_claim_leases_each_task_once(task_queue):
+    enqueue(task_queue, count=2)
+    first = task_queue.claim('w1', 1)
+    second = task_queue.claim('w2', 5)
+    assert [task['position'] for task in first] == [0]
+    assert [task['position'] for task in second] == [1]
+    assert task_queue.claim('w3', 5) == []
+    assert first[0]['batch_id'] == 'b1' and first[0]['settings'] == {'streaming': False}
+
+
+def test_complete_requires_current_lease(task_queue):
+    enqueue(task_queue)
+    task = task_queue.claim('w1', 1)[0]
+    assert not task_queue.complete(task['id'], 'w2', {'ok': True})
+    assert task_queue.complete(task['id'], 'w1', {'ok': True})
+    status = task_queue.batch_status('b1')[0]
+    assert status['state'] == 'done' and status['result'] == {'ok': True}
+
+
+def test_expired_lease_is_reclaimed_and_stale_result_discarded(task_queue):
+    enqueue(task_queue)
+    stale = task_queue.claim('w1', 1)[0]
+    time.sleep(0.4)
+    fresh = task_queue.claim('w2', 1)[0]
+    assert fresh['id'] == stale['id'] and fresh['attempt'] == 2
+    assert not task_queue.complete(stale['id'], 'w1', {'from': 'w1'})
+    assert task_queue.complete(fresh['id'], 'w2', {'from': 'w2'})
+    assert task_queue.batch_status('b1')[0]['result'] == {'from': 'w2'}
+
+
+def test_heartbeat_extends_lease(task_queue):
+    enqueue(task_queue)
+    task = task_queue.claim('w1', 1)[0]
+    time.sleep(0.2)
+    task_queue.heartbeat('w1', [task['id']])
+    time.sleep(0.2)
+    assert task_queue.claim('w2', 1) == []
+    assert task_queue.complete(task['id'], 'w1', {'ok': True})
+
+
+def test_fail_with_retry_requeues_task(task_queue):
+    enqueue(task_queue)
+    task = task_queue.claim('w1', 1)[0]
+    task_queue.fail(task['id'], 'w1', '503 unavailable', retry_at=time.time())
+    retried = task_queue.claim('w2', 1)[0]
+    assert retried['id'] == task['id'] and retried['attempt'] == 2
+    task_queue.fail(retried['id'], 'w2', 'invalid file')
+    assert task_queue.batch_status('b1')[0]['state'] == 'failed'
+
+
+def test_cancel_stops_queued_and_leased_tasks(task_queue):
+    enqueue(task_queue, count=3)
+    leased = task_queue.claim('w1', 1)[0]
+    task_queue.cancel('b1')
+    assert task_queue.claim('w2', 5) == []
+    assert task_queue.cancelled([leased['id']]) == [leased['id']]
+    assert not task_queue.complete(leased['id'], 'w1', {'late': True})
+    assert {task['state'] for task in task_queue.batch_status('b1')} == {'cancelled'}
+
+
+def test_claim_respects_limit_and_global_in_flight_cap(task_queue):
+    enqueue(task_queue, 'a', count=5, owner='alice')
+    enqueue(task_queue, 'b', count=5, owner='bob')
+    assert task_queue.claim('w1', 0) == []
+    assert len(task_queue.claim('w1', 3)) == 3
+    # سقف سراسری همزمانی روی همه workerها
+    assert len(task_queue.claim('w2', 5, max_in_flight=4)) == 1
+    assert len(task_queue.claim('w3', 10)) == 6
+
+
+def test_claim_interleaves_owners(task_queue):
+    enqueue(task_queue, 'big', count=6, owner='alice')
+    enqueue(task_queue, 'small', count=2, owner='bob')
+    owners = [task['batch_id'] for task in task_queue.claim('w1', 4)]
+    # batch کوچک همکار پشت شش فایل batch بزرگ نمی‌ماند
+    assert owners.count('small') == 2
@@ -0,0 +1,106 @@
+"""
+بنچمارک ترتیب ارسال فایل‌ها (APILimitsManager.dispatch_order) روی توزیع‌های مصنوعی اندازه فایل
+
+هر worker آزاد فایل بعدی صف را برمی‌دارد (همان رفتار صف AsyncExtractionEngine). ترتیب‌ها
+بر اساس زمان تخمینی (از تعداد صفحات) ساخته می‌شوند و زمان واقعی هر فایل با نویز
+تصادفی از تخمین فاصله دارد تا اثر خطای تخمین هم دیده شود.
+
+اجرا:
+    python tools/benchmark_dispatch_order.py --workers 4 10 --files 100 --trials 200
+
+خروجی برای هر توزیع: میانگین زمان کل (makespan)، زمان اولین نتیجه و میانگین زمان
+تکمیل فایل‌ها برای ترتیب بارگذاری، بزرگ‌ترین اول و کوچک‌ترین اول، به همراه کران پایین
+max(مجموع زمان‌ها / workers، طولانی‌ترین فایل).
+
+ترتیب‌ها و شبیه‌سازی مستقیماً از APILimitsManager در app.py خوانده می‌شوند (مانند
+tools/extraction_worker.py)؛ هیچ درخواستی به API ارسال نمی‌شود.
+"""
+import argparse
+import os
+import random
+import runpy
+import statistics
+import tempfile
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+
+SECONDS_PER_PAGE = 0.35
+OVERHEAD_SECONDS = 8.0
+
+
+def pages_uniform(n, rng):
+    return [rng.randint(10, 60) for _ in range(n)]
+
+
+def pages_lognormal(n, rng):
+    return [max(1, int(rng.lognormvariate(3.0, 0.8))) for _ in range(n)]
+
+
+def pages_bimodal(n, rng):
+    # بیشتر گزارش‌ها کوتاه، چند گزارش کامل سالانه بسیار بلند
+    return [rng.randint(200, 300) if rng.random() < 0.1 else rng.randint(8, 25) for _ in range(n)]
+
+
+def pages_giant_last(n, rng):
+    # بدترین حالت ترتیب بارگذاری: یک گزارش ۳۰۰ صفحه‌ای در انتهای batch
+    return [rng.randint(8, 25) for _ in range(n - 1)] + [300]
+
+
+DISTRIBUTIONS = {
+    'uniform': pages_uniform,
+    'lognormal': pages_lognormal,
+    'bimodal': pages_bimodal,
+    'giant-last': pages_giant_last,
+}
+
+
+def load_limits_manager():
+    """APILimitsManager از app.py بیرون از Streamlit (همان مسیر اجرای worker)"""
+    # app.py بدون کلید API اجرا نمی‌شود و دفتر سهمیه را در پوشه کش می‌سازد؛ بنچمارک به هیچ‌کدام نیاز ندارد
+    os.environ.setdefault("GOOGLE_API_KEYS", "benchmark")
+    os.environ.setdefault("ANALYSIS_CACHE_DIR", tempfile.mkdtemp(prefix='dispatch-benchmark-'))
+    os.chdir(os.path.dirname(APP_PATH))
+    return runpy.run_path(APP_PATH, run_name='__extraction_worker__')['APILimitsManager']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Makespan benchmark for file dispatch order")
+    parser.add_argument('--workers', type=int, nargs='+', default=[4, 10])
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--trials', type=int, default=200)
+    parser.add_argument('--noise', type=float, default=0.25, help='انحراف معیار لگاریتمی زمان واقعی نسبت به تخمین')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    limits_manager = load_limits_manager()
+
+    def simulate(durations, workers, order):
+        """(makespan، زمان اولین نتیجه، میانگین زمان تکمیل)"""
+        completions = limits_manager.simulate_completions(durations, workers, order)
+        return max(completions), min(completions), statistics.fmean(completions)
+
+    rng = random.Random(args.seed)
+    modes = ('upload', 'longest', 'shortest')
+    print(f"{'distribution':<12} {'workers':>7} {'bound':>8} " +
+          " ".join(f"{mode + ' makespan/first/mean':>30}" for mode in modes) + f" {'LPT gain':>9}")
+    for name, generator in DISTRIBUTIONS.items():
+        for workers in args.workers:
+            totals = {mode: [[], [], []] for mode in modes}
+            bounds = []
+            for _ in range(args.trials):
+                pages = generator(args.files, rng)
+                estimates = [OVERHEAD_SECONDS + SECONDS_PER_PAGE * p for p in pages]
+                durations = [e * rng.lognormvariate(0.0, args.noise) for e in estimates]
+                bounds.append(max(sum(durations) / workers, max(durations)))
+                for mode in modes:
+                    for metric, value in zip(totals[mode], simulate(durations, workers, limits_manager.dispatch_order(estimates, mode))):
+                        metric.append(value)
+            means = {mode: [statistics.fmean(metric) for metric in totals[mode]] for mode in modes}
+            gain = 1 - means['longest'][0] / means['upload'][0]
+            print(f"{name:<12} {workers:>7} {statistics.fmean(bounds):>7.0f}s " +
+                  " ".join(f"{m[0]:>12.0f}s/{m[1]:>6.0f}s/{m[2]:>7.0f}s" for m in means.values()) +
+                  f" {gain:>8.1%}")
+
+
+if __name__ == "__main__":
+    main()
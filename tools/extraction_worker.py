@@ -0,0 +1,58 @@
+"""
+worker صف مشترک استخراج برای اجرای چند replica از app.py
+
+replicaها فایل‌های هر job را در صف SQLite روی دیسک مشترک قرار می‌دهند و این workerها
+(روی هر node) وظایف را برداشته و با همان FinancialAnalyzer برنامه پردازش می‌کنند. سقف
+همزمانی و RPM/TPM مجموع کلیدها در خود صف و سهمیه روزانه در QuotaLedger مشترک اعمال
+می‌شود؛ برای افزایش توان پردازش کافی است worker بیشتری اجرا شود.
+
+اجرا:
+    TASK_QUEUE_BACKEND=sqlite TASK_QUEUE_PATH=/shared/task_queue.sqlite3 QUOTA_LEDGER_DIR=/shared \\
+        GEMINI_RPM=2 GEMINI_TPM=125000 GEMINI_RPD=50 python tools/extraction_worker.py --concurrency 8
+
+replicaهای Streamlit باید همان TASK_QUEUE_BACKEND و TASK_QUEUE_PATH و محدودیت‌های GEMINI_RPM/TPM/RPD
+را داشته باشند.
+"""
+import argparse
+import asyncio
+import os
+import runpy
+import signal
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared task queue worker for FinancialAnalyzer")
+    parser.add_argument('--concurrency', type=int, default=4, help='حداکثر فایل همزمان این worker')
+    parser.add_argument('--max-in-flight', type=int, default=int(os.getenv("GEMINI_MAX_CONCURRENCY", "50")),
+                        help='سقف سراسری فایل‌های در حال پردازش روی همه workerها')
+    parser.add_argument('--worker-id', default=None)
+    args = parser.parse_args()
+
+    # config.yaml و style.css نسبت به پوشه برنامه خوانده می‌شوند
+    os.chdir(os.path.dirname(APP_PATH))
+    app = runpy.run_path(APP_PATH, run_name='__extraction_worker__')
+    task_queue = app['get_task_queue']()
+    if task_queue is None or isinstance(task_queue, app['LocalTaskQueue']):
+        parser.error("TASK_QUEUE_BACKEND=sqlite و مسیر مشترک TASK_QUEUE_PATH باید تنظیم شوند")
+
+    worker = app['ExtractionWorker'](
+        task_queue,
+        concurrency=args.concurrency,
+        worker_id=args.worker_id,
+        max_in_flight=args.max_in_flight
+    )
+
+    async def run():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await worker.run(stop)
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+سرور جعلی Gemini برای بنچمارک موتور پردازش همزمان بدون مصرف سهمیه API
+
+اجرا:
+    python tools/fake_gemini_server.py --port 8765 --latency 20 --jitter 10
+    GEMINI_API_BASE_URL=http://127.0.0.1:8765 streamlit run app.py
+
+هر درخواست generateContent پس از تأخیر تصادفی یک پاسخ JSON معتبر مطابق
+responseSchema همان درخواست برمی‌گرداند. درخواست‌های streamGenerateContent همان پاسخ را
+در چند قطعه SSE با فاصله زمانی ارسال می‌کنند.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_RESULT = {
+    "تحلیل_جامع_گزارش_حسابرسی": {
+        "بخش۱_خلاصه_و_اطلاعات_کلیدی": {
+            "نام_شرکت": "شرکت نمونه",
+            "نام_حسابرس": "موسسه حسابرسی نمونه",
+            "دوره_مالی": "سال مالی منتهی به ۲۹ اسفند ۱۴۰۲",
+            "نوع_اظهارنظر": "مقبول",
+            "سطح_ریسک_کلی_بنا_به_گزارش": "پایین",
+            "جزییات_سطح_ریسک_تعیین_شده": "پاسخ آزمایشی سرور جعلی",
+            "نکات_کلیدی_و_نتیجه_گیری": ["نکته ۱", "نکته ۲", "نکته ۳"]
+        },
+        "بخش۲_تجزیه_تحلیل_گزارش": {
+            "بند_اظهارنظر": {"نوع": "مقبول", "خلاصه_دلایل": "-"},
+            "بند_مبانی_اظهارنظر": {"موضوعیت_دارد": False},
+            "بند_تاکید_بر_مطالب_خاص": {"موضوعیت_دارد": False},
+            "گزارش_رعایت_الزامات_قانونی": {"موضوعیت_دارد": False}
+        },
+        "بخش۳_چک_لیست_موضوعی": []
+    }
+}
+
+def sample_from_schema(schema: dict):
+    """
+    نمونه معتبر از responseSchema درخواست؛ آرایه‌هایی که عناصرشان فیلد enum دارند
+    (مانند چک‌لیست موضوعی) برای هر مقدار enum یک عنصر می‌گیرند
+    """
+    kind = str(schema.get('type', '')).lower()
+    if 'enum' in schema:
+        return schema['enum'][0]
+    if kind == 'object':
+        return {key: sample_from_schema(sub) for key, sub in schema.get('properties', {}).items()}
+    if kind == 'array':
+        items = schema.get('items', {})
+        for key, sub in items.get('properties', {}).items():
+            if 'enum' in sub:
+                return [dict(sample_from_schema(items), **{key: value}) for value in sub['enum']]
+        return [sample_from_schema(items)]
+    if kind == 'boolean':
+        return False
+    if kind in ('integer', 'number'):
+        return 1
+    return "نمونه"
+
+
+def build_result(request_body: dict) -> dict:
+    """پاسخ مطابق schema درخواست (مثلاً فقط یک بخش یا چند موضوع)، با مقادیر SAMPLE_RESULT در بخش خلاصه"""
+    config = request_body.get('generationConfig') or request_body.get('generation_config') or {}
+    schema = config.get('responseSchema') or config.get('response_schema')
+    if not schema:
+        return SAMPLE_RESULT
+    result = sample_from_schema(schema)
+    for root_key, sections in SAMPLE_RESULT.items():
+        summary_key = next(iter(sections))
+        if isinstance(result.get(root_key), dict) and summary_key in result[root_key]:
+            result[root_key][summary_key] = sections[summary_key]
+    return result
+
+
+stats = {'requests': 0, 'in_flight': 0, 'max_in_flight': 0}
+stats_lock = threading.Lock()
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    latency = 20.0
+    jitter = 10.0
+    error_rate = 0.0
+    straggler_rate = 0.0
+    straggler_latency = 120.0
+    truncate_rate = 0.0
+    retry_after = 0.0
+    revoked_keys = ()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            request_body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            request_body = {}
+
+        with stats_lock:
+            stats['requests'] += 1
+            stats['in_flight'] += 1
+            stats['max_in_flight'] = max(stats['max_in_flight'], stats['in_flight'])
+        try:
+            if self.headers.get('x-goog-api-key') in self.revoked_keys:
+                self._send(400, {"error": {"code": 400, "message": "API key not valid. Please pass a valid API key.",
+                                           "status": "INVALID_ARGUMENT"}})
+                return
+            if random.random() < self.straggler_rate:
+                time.sleep(self.straggler_latency)
+            else:
+                time.sleep(max(0.0, random.uniform(self.latency - self.jitter, self.latency + self.jitter)))
+            if random.random() < self.error_rate:
+                error = {"code": 429, "message": "Resource exhausted (fake)", "status": "RESOURCE_EXHAUSTED"}
+                if self.retry_after:
+                    error["details"] = [{"@type": "type.googleapis.com/google.rpc.RetryInfo",
+                                         "retryDelay": f"{self.retry_after:g}s"}]
+                self._send(429, {"error": error})
+                return
+            text = json.dumps(build_result(request_body), ensure_ascii=False)
+            finish_reason = "STOP"
+            if random.random() < self.truncate_rate:
+                # شبیه‌سازی رسیدن به سقف توکن خروجی
+                text = text[:int(len(text) * 0.7)]
+                finish_reason = "MAX_TOKENS"
+            usage = {"promptTokenCount": 15000, "candidatesTokenCount": 3000, "totalTokenCount": 18000}
+            if ':streamGenerateContent' in self.path:
+                self._send_stream(text, usage, finish_reason)
+                return
+            self._send(200, {
+                "candidates": [{
+                    "content": {"role": "model", "parts": [{"text": text}]},
+                    "finishReason": finish_reason,
+                    "avgLogprobs": round(random.uniform(-0.6, -0.05), 3)
+                }],
+                "usageMetadata": usage
+            })
+        finally:
+            with stats_lock:
+                stats['in_flight'] -= 1
+
+    def _send_stream(self, text: str, usage: dict, finish_reason: str = "STOP", chunks: int = 4):
+        """ارسال پاسخ در چند رویداد SSE؛ تأخیر اصلی قبل از اولین قطعه اعمال شده است"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        size = -(-len(text) // chunks)
+        for i in range(chunks):
+            last = i == chunks - 1
+            candidate = {"content": {"role": "model", "parts": [{"text": text[i * size:(i + 1) * size]}]}}
+            if last:
+                candidate["finishReason"] = finish_reason
+                candidate["avgLogprobs"] = round(random.uniform(-0.6, -0.05), 3)
+            event = {"candidates": [candidate]}
+            if last:
+                event["usageMetadata"] = usage
+            self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\r\n\r\n".encode('utf-8'))
+            self.wfile.flush()
+            if not last:
+                time.sleep(self.latency * 0.2)
+        self.close_connection = True
+
+    def _send(self, status: int, body: dict):
+        payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Gemini generateContent/streamGenerateContent endpoint")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=20.0, help='میانگین تأخیر پاسخ (ثانیه)')
+    parser.add_argument('--jitter', type=float, default=10.0, help='دامنه تغییر تصادفی تأخیر (ثانیه)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='نسبت پاسخ‌های 429')
+    parser.add_argument('--straggler-rate', type=float, default=0.0, help='نسبت درخواست‌های بسیار کند')
+    parser.add_argument('--straggler-latency', type=float, default=120.0, help='تأخیر درخواست‌های کند (ثانیه)')
+    parser.add_argument('--truncate-rate', type=float, default=0.0, help='نسبت پاسخ‌های قطع شده (MAX_TOKENS)')
+    parser.add_argument('--retry-after', type=float, default=0.0, help='retryDelay پیشنهادی در پاسخ‌های 429 (ثانیه)')
+    parser.add_argument('--revoked-key', action='append', default=[], help='کلیدی که همیشه خطای کلید نامعتبر می‌گیرد')
+    args = parser.parse_args()
+
+    FakeGeminiHandler.latency = args.latency
+    FakeGeminiHandler.jitter = args.jitter
+    FakeGeminiHandler.error_rate = args.error_rate
+    FakeGeminiHandler.straggler_rate = args.straggler_rate
+    FakeGeminiHandler.straggler_latency = args.straggler_latency
+    FakeGeminiHandler.truncate_rate = args.truncate_rate
+    FakeGeminiHandler.retry_after = args.retry_after
+    FakeGeminiHandler.revoked_keys = tuple(args.revoked_key)
+
+    server = ThreadingHTTPServer((args.host, args.port), FakeGeminiHandler)
+    server.daemon_threads = True
+    print(f"Fake Gemini listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"requests={stats['requests']} max_in_flight={stats['max_in_flight']}")
+
+
+if __name__ == "__main__":
+    main()